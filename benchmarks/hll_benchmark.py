@@ -0,0 +1,73 @@
+"""
+Compares :class:`sifr.hll.HyperLogLog` with the hyperloglog package
+that sifr used to depend on (if it is installed): memory per key and
+identifiers added per second, one at a time and in batches.
+
+Run from the repository root::
+
+    python benchmarks/hll_benchmark.py
+"""
+import sys
+import time
+
+from sifr.hll import HyperLogLog
+
+try:
+    import hyperloglog
+except ImportError:  # pragma: no cover
+    hyperloglog = None
+
+IDENTIFIERS = ["user-%d" % i for i in range(200000)]
+BATCH = 1000
+
+
+def sizeof(sketch):
+    registers = getattr(sketch, "registers", None)
+    if registers is None:
+        registers = sketch.M
+    if hasattr(registers, "nbytes"):
+        return sys.getsizeof(sketch) + registers.nbytes
+    return sys.getsizeof(sketch) + sys.getsizeof(registers) + sum(
+        sys.getsizeof(register) for register in set(registers)
+    )
+
+
+def rate(add, identifiers):
+    start = time.time()
+    add(identifiers)
+    return len(identifiers) / (time.time() - start)
+
+
+def single(sketch):
+    def add(identifiers):
+        for identifier in identifiers:
+            sketch.add(identifier)
+    return add
+
+
+def batched(sketch):
+    def add(identifiers):
+        for offset in range(0, len(identifiers), BATCH):
+            sketch.update(identifiers[offset:offset + BATCH])
+    return add
+
+
+def main():
+    sketches = [("sifr.hll", HyperLogLog, True)]
+    if hyperloglog is not None:
+        sketches.append(
+            ("hyperloglog", hyperloglog.HyperLogLog, False)
+        )
+    for name, cls, can_batch in sketches:
+        print("%s: %d bytes per key" % (name, sizeof(cls(0.005))))
+        print("  add: %.0f/s" % rate(
+            single(cls(0.005)), IDENTIFIERS[:20000]
+        ))
+        if can_batch:
+            print("  update (%d per batch): %.0f/s" % (
+                BATCH, rate(batched(cls(0.005)), IDENTIFIERS)
+            ))
+
+
+if __name__ == "__main__":
+    main()
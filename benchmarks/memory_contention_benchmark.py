@@ -0,0 +1,59 @@
+"""
+Thread contention benchmark for the in memory storages. Every thread
+counts events for its own set of keys at all resolutions.
+
+Run from the repository root::
+
+    python benchmarks/memory_contention_benchmark.py
+"""
+import datetime
+import threading
+import time
+
+from sifr.span import ALL_SPANS
+from sifr.storage import MemoryStorage, ShardedMemoryStorage
+
+EVENTS = 20000
+
+
+def run_threads(storage, threads):
+    now = datetime.datetime.now()
+    spans = [
+        [
+            [span(now, ["views", thread, key]) for span in ALL_SPANS]
+            for key in range(100)
+        ]
+        for thread in range(threads)
+    ]
+    ready = threading.Event()
+
+    def write(thread_spans):
+        ready.wait()
+        for event in range(EVENTS // threads):
+            storage.incr_multi(thread_spans[event % 100])
+            storage.incr_unique_multi(thread_spans[event % 100], event)
+
+    workers = [
+        threading.Thread(target=write, args=(spans[thread],))
+        for thread in range(threads)
+    ]
+    [worker.start() for worker in workers]
+    start = time.time()
+    ready.set()
+    [worker.join() for worker in workers]
+    return EVENTS / (time.time() - start)
+
+
+def run():
+    for threads in [1, 2, 4, 8]:
+        for name, storage in [
+            ("MemoryStorage", MemoryStorage),
+            ("ShardedMemoryStorage", ShardedMemoryStorage)
+        ]:
+            print("%-22s threads=%d %10.0f events/s" % (
+                name, threads, run_threads(storage(), threads)
+            ))
+
+
+if __name__ == "__main__":
+    run()
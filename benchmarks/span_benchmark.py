@@ -0,0 +1,46 @@
+"""
+Micro benchmark for span construction and key access.
+
+Run from the repository root::
+
+    python benchmarks/span_benchmark.py
+"""
+import timeit
+
+SETUP = """
+import datetime
+from sifr.span import {span}
+now = datetime.datetime(2015, 6, 16, 12, 30, 15)
+span = {span}(now, ["views", "user", 1])
+"""
+
+CASES = [
+    ("construct", "{span}(now, ['views', 'user', 1])"),
+    ("key", "span.key"),
+    ("timestamp", "span.timestamp"),
+    ("range", "span.range"),
+    ("construct + 3 keys", (
+        "s = {span}(now, ['views', 'user', 1]); "
+        "s.key + ':c'; s.key + ':u'; s.key + ':t'"
+    )),
+]
+
+
+def run(number=20000, repeat=3):
+    for span in ["Minute", "Hour", "Day", "Month", "Year"]:
+        for name, stmt in CASES:
+            best = min(
+                timeit.repeat(
+                    stmt.format(span=span),
+                    SETUP.format(span=span),
+                    number=number,
+                    repeat=repeat
+                )
+            )
+            print(
+                "%-8s %-20s %8.3f us" % (span, name, best / number * 1e6)
+            )
+
+
+if __name__ == "__main__":
+    run()
@@ -28,8 +28,9 @@ REQUIREMENTS.extend([EGG.findall(req)[0] for req in FULL_REQUIREMENTS if req.sta
 DAEMON_REQUIREMENTS = requirements_from_file('daemon.txt')
 REDIS_REQUIREMENTS = requirements_from_file('redis.txt')
 RIAK_REQUIREMENTS = requirements_from_file('riak.txt')
+ASYNCIO_REQUIREMENTS = requirements_from_file('asyncio.txt')
 
-ALL_REQUIREMENTS = REQUIREMENTS + DAEMON_REQUIREMENTS + REDIS_REQUIREMENTS + RIAK_REQUIREMENTS
+ALL_REQUIREMENTS = REQUIREMENTS + DAEMON_REQUIREMENTS + REDIS_REQUIREMENTS + RIAK_REQUIREMENTS + ASYNCIO_REQUIREMENTS
 
 versioneer.versionfile_source = "sifr/_version.py"
 versioneer.versionfile_build = "sifr/version.py"
@@ -50,6 +51,7 @@ setup(
         'daemon': DAEMON_REQUIREMENTS,
         'redis': REDIS_REQUIREMENTS,
         'riak': RIAK_REQUIREMENTS,
+        'asyncio': ASYNCIO_REQUIREMENTS,
         'all': ALL_REQUIREMENTS
     },
     dependency_links=DEPENDENCY_LINKS,
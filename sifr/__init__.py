@@ -47,3 +47,9 @@ class RPCClient(object):
                 'uniques', key, time.mktime(at.timetuple()), resolution
             )
         )
+
+    def tracked_cardinality(self, key, at, resolution):
+        return self.client.call(
+            'tracked_cardinality', key, time.mktime(at.timetuple()),
+            resolution
+        )
@@ -0,0 +1,270 @@
+"""
+asyncio counterparts of the storage backends in :mod:`sifr.storage`.
+Requires python 3.5+ (and the ``asyncio`` extra, redis-py 4.2+, for
+:class:`AsyncRedisStorage`).
+"""
+from abc import abstractmethod, ABCMeta
+import asyncio
+
+from sifr.storage import MemoryStorage, WRITE_SCRIPT, script_arguments
+
+
+class AsyncStorage(metaclass=ABCMeta):
+    @abstractmethod
+    async def incr(self, span, amount=1):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def incr_multi(self, spans, amount=1):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def incr_unique(self, span, identifier):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def incr_unique_multi(self, spans, identifier):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def track(self, span, identifier):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def track_multi(self, spans, identifier):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def count(self, span):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def cardinality(self, span):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def uniques(self, span):
+        raise NotImplementedError
+
+    async def incr_spans(self, amounts):
+        """
+        Increments several spans by individual amounts.
+
+        :param amounts: an iterable of ``(span, amount)`` tuples
+        """
+        for span, amount in amounts:
+            await self.incr(span, amount)
+
+    async def count_many(self, spans):
+        """
+        Gets the counts for several spans.
+
+        :param spans: the spans to read
+        :return: a list of counts in the same order as ``spans``
+        """
+        return [await self.count(span) for span in spans]
+
+    async def cardinality_union(self, spans):
+        """
+        Gets the number of distinct identifiers counted in any of
+        ``spans``, see :meth:`sifr.storage.Storage.cardinality_union`
+        for the fallback that sums the unique counts of the spans.
+        """
+        return sum([await self.cardinality(span) for span in spans])
+
+
+class AsyncMemoryStorage(AsyncStorage):
+    """
+    In process storage for tests and benchmarks. All the operations
+    are delegated to a :class:`sifr.storage.MemoryStorage` which never
+    blocks on I/O.
+
+    :param storage: the :class:`sifr.storage.MemoryStorage` to use
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage or MemoryStorage()
+
+    async def incr(self, span, amount=1):
+        self.storage.incr(span, amount)
+
+    async def incr_multi(self, spans, amount=1):
+        self.storage.incr_multi(spans, amount)
+
+    async def incr_spans(self, amounts):
+        self.storage.incr_spans(amounts)
+
+    async def incr_unique(self, span, identifier):
+        self.storage.incr_unique(span, identifier)
+
+    async def incr_unique_multi(self, spans, identifier):
+        self.storage.incr_unique_multi(spans, identifier)
+
+    async def track(self, span, identifier):
+        self.storage.track(span, identifier)
+
+    async def track_multi(self, spans, identifier):
+        self.storage.track_multi(spans, identifier)
+
+    async def count(self, span):
+        return self.storage.count(span)
+
+    async def count_many(self, spans):
+        return self.storage.count_many(spans)
+
+    async def cardinality(self, span):
+        return self.storage.cardinality(span)
+
+    async def cardinality_union(self, spans):
+        return self.storage.cardinality_union(spans)
+
+    async def uniques(self, span):
+        return self.storage.uniques(span)
+
+
+class PipelineBatch(object):
+    """
+    Collects the commands issued by concurrent coroutines and sends
+    them to redis in a single pipeline once the event loop gets around
+    to it.
+
+    :param redis: a :class:`redis.asyncio.Redis` client
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+        self.task = None
+
+    def execute(self, commands):
+        """
+        Queues commands for the next pipeline.
+
+        :param commands: a list of ``(command, args)`` tuples, the
+         command is either the name of a redis command or a script
+         registered with :meth:`redis.asyncio.Redis.register_script`
+        :return: a future for the list of results of ``commands``
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.commands.append((commands, future))
+        if self.task is None:
+            self.task = loop.create_task(self.__execute())
+        return future
+
+    async def __execute(self):
+        batch, self.commands, self.task = self.commands, [], None
+        try:
+            pipeline = await self.__pipeline(batch)
+            results = await pipeline.execute(raise_on_error=False)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self.__resolve(batch, results)
+
+    async def __pipeline(self, batch):
+        pipeline = self.redis.pipeline(transaction=False)
+        for commands, _ in batch:
+            for command, args in commands:
+                if callable(command):
+                    await command(*args, client=pipeline)
+                else:
+                    getattr(pipeline, command)(*args)
+        return pipeline
+
+    @staticmethod
+    def __resolve(batch, results):
+        """
+        Resolves the future of each call with its slice of the results,
+        or the first error among them.
+        """
+        offset = 0
+        for commands, future in batch:
+            result = results[offset:offset + len(commands)]
+            offset += len(commands)
+            if future.done():
+                continue
+            errors = [r for r in result if isinstance(r, Exception)]
+            if errors:
+                future.set_exception(errors[0])
+            else:
+                future.set_result(result)
+
+
+class AsyncRedisStorage(AsyncStorage):
+    """
+    :param redis: a :class:`redis.asyncio.Redis` client. Commands from
+     concurrent coroutines are sent to redis in shared pipelines.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.batch = PipelineBatch(redis)
+        self.write_script = redis.register_script(WRITE_SCRIPT)
+
+    async def write(self, command, suffix, values):
+        """
+        Writes values to several spans with a single call to
+        :data:`sifr.storage.WRITE_SCRIPT`.
+
+        :param command: ``incrby``, ``pfadd`` or ``sadd``
+        :param suffix: the suffix of the span keys
+        :param values: an iterable of ``(span, value)`` tuples
+        """
+        keys, args = script_arguments(command, suffix, values)
+        if keys:
+            await self.batch.execute([(self.write_script, (keys, args))])
+
+    async def incr(self, span, amount=1):
+        await self.incr_multi([span], amount)
+
+    async def incr_multi(self, spans, amount=1):
+        await self.write("incrby", ":c", ((span, amount) for span in spans))
+
+    async def incr_spans(self, amounts):
+        await self.write("incrby", ":c", amounts)
+
+    async def incr_unique(self, span, identifier):
+        await self.incr_unique_multi([span], identifier)
+
+    async def incr_unique_multi(self, spans, identifier):
+        await self.write(
+            "pfadd", ":u", ((span, identifier) for span in spans)
+        )
+
+    async def track(self, span, identifier):
+        await self.track_multi([span], identifier)
+
+    async def track_multi(self, spans, identifier):
+        await self.write("sadd", ":t", ((span, identifier) for span in spans))
+
+    async def count(self, span):
+        return (await self.count_many([span]))[0]
+
+    async def count_many(self, spans):
+        keys = [span.key + ":c" for span in spans]
+        if not keys:
+            return []
+        values = (await self.batch.execute([("mget", (keys,))]))[0]
+        return [int(value) if value is not None else 0 for value in values]
+
+    async def cardinality(self, span):
+        value = (
+            await self.batch.execute([("pfcount", (span.key + ":u",))])
+        )[0]
+        return int(value) if value is not None else 0
+
+    async def cardinality_union(self, spans):
+        keys = [span.key + ":u" for span in spans]
+        if not keys:
+            return 0
+        value = (await self.batch.execute([("pfcount", keys)]))[0]
+        return int(value) if value is not None else 0
+
+    async def uniques(self, span):
+        value = (
+            await self.batch.execute([("smembers", (span.key + ":t",))])
+        )[0]
+        return value or set()
@@ -0,0 +1,115 @@
+"""
+Count-Min sketches that replace the counters of the spans of all the
+namespaces under a prefix with one fixed size table per span.
+"""
+import math
+from collections import namedtuple
+
+import numpy
+
+from sifr.hll import hash64_one
+
+
+def dimensions(error=0.001, confidence=0.99):
+    """
+    Gets the width and depth of a sketch whose counts exceed the true
+    count by at most ``error`` times the total of the sketch with
+    probability ``confidence``.
+    """
+    width = int(math.ceil(math.e / error))
+    depth = int(math.ceil(math.log(1.0 / (1.0 - confidence))))
+    return width, max(depth, 1)
+
+
+def cells(item, width, depth):
+    """
+    Gets the flat indexes of the cells (one per row) that count ``item``.
+    The rows are indexed by double hashing a single 64 bit hash.
+    """
+    value = hash64_one(item)
+    first, second = value & 0xffffffff, (value >> 32) | 1
+    return [
+        row * width + (first + row * second) % width for row in range(depth)
+    ]
+
+
+class CountMinSketch(object):
+    """
+    Count-Min sketch with ``depth`` rows of ``width`` counters.
+    """
+    __slots__ = ("width", "depth", "table")
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.table = numpy.zeros(width * depth, dtype=numpy.int64)
+
+    def add(self, item, amount=1):
+        """
+        Counts ``amount`` occurrences of ``item``.
+        """
+        self.table[cells(item, self.width, self.depth)] += amount
+
+    def query(self, item):
+        """
+        Gets the (over)estimated count of ``item``.
+        """
+        return int(self.table[cells(item, self.width, self.depth)].min())
+
+    def copy(self):
+        copy = CountMinSketch.__new__(CountMinSketch)
+        copy.width, copy.depth = self.width, self.depth
+        copy.table = self.table.copy()
+        return copy
+
+    def __getstate__(self):
+        return self.width, self.depth, self.table
+
+    def __setstate__(self, state):
+        self.width, self.depth, self.table = state
+
+
+#: The span of the sketch that counts the spans of a prefix, it has the
+#: ``namespace``, ``timestamp``, ``key`` and ``expiry`` of a
+#: :class:`sifr.span.Span` so that storages can key and expire it the same
+#: way.
+SketchSpan = namedtuple(
+    "SketchSpan",
+    ["namespace", "timestamp", "key", "expiry", "width", "depth"]
+)
+
+
+class CountMinPrefixes(object):
+    """
+    Maps spans to the sketch of the longest namespace prefix that they
+    match, a prefix matches whole keys of the namespace only (see
+    :meth:`sifr.span.Span.in_namespace`).
+
+    :param prefixes: a mapping of namespace prefixes to the ``error`` of
+     their sketches or an ``(error, confidence)`` pair, see
+     :func:`dimensions`
+    """
+
+    def __init__(self, prefixes=None):
+        self.prefixes = sorted(
+            (
+                (prefix, dimensions(*params)
+                 if isinstance(params, (list, tuple))
+                 else dimensions(params))
+                for prefix, params in (prefixes or {}).items()
+            ),
+            key=lambda item: len(item[0]), reverse=True
+        )
+
+    def sketch(self, span):
+        """
+        Gets the :class:`SketchSpan` that counts ``span``, ``None`` if its
+        namespace matches no prefix.
+        """
+        for prefix, (width, depth) in self.prefixes:
+            if span.in_namespace(prefix):
+                return SketchSpan(
+                    prefix, span.timestamp, prefix + ":" + span.timestamp,
+                    span.expiry, width, depth
+                )
+        return None
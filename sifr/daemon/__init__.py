@@ -1,3 +1,6 @@
+import atexit
+import sys
+
 import anyconfig
 import click
 import msgpackrpc
@@ -33,33 +36,99 @@ def cli(ctx):
     ctx.obj = SifrD()
 
 
-@cli.command()
-@click.option("--config", type=AnyConfigType(), required=True)
-@click.pass_obj
-def msgpack_server(sifrd, config):
+def storage_from_config(config):
     storage_type = config.get("storage")
     if storage_type == "riak":
         import riak
         riak_nodes = config.get("riak_nodes")
         riak_instance = riak.RiakClient(nodes=riak_nodes)
-        storage = RiakStorage(riak_instance)
+        storage = RiakStorage(
+            riak_instance, partitioned=bool(config.get("riak_partitioned"))
+        )
     elif storage_type == "redis":
         import redis
-        redis_instance = redis.from_url(config.get("redis_url"))
-        storage = RedisStorage(redis_instance)
+        if config.get("redis_cluster"):
+            from redis.cluster import RedisCluster
+            redis_instance = RedisCluster.from_url(config.get("redis_url"))
+        else:
+            redis_instance = redis.from_url(config.get("redis_url"))
+        storage = RedisStorage(
+            redis_instance, cluster=bool(config.get("redis_cluster")),
+            batch_window=config.get("redis_batch_window"),
+            batch_size=config.get("redis_batch_size", 1000),
+            count_min_prefixes=config.get("count_min_prefixes"),
+            track_limit=config.get("track_limit"),
+            track_policy=config.get("track_policy", "first")
+        )
     else:
-        storage = MemoryStorage()
+        storage = MemoryStorage(
+            exact_threshold=config.get("exact_threshold", 256),
+            error_rate=config.get("error_rate", 0.005),
+            resolution_error_rates=config.get("resolution_error_rates"),
+            prefix_error_rates=config.get("prefix_error_rates"),
+            count_min_prefixes=config.get("count_min_prefixes"),
+            track_limit=config.get("track_limit"),
+            track_policy=config.get("track_policy", "first")
+        )
+        if config.get("persistence_dir"):
+            from sifr.persistence import Persistence
+            persistence = Persistence(
+                storage, config["persistence_dir"],
+                snapshot_interval=config.get("snapshot_interval", 300),
+                flush_interval=config.get("flush_interval", 1.0),
+                fsync=bool(config.get("fsync"))
+            ).open()
+            atexit.register(persistence.close)
+    return storage
+
+
+@cli.command()
+@click.option("--config", type=AnyConfigType(), required=True)
+@click.option(
+    "--asyncio", "use_asyncio", is_flag=True,
+    help="Serve requests with asyncio and batch concurrent writes"
+)
+@click.option(
+    "--workers", type=click.IntRange(1), default=1,
+    help="Number of asyncio worker processes sharing the listening socket"
+)
+@click.pass_obj
+def msgpack_server(sifrd, config, use_asyncio, workers):
+    host, port = config.get("host", "127.0.0.1"), int(config.get("port", 6000))
+    if workers > 1:
+        if config.get("persistence_dir"):
+            raise click.UsageError(
+                "persistence_dir can't be used with more than one worker"
+            )
+        from sifr.daemon.workers import serve_workers
+        sys.exit(serve_workers(
+            lambda: storage_from_config(config), host, port, workers
+        ))
+    storage = storage_from_config(config)
+    if use_asyncio:
+        from sifr.daemon.aio import serve
+        return serve(storage, host, port)
     server = msgpackrpc.Server(
         SifrServer(storage),
         unpack_encoding='utf-8'
     )
-    server.listen(
-        msgpackrpc.Address(
-            config.get("host", "127.0.0.1"), int(config.get("port", 6000))
-        )
-    )
+    server.listen(msgpackrpc.Address(host, port))
     server.start()
 
 
+@cli.command()
+@click.option("--config", type=AnyConfigType(), required=True)
+@click.pass_obj
+def riak_sweep(sifrd, config):
+    """
+    Deletes the partitioned riak maps whose spans have all expired.
+    """
+    storage = storage_from_config(config)
+    if not isinstance(storage, RiakStorage):
+        raise click.UsageError("riak_sweep requires the riak storage")
+    click.echo("Deleted %d maps" % storage.sweep())
+    storage.close()
+
+
 def run():
     return cli(auto_envvar_prefix='SIFR')
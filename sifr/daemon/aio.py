@@ -0,0 +1,198 @@
+"""
+asyncio implementation of the msgpack-rpc sifrd server.
+Requires python 3.5+.
+"""
+import asyncio
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+
+from sifr.daemon.msgpack import SifrServer, span_from_resolution
+
+REQUEST, RESPONSE, NOTIFY = 0, 1, 2
+
+
+def _spans(now, key, resolutions):
+    """
+    Gets the spans of a call, raising :class:`ValueError` for an unknown
+    resolution.
+    """
+    spans = []
+    for resolution in resolutions:
+        span_class = span_from_resolution(resolution)
+        if span_class is None:
+            raise ValueError("Unknown resolution: %s" % (resolution,))
+        spans.append(span_class(now, [key]))
+    return spans
+
+
+class AsyncSifrServer(object):
+    """
+    msgpack-rpc server that accepts any number of in flight requests per
+    connection. The ``incr`` and ``incr_unique`` calls received during
+    an iteration of the event loop are written to the storage as a single
+    batch. Their parameters are checked before they join the batch so that
+    an invalid call only fails itself. All storage calls run on a thread
+    pool so that a slow backend doesn't block the event loop.
+
+    :param storage: the :class:`sifr.storage.Storage` to use
+    :param max_workers: size of the thread pool for storage calls
+    """
+    batched = ("incr", "incr_unique")
+
+    def __init__(self, storage, max_workers=8):
+        self.storage = storage
+        self.server = SifrServer(storage)
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.pending = dict((method, []) for method in self.batched)
+        self.flush_scheduled = False
+
+    async def start(self, host, port, **kwargs):
+        """
+        Starts listening for connections.
+
+        :return: the :class:`asyncio.Server`
+        """
+        return await asyncio.start_server(self.handle, host, port, **kwargs)
+
+    async def handle(self, reader, writer, dispatch=None):
+        dispatch = dispatch or self.dispatch
+        unpacker = msgpack.Unpacker(raw=False)
+        while True:
+            data = await reader.read(64 * 1024)
+            if not data:
+                break
+            unpacker.feed(data)
+            for message in unpacker:
+                asyncio.ensure_future(
+                    self.respond(message, writer, dispatch)
+                )
+        writer.close()
+
+    async def respond(self, message, writer, dispatch):
+        if message[0] == REQUEST:
+            _, msgid, method, params = message
+        else:
+            msgid = None
+            _, method, params = message
+        try:
+            error, result = None, await dispatch(method, params)
+        except Exception as e:
+            error, result = "%s: %s" % (e.__class__.__name__, e), None
+        if msgid is not None and not writer.transport.is_closing():
+            writer.write(msgpack.packb([RESPONSE, msgid, error, result]))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    def dispatch(self, method, params):
+        """
+        Dispatches an rpc call received from a client.
+
+        :return: a future for the result of the call
+        """
+        return self.call(method, params)
+
+    def call(self, method, params):
+        """
+        Executes a single rpc call against the local storage.
+
+        :return: a future for the result of the call
+        """
+        loop = asyncio.get_running_loop()
+        if method in self.batched:
+            key, resolutions, value = params
+            spans = _spans(datetime.datetime.now(), key, resolutions)
+            if method == "incr" and (
+                not isinstance(value, int) or isinstance(value, bool)
+            ):
+                raise TypeError("amount must be an integer")
+            if method == "incr_unique":
+                try:
+                    hash(value)
+                except TypeError:
+                    raise TypeError("identifier must be hashable")
+            future = loop.create_future()
+            self.pending[method].append(((spans, value), future))
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                loop.call_soon(self.flush)
+            return future
+        if method.startswith("_") or not hasattr(self.server, method):
+            raise NameError("No such method: %s" % method)
+        return loop.run_in_executor(
+            self.executor, lambda: getattr(self.server, method)(*params)
+        )
+
+    def flush(self):
+        """
+        Writes the batched calls that are pending to the storage.
+        """
+        self.flush_scheduled = False
+        pending = self.pending
+        self.pending = dict((method, []) for method in self.batched)
+        loop = asyncio.get_running_loop()
+        for method, calls in pending.items():
+            if not calls:
+                continue
+            write = loop.run_in_executor(
+                self.executor, getattr(self, "_write_" + method),
+                [params for params, _ in calls]
+            )
+            write.add_done_callback(
+                lambda done, calls=calls: self.__resolve(done, calls)
+            )
+
+    @staticmethod
+    def __resolve(done, calls):
+        """
+        Resolves the futures of the calls of a batch with the error of the
+        whole write, or the error of each call returned by the write.
+        """
+        if done.exception() is not None:
+            errors = [done.exception()] * len(calls)
+        else:
+            errors = done.result()
+        for (_, future), error in zip(calls, errors):
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+    def _write_incr(self, calls):
+        amounts = {}
+        for spans, amount in calls:
+            for span in spans:
+                amounts.setdefault(span.key, [span, 0])[1] += amount
+        self.storage.incr_spans(amounts.values())
+        return [None] * len(calls)
+
+    def _write_incr_unique(self, calls):
+        spans = {}
+        for call_spans, identifier in calls:
+            for span in call_spans:
+                spans.setdefault(identifier, {})[span.key] = span
+        errors = {}
+        for identifier, identifier_spans in spans.items():
+            try:
+                self.storage.incr_unique_multi(
+                    list(identifier_spans.values()), identifier
+                )
+            except Exception as error:
+                errors[identifier] = error
+        return [errors.get(identifier) for _, identifier in calls]
+
+
+def serve(storage, host, port):
+    """
+    Runs an :class:`AsyncSifrServer` until the process is interrupted.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = AsyncSifrServer(storage)
+    loop.run_until_complete(server.start(host, port))
+    loop.run_forever()
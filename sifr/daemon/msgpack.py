@@ -51,3 +51,8 @@ class SifrServer(object):
                 span_from_resolution(resolution)(normalize_time(at), [key])
             )
         )
+
+    def tracked_cardinality(self, key, at, resolution):
+        return self.storage.tracked_cardinality(
+            span_from_resolution(resolution)(normalize_time(at), [key])
+        )
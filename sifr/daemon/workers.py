@@ -0,0 +1,254 @@
+"""
+Multi process sifrd. Each worker runs an :class:`AsyncSifrServer` on a
+listening socket that is shared through ``SO_REUSEPORT``. Requires a
+platform with ``fork`` and ``SO_REUSEPORT`` (linux 3.9+, BSDs, macOS).
+"""
+import asyncio
+import itertools
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import zlib
+
+import msgpack
+
+from sifr.daemon.aio import AsyncSifrServer, REQUEST
+from sifr.storage import MemoryStorage
+
+
+def owner(key, workers):
+    """
+    Gets the index of the worker that owns ``key``. Unlike :func:`hash`
+    the result is the same in every process.
+
+    :param key: the key of an rpc call
+    :param workers: the number of workers
+    """
+    if not isinstance(key, bytes):
+        key = str(key).encode("utf-8")
+    return (zlib.crc32(key) & 0xffffffff) % workers
+
+
+class PeerConnection(object):
+    """
+    Pipelined msgpack-rpc connection to another worker.
+
+    :param path: the unix socket that the worker listens on
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.msgids = itertools.count()
+        self.pending = {}
+        self.writer = None
+        self.connecting = None
+
+    async def connect(self, retries=50, delay=0.1):
+        for attempt in range(retries):
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(
+                    self.path
+                )
+                break
+            except (OSError, IOError):
+                if attempt == retries - 1:
+                    raise
+                await asyncio.sleep(delay)
+        asyncio.ensure_future(self.read(reader))
+
+    async def read(self, reader):
+        unpacker = msgpack.Unpacker(raw=False)
+        while True:
+            data = await reader.read(64 * 1024)
+            if not data:
+                break
+            unpacker.feed(data)
+            for _, msgid, error, result in unpacker:
+                future = self.pending.pop(msgid)
+                if error is not None:
+                    future.set_exception(RuntimeError(error))
+                else:
+                    future.set_result(result)
+        self.writer = None
+        self.connecting = None
+        for future in self.pending.values():
+            future.set_exception(ConnectionError("peer went away"))
+        self.pending = {}
+
+    async def call(self, method, params):
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self.connect())
+        connecting = self.connecting
+        try:
+            await connecting
+        except Exception:
+            # the next call starts a new connection attempt
+            if self.connecting is connecting:
+                self.connecting = None
+            raise
+        msgid = next(self.msgids)
+        future = self.pending[msgid] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self.writer.write(msgpack.packb([REQUEST, msgid, method, params]))
+        return await future
+
+
+class PartitionedSifrServer(AsyncSifrServer):
+    """
+    :class:`AsyncSifrServer` that owns the part of the keyspace that
+    hashes to ``index``. Calls for keys owned by other workers are
+    forwarded to them over their peer sockets.
+
+    :param storage: the :class:`sifr.storage.Storage` to use
+    :param index: the index of this worker
+    :param peers: the unix socket paths that the workers listen on for
+     forwarded calls
+    """
+
+    def __init__(self, storage, index, peers, **kwargs):
+        super(PartitionedSifrServer, self).__init__(storage, **kwargs)
+        self.index = index
+        self.peers = dict(
+            (i, PeerConnection(path)) for i, path in enumerate(peers)
+            if i != index
+        )
+        self.workers = len(peers)
+
+    async def start_peer(self, path):
+        """
+        Starts listening for forwarded calls on the unix socket ``path``.
+        """
+        return await asyncio.start_unix_server(
+            lambda reader, writer: self.handle(reader, writer, self.call),
+            path
+        )
+
+    def dispatch(self, method, params):
+        worker = owner(params[0], self.workers) if params else self.index
+        if worker == self.index:
+            return self.call(method, params)
+        return asyncio.ensure_future(
+            self.peers[worker].call(method, params)
+        )
+
+
+def _listen(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    return sock
+
+
+def _run_worker(index, storage_factory, host, port, peers):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    storage = storage_factory()
+    if peers and isinstance(storage, MemoryStorage):
+        server = PartitionedSifrServer(storage, index, peers)
+        loop.run_until_complete(server.start_peer(peers[index]))
+    else:
+        server = AsyncSifrServer(storage)
+    loop.run_until_complete(server.start(None, None, sock=_listen(host, port)))
+    loop.run_forever()
+
+
+def serve_workers(storage_factory, host, port, workers):
+    """
+    Forks ``workers`` processes that serve sifrd on ``host:port``. When
+    the storage is a :class:`sifr.storage.MemoryStorage` each worker owns
+    the keys that hash to it and forwards the calls for other keys to the
+    worker that owns them.
+
+    :param storage_factory: callable that creates the storage of a worker
+     (after it has been forked)
+    :return: the exit status for sifrd, ``1`` if a worker failed
+    """
+    directory = tempfile.mkdtemp(prefix="sifrd-")
+    peers = [
+        os.path.join(directory, "worker-%d.sock" % i) for i in range(workers)
+    ]
+    try:
+        return _reap(_spawn(storage_factory, host, port, peers))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _spawn(storage_factory, host, port, peers):
+    """
+    Forks a worker for each of ``peers``.
+
+    :return: the pids of the workers
+    """
+    children = []
+    for index in range(len(peers)):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            status = 1
+            try:
+                _run_worker(index, storage_factory, host, port, peers)
+                status = 0
+            except Exception:
+                logging.exception("sifrd worker %d failed", index)
+            finally:
+                os._exit(status)
+        children.append(pid)
+    return children
+
+
+def _reap(children):
+    """
+    Waits for the workers to exit, forwarding SIGTERM and SIGINT to them.
+    A worker that exits by itself stops all the others, as the keys that
+    it owns can't be reached anymore.
+
+    :return: ``1`` if a worker exited with an error, otherwise ``0``
+    """
+    children = set(children)
+    stopping = []
+
+    def stop(signum=None, frame=None):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    status = 0
+    while children:
+        pid, code = _wait()
+        if pid is None:
+            break
+        children.discard(pid)
+        if not stopping:
+            if code:
+                logging.error(
+                    "sifrd worker %d exited with wait status %d, stopping",
+                    pid, code
+                )
+                status = 1
+            stop()
+    return status
+
+
+def _wait():
+    """
+    Waits for any child to exit.
+
+    :return: its pid and wait status, ``(None, 0)`` when there are none
+    """
+    while True:
+        try:
+            return os.wait()
+        except InterruptedError:
+            continue
+        except ChildProcessError:
+            return None, 0
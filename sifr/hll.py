@@ -1,12 +1,251 @@
-from hyperloglog import HyperLogLog
+import binascii
+import math
+
+import numpy
+import six
+
+_FNV_OFFSET = numpy.uint64(0xcbf29ce484222325)
+_FNV_PRIME = numpy.uint64(0x100000001b3)
+_MIX_1 = numpy.uint64(0xff51afd7ed558ccd)
+_MIX_2 = numpy.uint64(0xc4ceb9fe1a85ec53)
+_MASK = 0xffffffffffffffff
+
+
+def _encode(identifier):
+    if isinstance(identifier, six.binary_type):
+        return identifier
+    if not isinstance(identifier, six.text_type):
+        identifier = six.text_type(identifier)
+    return identifier.encode("utf-8")
+
+
+def hash64(identifiers):
+    """
+    Hashes a batch of identifiers to 64 bit integers. The identifiers are
+    packed into a matrix of 64 bit words and hashed one column at a time,
+    so the cost in python is per column rather than per identifier.
+
+    :param identifiers: a list of objects that can be represented as
+     strings
+    :return: a :class:`numpy.ndarray` of ``uint64`` hashes
+    """
+    encoded = [_encode(identifier) for identifier in identifiers]
+    hashes = numpy.full(len(encoded), _FNV_OFFSET, dtype=numpy.uint64)
+    if not encoded:
+        return hashes
+    lengths = numpy.array([len(e) for e in encoded], dtype=numpy.uint64)
+    hashes ^= lengths
+    width = max(8, -(-int(lengths.max()) // 8) * 8)
+    words = numpy.array(encoded, dtype="S%d" % width).view("<u8").reshape(
+        len(encoded), width // 8
+    )
+    for column in range(words.shape[1]):
+        mixed = (hashes ^ words[:, column]) * _FNV_PRIME
+        hashes = numpy.where(lengths > column * 8, mixed, hashes)
+    hashes ^= hashes >> numpy.uint64(33)
+    hashes *= _MIX_1
+    hashes ^= hashes >> numpy.uint64(33)
+    hashes *= _MIX_2
+    hashes ^= hashes >> numpy.uint64(33)
+    return hashes
+
+
+def hash64_one(identifier):
+    """
+    Hashes a single identifier with plain integer arithmetic. The result
+    is the same as that of :func:`hash64` without the cost of building
+    arrays for one value.
+    """
+    data = _encode(identifier)
+    value = 0xcbf29ce484222325 ^ len(data)
+    for offset in range(0, len(data), 8):
+        word = int(binascii.hexlify(data[offset:offset + 8][::-1]) or b"0", 16)
+        value = ((value ^ word) * 0x100000001b3) & _MASK
+    value ^= value >> 33
+    value = (value * 0xff51afd7ed558ccd) & _MASK
+    value ^= value >> 33
+    value = (value * 0xc4ceb9fe1a85ec53) & _MASK
+    return value ^ (value >> 33)
+
+
+def _bit_length(values):
+    lengths = numpy.zeros(values.shape, dtype=numpy.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        shift = numpy.uint64(shift)
+        high = values >> shift
+        found = high > 0
+        lengths[found] += numpy.uint8(shift)
+        values = numpy.where(found, high, values)
+    return lengths + (values > 0)
+
+
+class HyperLogLog(object):
+    """
+    Dense hyperloglog sketch with one ``uint8`` register per bucket
+    stored in a numpy array.
+
+    :param error_rate: the relative error of the estimates
+    :param precision: number of index bits (overrides ``error_rate``)
+    """
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, error_rate=0.005, precision=None):
+        if precision is None:
+            precision = int(math.ceil(math.log((1.04 / error_rate) ** 2, 2)))
+        self.precision = min(max(precision, 4), 18)
+        self.registers = numpy.zeros(1 << self.precision, dtype=numpy.uint8)
+
+    def add(self, identifier):
+        """
+        Adds a single identifier to the sketch.
+        """
+        self.add_hash(hash64_one(identifier))
+
+    def add_hash(self, value):
+        """
+        Adds a single identifier that was already hashed with
+        :func:`hash64_one`.
+        """
+        index = value >> (64 - self.precision)
+        remaining = (value << self.precision) & _MASK
+        rank = 64 - remaining.bit_length() + 1 if remaining else (
+            64 - self.precision + 1
+        )
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, identifiers):
+        """
+        Adds a batch of identifiers to the sketch.
+
+        :param identifiers: a list of objects that can be represented as
+         strings
+        """
+        self.update_hashes(hash64(identifiers))
+
+    def update_hashes(self, hashes):
+        """
+        Adds a batch of identifiers that were already hashed.
+
+        :param hashes: a :class:`numpy.ndarray` of ``uint64`` hashes
+        """
+        index = (hashes >> numpy.uint64(64 - self.precision)).astype(
+            numpy.intp
+        )
+        remaining = (hashes << numpy.uint64(self.precision)) | numpy.uint64(
+            1 << (self.precision - 1)
+        )
+        ranks = (65 - _bit_length(remaining)).astype(numpy.uint8)
+        numpy.maximum.at(self.registers, index, ranks)
+
+    def merge(self, other):
+        """
+        Merges another sketch into this one. A sketch with a higher
+        precision is folded down to the precision of this one first.
+        """
+        if other.precision != self.precision:
+            other = other.fold(self.precision)
+        numpy.maximum(self.registers, other.registers, out=self.registers)
+
+    def copy(self):
+        """
+        Gets a copy of the sketch.
+        """
+        copy = HyperLogLog(precision=self.precision)
+        copy.registers[:] = self.registers
+        return copy
+
+    def fold(self, precision):
+        """
+        Gets a copy of this sketch with a lower precision, as if the
+        identifiers had been added to a sketch with that precision.
+
+        :param precision: the new number of index bits
+        """
+        if precision > self.precision:
+            raise ValueError(
+                "Cannot fold a sketch with precision %d to %d"
+                % (self.precision, precision)
+            )
+        folded = HyperLogLog(precision=precision)
+        bits = self.precision - precision
+        registers = self.registers.reshape(len(folded.registers), 1 << bits)
+        # the leading bits of the hash that no longer index a register
+        # become the leading bits of the part that is ranked
+        ranks = numpy.empty(registers.shape, dtype=numpy.uint8)
+        ranks[:, 0] = registers[:, 0] + bits
+        ranks[:, 1:] = bits + 1 - _bit_length(
+            numpy.arange(1, 1 << bits, dtype=numpy.uint64)
+        )
+        ranks[registers == 0] = 0
+        folded.registers[:] = ranks.max(axis=1)
+        return folded
+
+    def card(self):
+        """
+        Estimates the number of distinct identifiers that were added.
+        """
+        buckets = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / buckets)
+        estimate = alpha * buckets * buckets / numpy.sum(
+            numpy.ldexp(1.0, -self.registers.astype(numpy.int32))
+        )
+        zeros = buckets - numpy.count_nonzero(self.registers)
+        if zeros and estimate <= 2.5 * buckets:
+            return buckets * math.log(float(buckets) / zeros)
+        return float(estimate)
+
+
+def merge_counters(counters):
+    """
+    Merges unique counters as kept by :class:`HLLCounter` without
+    modifying them. The result is an exact set of hashes if all of the
+    counters are exact, otherwise a sketch with the lowest precision of
+    the sketches that were merged.
+
+    :param counters: a list of sets of hashes and :class:`HyperLogLog`
+     sketches
+    """
+    sketches = [c for c in counters if isinstance(c, HyperLogLog)]
+    if not sketches:
+        return set().union(*counters)
+    merged = HyperLogLog(
+        precision=min(sketch.precision for sketch in sketches)
+    )
+    for counter in counters:
+        if isinstance(counter, HyperLogLog):
+            merged.merge(counter)
+        elif counter:
+            merged.update_hashes(
+                numpy.fromiter(counter, numpy.uint64, len(counter))
+            )
+    return merged
+
+
+def estimate(counter):
+    """
+    Gets the number of unique occurrences in a counter returned by
+    :func:`merge_counters`.
+    """
+    if isinstance(counter, HyperLogLog):
+        return int(round(counter.card()))
+    return len(counter)
 
 
 class HLLCounter(object):
-    def __init__(self):
+    def __init__(self, error_rate=0.005, threshold=256):
         """
         Simple counter that uses hyperloglog
-        to count unique occurrences per key
+        to count unique occurrences per key. Each key starts out as an
+        exact set of identifier hashes and is promoted to a sketch once
+        it holds more than ``threshold`` of them.
+
+        :param error_rate: the relative error of the sketches
+        :param threshold: the largest exact set to keep per key,
+         ``0`` to always use sketches
         """
+        self.error_rate = error_rate
+        self.threshold = threshold
         self.counter = {}
 
     def pop(self, key):
@@ -16,21 +255,103 @@ class HLLCounter(object):
         """
         self.counter.pop(key, None)
 
-    def add(self, key, identifier):
+    def sketch(self, key, error_rate=None):
+        """
+        Gets the sketch of a key, promoting it if it is still exact
+        :param key:
+        :param error_rate: the relative error of the sketch if it has to
+         be created, defaults to the error rate of the counter
+        """
+        counter = self.counter.get(key)
+        if not isinstance(counter, HyperLogLog):
+            sketch = HyperLogLog(error_rate or self.error_rate)
+            if counter:
+                sketch.update_hashes(
+                    numpy.fromiter(counter, numpy.uint64, len(counter))
+                )
+            counter = self.counter[key] = sketch
+        return counter
+
+    def add(self, key, identifier, error_rate=None):
         """
         Adds a key to the counter
         :param key:
         :param identifier: any object that can be represented
          as a string
+        :param error_rate: the relative error of the sketch if the key
+         is promoted, see :meth:`sketch`
+        """
+        self.add_hash(key, hash64_one(identifier), error_rate)
+
+    def add_hash(self, key, value, error_rate=None):
+        """
+        Adds an identifier that was already hashed with
+        :func:`hash64_one` to a key
+        :param key:
+        :param value: the hash of the identifier
+        :param error_rate: the relative error of the sketch if the key
+         is promoted, see :meth:`sketch`
+        """
+        counter = self.counter.get(key)
+        if isinstance(counter, HyperLogLog):
+            counter.add_hash(value)
+        elif counter is None and not self.threshold:
+            self.sketch(key, error_rate).add_hash(value)
+        else:
+            counter = self.counter.setdefault(key, set())
+            counter.add(value)
+            if len(counter) > self.threshold:
+                self.sketch(key, error_rate)
+
+    def add_many(self, key, identifiers, error_rate=None):
+        """
+        Adds several identifiers for a key in one vectorized update
+        :param key:
+        :param identifiers: an iterable of objects that can be
+         represented as strings
+        :param error_rate: the relative error of the sketch if the key
+         is promoted, see :meth:`sketch`
+        """
+        identifiers = list(identifiers)
+        if not identifiers:
+            return
+        hashes = hash64(identifiers)
+        counter = self.counter.get(key)
+        if not isinstance(counter, HyperLogLog):
+            new = set(hashes.tolist()).difference(counter or ())
+            if len(counter or ()) + len(new) <= self.threshold:
+                self.counter.setdefault(key, set()).update(new)
+                return
+        self.sketch(key, error_rate).update_hashes(hashes)
+
+    def copy(self):
+        """
+        Gets a copy of the counters of all the keys
+        """
+        return dict(
+            (key, counter.copy()) for key, counter in self.counter.items()
+        )
+
+    def union(self, keys):
+        """
+        Gets the merged counter of several keys, see
+        :func:`merge_counters`
+        :param keys:
+        """
+        return merge_counters(
+            [self.counter[key] for key in keys if key in self.counter]
+        )
+
+    def is_exact(self, key):
+        """
+        Checks whether the count of a key is exact
+        :param key:
         """
-        self.counter.setdefault(key, HyperLogLog(0.005))
-        self.counter[key].add(str(identifier))
+        return not isinstance(self.counter.get(key), HyperLogLog)
 
     def get(self, key):
         """
         Gets the unique occurrences in the set
         :param key:
         """
-        if key not in self.counter:
-            return 0
-        return int(self.counter[key].card())
+        return estimate(self.counter.get(key, ()))
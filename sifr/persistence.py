@@ -0,0 +1,224 @@
+"""
+Persistence for :class:`sifr.storage.MemoryStorage`.
+
+The state of the storage is kept in a directory as a snapshot plus append
+only logs of the writes made after it::
+
+    snapshot          zlib compressed pickle of MemoryStorage.dump()
+    log.<generation>  length prefixed pickled journal records
+
+Taking a snapshot starts a new log generation while the storage lock is
+held (together with copying the state). The copy is then serialized,
+written to a temporary file and renamed over the previous snapshot without
+the lock, after which the logs it covers are removed. A crash at any point
+leaves a snapshot and the logs needed to bring it up to date.
+
+The log has its own lock so that flushing it to disk never holds the storage
+lock, only writing a record to it does.
+"""
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from six.moves import cPickle as pickle
+
+_LENGTH = struct.Struct("<I")
+
+
+def read_log(path):
+    """
+    Reads the records of a log. A record that was only partially written
+    (by a crash) ends the log.
+
+    :param path: the path of the log
+    """
+    with open(path, "rb") as log:
+        data = log.read()
+    offset = 0
+    while offset + _LENGTH.size <= len(data):
+        length, = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        if offset + length > len(data):
+            break
+        yield pickle.loads(data[offset:offset + length])
+        offset += length
+
+
+def _fsync_directory(path):
+    """
+    Makes the entries of a directory (e.g. a file renamed into it) durable.
+
+    :param path: the path of the directory
+    """
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class Persistence(object):
+    """
+    Persists a :class:`sifr.storage.MemoryStorage` to ``directory``.
+
+    :param storage: the :class:`sifr.storage.MemoryStorage` to persist
+    :param directory: the directory for the snapshot and logs
+    :param snapshot_interval: seconds between snapshots
+    :param flush_interval: seconds between flushes of the log to the
+     operating system, at most this much of the writes is lost when the
+     process crashes. ``0`` flushes every write, under the storage lock.
+    :param fsync: whether to also fsync the log when it is flushed, which
+     protects against losing writes when the machine crashes
+    """
+
+    def __init__(self, storage, directory, snapshot_interval=300,
+                 flush_interval=1.0, fsync=False):
+        self.storage = storage
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.generation = 0
+        self.log = None
+        self.log_lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def snapshot_path(self):
+        return os.path.join(self.directory, "snapshot")
+
+    def log_path(self, generation):
+        return os.path.join(self.directory, "log.%d" % generation)
+
+    def generations(self):
+        """
+        Gets the generations of the logs in the directory, oldest first.
+        """
+        generations = []
+        for name in os.listdir(self.directory):
+            prefix, _, generation = name.partition(".")
+            if prefix == "log" and generation.isdigit():
+                generations.append(int(generation))
+        return sorted(generations)
+
+    def open(self):
+        """
+        Restores the storage from the directory and starts logging its
+        writes and taking periodic snapshots.
+
+        :return: the :class:`Persistence`
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        first = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as snapshot:
+                first, state = pickle.loads(zlib.decompress(snapshot.read()))
+            self.storage.load(state)
+        generations = [g for g in self.generations() if g >= first]
+        for generation in generations:
+            self.storage.replay(read_log(self.log_path(generation)))
+        with self.storage.lock:
+            self.__rotate(max(generations + [first]) + 1)
+            self.storage.journal = self.write
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __rotate(self, generation):
+        log = open(self.log_path(generation), "ab")
+        with self.log_lock:
+            if self.log is not None:
+                self.log.close()
+            self.generation = generation
+            self.log = log
+
+    def write(self, record):
+        """
+        Appends a record to the log, called with the storage lock held.
+        """
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.log_lock:
+            self.log.write(_LENGTH.pack(len(data)) + data)
+        if not self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Flushes the log to the operating system (and disk with ``fsync``).
+        The fsync is made on a duplicate of the log's descriptor without
+        holding any lock, so writes carry on meanwhile.
+        """
+        with self.log_lock:
+            if self.log is None:
+                return
+            self.log.flush()
+            if not self.fsync:
+                return
+            descriptor = os.dup(self.log.fileno())
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def snapshot(self):
+        """
+        Writes a snapshot of the storage and removes the logs that it
+        covers. The storage lock is only held to copy its state.
+        """
+        with self.snapshot_lock:
+            with self.storage.lock:
+                state = self.storage.dump()
+                with self.log_lock:
+                    self.log.flush()
+                self.__rotate(self.generation + 1)
+                generation = self.generation
+            data = zlib.compress(
+                pickle.dumps((generation, state), pickle.HIGHEST_PROTOCOL)
+            )
+            temporary = self.snapshot_path + ".tmp"
+            with open(temporary, "wb") as snapshot:
+                snapshot.write(data)
+                snapshot.flush()
+                os.fsync(snapshot.fileno())
+            os.rename(temporary, self.snapshot_path)
+            _fsync_directory(self.directory)
+            for old in self.generations():
+                if old < generation:
+                    os.remove(self.log_path(old))
+
+    def __run(self):
+        elapsed = 0.0
+        interval = min(self.flush_interval or 1.0, self.snapshot_interval)
+        while not self.stopped.wait(interval):
+            try:
+                self.flush()
+                elapsed += interval
+                if elapsed >= self.snapshot_interval:
+                    elapsed = 0.0
+                    self.snapshot()
+            except Exception:
+                logging.exception("Failed to persist the memory storage")
+
+    def close(self):
+        """
+        Stops logging, takes a final snapshot and closes the log. Does
+        nothing if the persistence isn't open.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.log is None:
+            return
+        self.snapshot()
+        with self.storage.lock:
+            self.storage.journal = None
+            with self.log_lock:
+                self.log.close()
+                self.log = None
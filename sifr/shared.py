@@ -0,0 +1,278 @@
+"""
+Counter storage that is shared by all the processes on a host through a
+memory mapped file. Requires a platform with ``fcntl`` (unix).
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from sifr.storage import Storage
+
+_HEADER = struct.Struct("<8sQQ")
+_MAGIC = b"SIFRSHM1"
+#: key hash (0 for an empty slot), value, expiry (0 for never)
+_SLOT = struct.Struct("<Qqq")
+_HASH = struct.Struct("<Q")
+
+
+def _encode(key):
+    return key if isinstance(key, bytes) else key.encode("utf-8")
+
+
+class _Table(object):
+    """
+    The file, memory map and stripe locks of a table, opened once per path
+    in a process: ``fcntl`` locks belong to the process, so instances that
+    opened the file separately wouldn't exclude each other and closing
+    either descriptor would drop the locks of both.
+    """
+
+    def __init__(self, path, capacity, stripes):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, _HEADER.size, 0)
+        try:
+            header = os.read(self.fd, _HEADER.size)
+            if len(header) < _HEADER.size:
+                stripe_size = -(-capacity // stripes)
+                os.ftruncate(
+                    self.fd, _HEADER.size + stripe_size * stripes * _SLOT.size
+                )
+                header = _HEADER.pack(_MAGIC, stripe_size * stripes, stripes)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, header)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, _HEADER.size, 0)
+        magic, self.capacity, self.stripes = _HEADER.unpack(header)
+        if magic != _MAGIC:
+            os.close(self.fd)
+            raise ValueError("%s is not a sifr shared table" % path)
+        self.map = mmap.mmap(
+            self.fd, _HEADER.size + self.capacity * _SLOT.size
+        )
+        self.locks = [threading.Lock() for _ in range(self.stripes)]
+        self.references = 0
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _open_table(path, capacity, stripes):
+    key = (os.getpid(), os.path.realpath(path))
+    with _tables_lock:
+        if key not in _tables:
+            _tables[key] = _Table(path, capacity, stripes)
+        table = _tables[key]
+        table.references += 1
+        return key, table
+
+
+def _close_table(key):
+    with _tables_lock:
+        table = _tables[key]
+        table.references -= 1
+        if not table.references:
+            del _tables[key]
+            table.close()
+
+
+class SharedTableFull(Exception):
+    """
+    Raised when a stripe of a :class:`SharedMemoryStorage` has no free
+    slot for a new span.
+    """
+
+
+class SharedMemoryStorage(Storage):
+    """
+    Storage for counters in a fixed size open addressing hash table in a
+    memory mapped file, so that every process that opens the same file
+    (e.g. the workers of a web server) counts into the same table.
+
+    The table is split in ``stripes`` that each have their own lock, a
+    thread lock within a process and an ``fcntl`` lock on a byte of the
+    file across processes. All the spans of a namespace are kept in the
+    same stripe so that writing an event at every resolution takes a
+    single lock. The slot of a span is found by linear probing within its
+    stripe. When a probe meets an expired slot, the expired slots of the
+    rest of its run are cleared and the live ones moved back towards their
+    home slot, so that probes keep stopping at the first empty slot.
+    Instances for the same path in a process share the file and its locks.
+
+    Only counters are supported, unique counts and tracking raise
+    :class:`NotImplementedError`.
+
+    :param path: the file that backs the table, created if it doesn't
+     exist. The size of an existing table is read from the file.
+    :param capacity: the number of slots in the table
+    :param stripes: the number of independently locked stripes
+    """
+
+    def __init__(self, path, capacity=1 << 20, stripes=64):
+        self.path = path
+        self.table_key, table = _open_table(path, capacity, stripes)
+        self.fd, self.map, self.locks = table.fd, table.map, table.locks
+        self.capacity, self.stripes = table.capacity, table.stripes
+        self.stripe_size = self.capacity // self.stripes
+        super(SharedMemoryStorage, self).__init__()
+
+    def close(self):
+        """
+        Releases the table, which is unmapped and its file closed once no
+        instance in the process uses it.
+        """
+        if self.table_key is not None:
+            _close_table(self.table_key)
+            self.table_key = None
+
+    def __locate(self, span):
+        key_hash = _HASH.unpack_from(
+            hashlib.md5(_encode(span.key)).digest()
+        )[0] or 1
+        stripe = (zlib.crc32(_encode(span.namespace)) & 0xffffffff) % (
+            self.stripes
+        )
+        return key_hash, stripe, key_hash % self.stripe_size
+
+    def __by_stripe(self, items):
+        stripes = {}
+        for span, value in items:
+            key_hash, stripe, start = self.__locate(span)
+            stripes.setdefault(stripe, []).append(
+                (key_hash, start, span, value)
+            )
+        return stripes
+
+    def __lock(self, stripe):
+        self.locks[stripe].acquire()
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, _HEADER.size + stripe)
+
+    def __unlock(self, stripe):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, _HEADER.size + stripe)
+        self.locks[stripe].release()
+
+    def __offset(self, stripe, index):
+        return _HEADER.size + (stripe * self.stripe_size + index) * _SLOT.size
+
+    def __probe(self, key_hash, stripe, start, now, insert):
+        """
+        Finds the offset of the slot of ``key_hash`` in ``stripe``. With
+        ``insert`` a slot is claimed for a key that isn't in the table,
+        otherwise ``None`` is returned for it. The stripe must be locked.
+        """
+        for probe in range(self.stripe_size):
+            index = (start + probe) % self.stripe_size
+            offset = self.__offset(stripe, index)
+            slot_hash, _, expiry = _SLOT.unpack_from(self.map, offset)
+            if slot_hash and expiry and expiry <= now:
+                self.__purge(stripe, index, now)
+                return self.__probe(key_hash, stripe, start, now, insert)
+            if slot_hash == key_hash:
+                return offset
+            if not slot_hash:
+                break
+        else:
+            offset = None
+        if not insert:
+            return None
+        if offset is None:
+            raise SharedTableFull(
+                "No free slot in stripe %d of %s" % (stripe, self.path)
+            )
+        _SLOT.pack_into(self.map, offset, key_hash, 0, 0)
+        return offset
+
+    def __purge(self, stripe, index, now):
+        """
+        Clears the run of occupied slots of ``stripe`` that starts at
+        ``index`` and inserts its live slots again, each in the first empty
+        slot from its home slot. The stripe must be locked.
+        """
+        live = []
+        for probe in range(self.stripe_size):
+            offset = self.__offset(stripe, (index + probe) % self.stripe_size)
+            slot = _SLOT.unpack_from(self.map, offset)
+            if not slot[0]:
+                break
+            if not slot[2] or slot[2] > now:
+                live.append(slot)
+            _SLOT.pack_into(self.map, offset, 0, 0, 0)
+        for slot in live:
+            home = slot[0] % self.stripe_size
+            for probe in range(self.stripe_size):
+                offset = self.__offset(
+                    stripe, (home + probe) % self.stripe_size
+                )
+                if not _SLOT.unpack_from(self.map, offset)[0]:
+                    _SLOT.pack_into(self.map, offset, *slot)
+                    break
+
+    def incr(self, span, amount=1):
+        self.incr_spans([(span, amount)])
+
+    def incr_multi(self, spans, amount=1):
+        self.incr_spans((span, amount) for span in spans)
+
+    def incr_spans(self, amounts):
+        now = time.time()
+        for stripe, items in self.__by_stripe(amounts).items():
+            self.__lock(stripe)
+            try:
+                for key_hash, start, span, amount in items:
+                    offset = self.__probe(key_hash, stripe, start, now, True)
+                    _, value, expiry = _SLOT.unpack_from(self.map, offset)
+                    if span.expiry is not None and not expiry:
+                        expiry = int(span.expiry)
+                    _SLOT.pack_into(
+                        self.map, offset, key_hash, value + amount, expiry
+                    )
+            finally:
+                self.__unlock(stripe)
+
+    def count(self, span):
+        return self.count_many([span])[0]
+
+    def count_many(self, spans):
+        spans = list(spans)
+        counts = dict((span.key, 0) for span in spans)
+        now = time.time()
+        stripes = self.__by_stripe((span, None) for span in spans)
+        for stripe, items in stripes.items():
+            self.__lock(stripe)
+            try:
+                for key_hash, start, span, _ in items:
+                    offset = self.__probe(key_hash, stripe, start, now, False)
+                    if offset is not None:
+                        counts[span.key] = _SLOT.unpack_from(
+                            self.map, offset
+                        )[1]
+            finally:
+                self.__unlock(stripe)
+        return [counts[span.key] for span in spans]
+
+    def incr_unique(self, span, identifier):
+        raise NotImplementedError
+
+    def incr_unique_multi(self, spans, identifier):
+        raise NotImplementedError
+
+    def track(self, span, identifier):
+        raise NotImplementedError
+
+    def track_multi(self, spans, identifier):
+        raise NotImplementedError
+
+    def cardinality(self, span):
+        raise NotImplementedError
+
+    def uniques(self, span):
+        raise NotImplementedError
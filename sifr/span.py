@@ -1,6 +1,8 @@
-import calendar
 import datetime
 import time
+
+from six.moves import range as xrange
+
 from sifr.util import normalize_time
 
 try:
@@ -8,165 +10,329 @@ try:
 except ImportError:
     from sifr.backports.total_ordering import total_ordering
 
+EPOCH = datetime.datetime(1970, 1, 1)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def to_seconds(at):
+    """
+    Converts a naive datetime to the number of wall clock seconds since
+    the epoch (ignoring microseconds). Wall clock seconds keep bucket
+    arithmetic consistent with the naive datetimes that the spans use.
+
+    :param at: a :class:`datetime.datetime`
+    """
+    return (
+        (at.toordinal() - EPOCH_ORDINAL) * 86400
+        + at.hour * 3600 + at.minute * 60 + at.second
+    )
+
+
+def from_seconds(seconds):
+    """
+    Converts wall clock seconds since the epoch back to a naive datetime.
+
+    :param seconds: the value returned by :func:`to_seconds`
+    """
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
+_UTC_OFFSETS = {}
+
+
+def _utc_offset(seconds):
+    return time.mktime(from_seconds(seconds).timetuple()) - seconds
+
+
+def to_timestamp(seconds):
+    """
+    Converts wall clock seconds since the epoch to a unix timestamp in the
+    local timezone, i.e. the equivalent of :func:`time.mktime`. The utc
+    offset of each wall clock hour is cached (unless the offset changes
+    within that hour) since :func:`time.mktime` is comparatively slow.
+
+    :param seconds: the value returned by :func:`to_seconds`
+    """
+    hour = seconds // 3600
+    offset = _UTC_OFFSETS.get(hour)
+    if offset is None:
+        offset = _utc_offset(hour * 3600)
+        if offset != _utc_offset(hour * 3600 + 3599):
+            return seconds + _utc_offset(seconds)
+        if len(_UTC_OFFSETS) > 4096:
+            _UTC_OFFSETS.clear()
+        _UTC_OFFSETS[hour] = offset
+    return seconds + offset
+
+
+def _day_start(year, month, day):
+    ordinal = datetime.date(year, month, day).toordinal()
+    return (ordinal - EPOCH_ORDINAL) * 86400
+
 
 @total_ordering
 class Span(object):
-    def __init__(self, at, keys, expiry=None):
-        if not expiry and not isinstance(self, Forever):
-            next = SPAN_ORDER.index(self.__class__) + 1
-            if next < len(SPAN_ORDER):
-                self.expiry = time.mktime(
-                    (
-                        normalize_time(at) + datetime.timedelta(
-                            seconds=SPAN_ORDER[next].duration
-                        )
-                    ).timetuple()
-                )
-            else:
-                self.expiry = None
-        else:
-            self.expiry = expiry
-        self.at = normalize_time(at)
-        self._key = ":".join([str(k) for k in keys])
+    """
+    A window of time for a namespace. The key, timestamp, range and expiry
+    of a span are computed once when it is constructed.
 
-    @property
-    def key(self):
-        return "{key}:{time}".format(key=self._key,
-                                     time=self.at.strftime(self.fmt))
+    :param at: any point in time that falls inside the span
+    :param keys: the keys that make up the namespace
+    :param expiry: explicit expiry that overrides the default retention
+    """
+    __slots__ = ("at", "namespace", "timestamp", "key", "range", "expiry")
 
-    @property
-    def namespace(self):
-        return self._key
+    #: seconds after :attr:`at` that the span is retained for
+    retention = None
 
-    @property
-    def timestamp(self):
-        return self.at.strftime(self.fmt)
+    def __init__(self, at, keys, expiry=None):
+        at = normalize_time(at)
+        seconds = to_seconds(at)
+        if not expiry and self.retention is not None:
+            expiry = to_timestamp(seconds + self.retention)
+        self.at = at
+        self.expiry = expiry
+        self.namespace = ":".join([str(k) for k in keys])
+        self.timestamp = self.format(at)
+        self.key = self.namespace + ":" + self.timestamp
+        bucket = self.bucket(seconds)
+        self.range = (
+            from_seconds(self.bucket_start(bucket)),
+            from_seconds(self.bucket_start(bucket + 1) - 1)
+        )
+
+    def in_namespace(self, prefix):
+        """
+        Checks whether the namespace of the span is ``prefix`` or is made
+        of the keys of ``prefix`` followed by more keys, so that
+        ``views:user`` matches ``views:user:1`` but not ``views:users``.
+
+        :param prefix: a namespace
+        """
+        return self.namespace == prefix or self.namespace.startswith(
+            prefix + ":"
+        )
 
     @property
     def next(self):
-        n = self.__class__(self.range[1] + datetime.timedelta(seconds=1), [])
-        n._key = self._key
-        return n
+        return self.__class__(
+            self.range[1] + datetime.timedelta(seconds=1), [self.namespace]
+        )
+
+    @classmethod
+    def format(cls, at):
+        """
+        Formats ``at`` using :attr:`fmt`.
+
+        :param at: a :class:`datetime.datetime`
+        """
+        return at.strftime(cls.fmt)
+
+    @classmethod
+    def bucket(cls, seconds):
+        """
+        Gets the integer id of the bucket that contains ``seconds``.
+
+        :param seconds: wall clock seconds since the epoch
+        """
+        return seconds // cls.duration
+
+    @classmethod
+    def bucket_start(cls, bucket):
+        """
+        Gets the first wall clock second of ``bucket``.
+
+        :param bucket: an id returned by :meth:`bucket`
+        """
+        return bucket * cls.duration
 
     def __lt__(self, other):
         return self.at < other.at
 
     def __repr__(self):  # pragma: no cover
-        return self.at.strftime(self.fmt)
+        return self.timestamp
 
 
 class Minute(Span):
+    __slots__ = ()
     fmt = "%Y-%m-%d_%H:%M"
     duration = 60
 
-    @property
-    def range(self):
-        return (datetime.datetime(year=self.at.year,
-                                  month=self.at.month,
-                                  day=self.at.day,
-                                  hour=self.at.hour,
-                                  minute=self.at.minute),
-                datetime.datetime(year=self.at.year,
-                                  month=self.at.month,
-                                  day=self.at.day,
-                                  hour=self.at.hour,
-                                  minute=self.at.minute,
-                                  second=59))
+    @classmethod
+    def format(cls, at):
+        return "%04d-%02d-%02d_%02d:%02d" % (
+            at.year, at.month, at.day, at.hour, at.minute
+        )
 
 
 class Hour(Span):
+    __slots__ = ()
     fmt = "%Y-%m-%d_%H"
     duration = 60 * 60
 
-    @property
-    def range(self):
-        return (datetime.datetime(year=self.at.year,
-                                  month=self.at.month,
-                                  day=self.at.day,
-                                  hour=self.at.hour),
-                datetime.datetime(year=self.at.year,
-                                  month=self.at.month,
-                                  day=self.at.day,
-                                  hour=self.at.hour,
-                                  minute=59,
-                                  second=59))
+    @classmethod
+    def format(cls, at):
+        return "%04d-%02d-%02d_%02d" % (at.year, at.month, at.day, at.hour)
 
 
 class Day(Span):
+    __slots__ = ()
     fmt = "%Y-%m-%d"
     duration = 60 * 60 * 24
 
-    @property
-    def range(self):
-        return (datetime.datetime(year=self.at.year,
-                                  month=self.at.month,
-                                  day=self.at.day),
-                datetime.datetime(year=self.at.year,
-                                  month=self.at.month,
-                                  day=self.at.day,
-                                  hour=23,
-                                  minute=59,
-                                  second=59))
+    @classmethod
+    def format(cls, at):
+        return "%04d-%02d-%02d" % (at.year, at.month, at.day)
 
 
 class Month(Span):
+    __slots__ = ()
     fmt = "%Y-%m"
     duration = 60 * 60 * 24 * 30
 
-    @property
-    def range(self):
-        return (datetime.datetime(year=self.at.year,
-                                  month=self.at.month,
-                                  day=1),
-                datetime.datetime(
-                    year=self.at.year,
-                    month=self.at.month,
-                    day=calendar.monthrange(self.at.year, self.at.month)[1],
-                    hour=23,
-                    minute=59,
-                    second=59))
+    @classmethod
+    def format(cls, at):
+        return "%04d-%02d" % (at.year, at.month)
+
+    @classmethod
+    def bucket(cls, seconds):
+        date = datetime.date.fromordinal(seconds // 86400 + EPOCH_ORDINAL)
+        return date.year * 12 + date.month - 1
+
+    @classmethod
+    def bucket_start(cls, bucket):
+        year, month = divmod(bucket, 12)
+        return _day_start(year, month + 1, 1)
 
 
 class Year(Span):
+    __slots__ = ()
     fmt = "%Y"
     duration = 60 * 60 * 24 * 365
 
-    @property
-    def range(self):
-        return (datetime.datetime(year=self.at.year,
-                                  month=1,
-                                  day=1),
-                datetime.datetime(year=self.at.year,
-                                  month=12,
-                                  day=calendar.monthrange(self.at.year, 12)[1],
-                                  hour=23,
-                                  minute=59,
-                                  second=59))
+    @classmethod
+    def format(cls, at):
+        return "%04d" % at.year
+
+    @classmethod
+    def bucket(cls, seconds):
+        return datetime.date.fromordinal(
+            seconds // 86400 + EPOCH_ORDINAL
+        ).year
+
+    @classmethod
+    def bucket_start(cls, bucket):
+        return _day_start(bucket, 1, 1)
 
 
 class Forever(Span):
+    __slots__ = ()
     fmt = "I"
     duration = -1
 
+    @classmethod
+    def bucket(cls, seconds):
+        return 0
+
+    @classmethod
+    def bucket_start(cls, bucket):
+        if bucket <= 0:
+            return to_seconds(datetime.datetime.min)
+        return to_seconds(datetime.datetime.max) + 1
+
+
 ALL_SPANS = [Year, Month, Day, Hour, Minute]
 SPAN_ORDER = [Minute, Hour, Day, Month, Year]
 
+for _span, _next in zip(SPAN_ORDER, SPAN_ORDER[1:]):
+    _span.retention = _next.duration
+del _span, _next
+
+
+def _plan(first_second, last_second, buckets):
+    if not buckets or first_second > last_second:
+        return
+    span, remaining = buckets[0], buckets[1:]
+    first = span.bucket(first_second)
+    if span.bucket_start(first) < first_second:
+        first += 1
+    last = span.bucket(last_second + 1) - 1
+    if first > last:
+        for run in _plan(first_second, last_second, remaining):
+            yield run
+    else:
+        for run in _plan(
+            first_second, span.bucket_start(first) - 1, remaining
+        ):
+            yield run
+        yield span, first, last
+        for run in _plan(
+            span.bucket_start(last + 1), last_second, remaining
+        ):
+            yield run
+
+
+def plan_time_spans(start, end, buckets=ALL_SPANS):
+    """
+    Works out which buckets cover the window between ``start`` and ``end``
+    without constructing any spans. Larger buckets are preferred and the
+    remainder on either side is filled with the next resolution in
+    ``buckets``.
+
+    :param start: start of the window
+    :param end: end of the window
+    :param buckets: the resolutions to cover the window with
+    :return: a chronologically ordered list of ``(span class, first bucket,
+     last bucket)`` tuples
+    """
+    start, end = normalize_time(start), normalize_time(end)
+    first_second = to_seconds(start) + (1 if start.microsecond else 0)
+    return list(_plan(first_second, to_seconds(end), list(buckets)))
+
+
+def iter_time_spans(start, end, keys, buckets=ALL_SPANS):
+    """
+    Lazily generates the spans covering the window between ``start``
+    and ``end`` in chronological order.
+
+    :param start: start of the window
+    :param end: end of the window
+    :param keys: the keys that make up the span namespace
+    :param buckets: the resolutions to cover the window with
+    """
+    for span, first, last in plan_time_spans(start, end, buckets):
+        for bucket in xrange(first, last + 1):
+            yield span(from_seconds(span.bucket_start(bucket)), keys)
+
 
 def get_time_spans(start, end, keys, buckets=ALL_SPANS):
-    spans = []
-    buckets = list(buckets)
-    if buckets:
-        cur_bucket = buckets[0](start, keys)
-        while cur_bucket.range[1] <= end:
-            if start <= cur_bucket.range[0] and cur_bucket.range[1] <= end:
-                spans.append(cur_bucket)
-            cur_bucket = cur_bucket.next
-        buckets.pop(0)
-        if spans:
-            min_left = min(spans).range[0]
-            max_right = max(spans).range[1]
-            spans.extend(get_time_spans(start, min_left, keys, list(buckets)))
-            spans.extend(get_time_spans(max_right, end, keys, list(buckets)))
-        else:
-            spans.extend(get_time_spans(start, end, keys, list(buckets)))
-    return sorted(spans)
+    return list(iter_time_spans(start, end, keys, buckets))
+
+
+def coalesce_events(events, buckets=ALL_SPANS):
+    """
+    Fans events out to spans and sums the amounts of the events that fall
+    in the same span. The expiry of each span is based on the latest event
+    that it received.
+
+    :param events: an iterable of ``(keys, at, amount)`` tuples
+    :param buckets: the resolutions to fan each event out to
+    :return: a list of ``(span, amount)`` tuples
+    """
+    totals = {}
+    for keys, at, amount in events:
+        at = normalize_time(at)
+        seconds = to_seconds(at)
+        namespace = ":".join([str(k) for k in keys])
+        for span in buckets:
+            ident = (span, namespace, span.bucket(seconds))
+            total = totals.get(ident)
+            if total is None:
+                totals[ident] = [at, amount]
+            else:
+                total[0] = max(total[0], at)
+                total[1] += amount
+    return [
+        (span(at, [namespace]), amount)
+        for (span, namespace, _), (at, amount) in totals.items()
+    ]
@@ -1,10 +1,23 @@
 from abc import abstractmethod, ABCMeta
+import datetime
+import heapq
+import itertools
+import logging
 import threading
 import time
+import uuid
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
 
 import six
 
-from sifr.hll import HLLCounter
+from sifr.cms import CountMinPrefixes, CountMinSketch, cells
+from sifr.hll import HLLCounter, estimate, hash64_one, merge_counters
+from sifr.topk import SpaceSaving
+from sifr.span import (
+    ALL_SPANS, Day, Hour, Minute, Month, Year, coalesce_events,
+    get_time_spans, to_seconds, to_timestamp
+)
 
 try:
     from collections import Counter
@@ -50,163 +63,1368 @@ class Storage(object):
     def uniques(self, span):
         raise NotImplementedError
 
+    def incr_spans(self, amounts):
+        """
+        Increments several spans by individual amounts. Backends override
+        this to write all the spans in a single batched call.
+
+        :param amounts: an iterable of ``(span, amount)`` tuples
+        """
+        for span, amount in amounts:
+            self.incr(span, amount)
+
+    def incr_batch(self, events, buckets=ALL_SPANS):
+        """
+        Increments the counters for a batch of events. Events that fall in
+        the same span are summed up before anything is written to the
+        backend.
+
+        :param events: an iterable of ``(keys, at, amount)`` tuples
+        :param buckets: the resolutions to count each event in
+        """
+        self.incr_spans(coalesce_events(events, buckets))
+
+    def count_many(self, spans):
+        """
+        Gets the counts for several spans. Backends override this
+        to read all the spans in a single batched call.
+
+        :param spans: the spans to read
+        :return: a list of counts in the same order as ``spans``
+        """
+        return [self.count(span) for span in spans]
+
+    def cardinality_many(self, spans):
+        """
+        Gets the unique counts for several spans. Backends override this
+        to read all the spans in a single batched call.
+
+        :param spans: the spans to read
+        :return: a list of cardinalities in the same order as ``spans``
+        """
+        return [self.cardinality(span) for span in spans]
+
+    def cardinality_union(self, spans):
+        """
+        Gets the number of distinct identifiers counted by
+        :meth:`incr_unique` in any of ``spans``. An identifier that was
+        seen in several of the spans is only counted once.
+
+        :param spans: the spans to merge, which may belong to different
+         keys
+
+        Backends that can't merge their counters inherit this fallback,
+        which sums the unique counts of the spans and therefore counts an
+        identifier once per span that saw it (exact for a single span).
+        """
+        return sum(self.cardinality_many(list(spans)))
+
+    def cardinality_unions(self, groups):
+        """
+        Gets :meth:`cardinality_union` for several groups of spans.
+        Backends override this to read all the groups in a single
+        batched call.
+
+        :param groups: an iterable of lists of spans
+        :return: a list of cardinalities in the same order as ``groups``
+        """
+        return [self.cardinality_union(spans) for spans in groups]
+
+    def cardinality_intersection(self, spans):
+        """
+        Estimates the number of identifiers counted by
+        :meth:`incr_unique` in every one of ``spans`` using the
+        inclusion-exclusion principle over the unions of all the subsets
+        of ``spans``. That is ``2 ** len(spans) - 1`` unions, and the
+        errors of the unions add up, so at most
+        :data:`MAX_INTERSECTION_SPANS` spans are accepted.
+
+        :param spans: the spans to intersect, which may belong to
+         different keys
+        :raises ValueError: if there are too many spans
+        """
+        spans = list(spans)
+        if not spans:
+            return 0
+        if len(spans) > MAX_INTERSECTION_SPANS:
+            raise ValueError(
+                "Can't intersect more than %d spans, got %d" % (
+                    MAX_INTERSECTION_SPANS, len(spans)
+                )
+            )
+        subsets = [
+            subset for size in range(1, len(spans) + 1)
+            for subset in itertools.combinations(spans, size)
+        ]
+        unions = self.cardinality_unions(subsets)
+        total = sum(
+            union if len(subset) % 2 else -union
+            for subset, union in zip(subsets, unions)
+        )
+        return max(0, min([total] + unions[:len(spans)]))
+
+    def tracked_cardinality(self, span):
+        """
+        Gets the number of distinct identifiers tracked in a span, which
+        includes those that a bounded tracked set didn't keep.
+
+        :param span: the span to read
+        """
+        return len(self.uniques(span))
+
+    def incr_topk(self, spans, item, amount=1):
+        """
+        Counts an occurrence of ``item`` in the top-k sketch of each span.
+        The sketches keep a bounded number of items per span, see
+        :class:`sifr.topk.SpaceSaving`.
+
+        :param spans: the spans to count the item in
+        :param item: the item (e.g. a page) to count
+        :param amount: the number of occurrences
+        """
+        raise NotImplementedError
+
+    def top_k(self, span, k):
+        """
+        Gets the most frequent items counted by :meth:`incr_topk`. The
+        counts may be overestimated by up to the lowest count that the
+        sketch of the span holds.
+
+        :param span: the span to read
+        :param k: the number of items
+        :return: a list of ``(item, count)`` tuples, highest count first
+        """
+        raise NotImplementedError
+
+    def count_range(self, keys, start, end, buckets=ALL_SPANS):
+        """
+        Gets the total count for ``keys`` between ``start`` and ``end``
+        using the spans returned by :func:`sifr.span.get_time_spans`.
+
+        :param keys: the keys that make up the span namespace
+        :param start: start of the window
+        :param end: end of the window
+        :param buckets: the resolutions to cover the window with
+        """
+        return sum(
+            self.count_many(get_time_spans(start, end, keys, buckets))
+        )
+
+    def cardinality_range(self, keys, start, end, buckets=ALL_SPANS):
+        """
+        Gets the number of distinct identifiers seen between ``start``
+        and ``end``, merging the unique counts of the covering spans with
+        :meth:`cardinality_union`.
+
+        :param keys: the keys that make up the span namespace
+        :param start: start of the window
+        :param end: end of the window
+        :param buckets: the resolutions to cover the window with
+        """
+        return self.cardinality_union(
+            get_time_spans(start, end, keys, buckets)
+        )
+
+
+_Expiry = namedtuple("_Expiry", ["key", "expiry"])
+
+#: The largest number of spans :meth:`Storage.cardinality_intersection`
+#: accepts, it reads ``2 ** n - 1`` unions.
+MAX_INTERSECTION_SPANS = 10
+
+#: Policies for identifiers tracked in a span that already tracks
+#: ``track_limit`` others: ``first`` ignores them, ``reservoir`` keeps the
+#: ``track_limit`` identifiers with the lowest hashes (a uniform sample of
+#: the distinct identifiers) and ``reject`` raises
+#: :class:`TrackLimitExceeded`.
+TRACK_POLICIES = ("first", "reservoir", "reject")
+
+
+class TrackLimitExceeded(ValueError):
+    """
+    Raised when an identifier could not be tracked in some spans because
+    they already track ``track_limit`` identifiers. The identifier is
+    still tracked in the other spans and counted by
+    :meth:`Storage.tracked_cardinality`.
+
+    :attr:`spans` are the spans that were full.
+    """
+
+    def __init__(self, spans):
+        self.spans = spans
+        super(TrackLimitExceeded, self).__init__(
+            "Tracking limit reached for %s" % ", ".join(
+                span.key for span in spans
+            )
+        )
+
+
+def sample_score(identifier):
+    """
+    Gets the score that decides whether ``identifier`` is kept in a
+    reservoir sample, the 53 high bits of its hash so that it is exact as
+    a double (redis sorted set scores).
+    """
+    return hash64_one(identifier) >> 11
+
 
 class MemoryStorage(Storage):
-    def __init__(self):
+    """
+    In process storage.
+
+    :param exact_threshold: number of distinct identifiers a span counts
+     exactly before its unique counter is promoted to a hyperloglog
+     sketch, ``0`` to always use sketches
+    :param error_rate: the default relative error of the sketches
+    :param resolution_error_rates: a mapping of resolutions
+     (``"minute"``, ``"hour"``, ...) to the relative error of the sketches
+     of spans with that resolution
+    :param prefix_error_rates: a mapping of namespace prefixes to the
+     relative error of the sketches of spans in the namespace of the
+     prefix, see :meth:`sifr.span.Span.in_namespace`. The longest
+     matching prefix takes precedence over the resolution of the span.
+    :param topk_capacity: the number of items that the top-k sketch of
+     a span keeps
+    :param count_min_prefixes: a mapping of namespace prefixes to the
+     ``error`` or ``(error, confidence)`` of a Count-Min sketch per span
+     that counts all the namespaces with the prefix, instead of a counter
+     per namespace. See :class:`sifr.cms.CountMinPrefixes`.
+    :param track_limit: the largest number of identifiers tracked per
+     span, ``None`` for no limit. With a limit the distinct tracked
+     identifiers are also counted by a hyperloglog, see
+     :meth:`tracked_cardinality`.
+    :param track_policy: what happens to identifiers over the limit, one
+     of :data:`TRACK_POLICIES`
+
+    :attr:`journal` can be set to a callable that is called with a
+    record of every write while the lock is held, see
+    :mod:`sifr.persistence`.
+    """
+
+    def __init__(self, exact_threshold=256, error_rate=0.005,
+                 resolution_error_rates=None, prefix_error_rates=None,
+                 topk_capacity=100, count_min_prefixes=None,
+                 track_limit=None, track_policy="first"):
+        if track_policy not in TRACK_POLICIES:
+            raise ValueError("Unknown track policy: %s" % track_policy)
         self.lock = threading.RLock()
-        self.unique_counter = HLLCounter()
+        self.unique_counter = HLLCounter(
+            error_rate=error_rate, threshold=exact_threshold
+        )
+        self.resolution_error_rates = dict(resolution_error_rates or {})
+        self.prefix_error_rates = sorted(
+            (prefix_error_rates or {}).items(),
+            key=lambda item: len(item[0]), reverse=True
+        )
         self.counter = Counter()
         self.tracker = {}
+        self.track_limit = track_limit
+        self.track_policy = track_policy
+        self.tracked_counter = HLLCounter(
+            error_rate=error_rate, threshold=exact_threshold
+        )
+        self.samples = {}
+        self.sample_order = itertools.count()
+        self.topk = {}
+        self.topk_capacity = topk_capacity
+        self.count_min = CountMinPrefixes(count_min_prefixes)
+        self.sketches = {}
         self.expirations = {}
-        self.timer = threading.Timer(0.01, self.__expire_events)
-        self.timer.start()
+        self.expiry_queue = []
+        self.expiry_condition = threading.Condition(self.lock)
+        self.reaper = None
+        self.journal = None
         super(MemoryStorage, self).__init__()
 
-    def __expire_events(self):
+    def __reap(self):
+        """
+        Removes keys as they become due. A key is only ever queued once,
+        if its expiry was extended after it was queued it is queued again
+        with the new expiry once the original one is reached.
+        """
         with self.lock:
-            for key in list(self.expirations.keys()):
-                self.__check_expiry(key)
+            while self.expiry_queue:
+                now = time.time()
+                expiry, key = self.expiry_queue[0]
+                if expiry > now:
+                    self.expiry_condition.wait(min(expiry - now, 60))
+                    continue
+                heapq.heappop(self.expiry_queue)
+                current = self.expirations.get(key)
+                if current is not None and current > now:
+                    heapq.heappush(self.expiry_queue, (current, key))
+                else:
+                    self.__check_expiry(key)
+            self.reaper = None
 
-    def __schedule_expiry(self):
-        if not self.timer.is_alive():
-            self.timer = threading.Timer(0.01, self.__expire_events)
-            self.timer.start()
+    def __schedule_expiry(self, span):
+        if span.expiry is None:
+            return
+        queued = span.key in self.expirations
+        self.expirations[span.key] = span.expiry
+        if queued:
+            return
+        heapq.heappush(self.expiry_queue, (span.expiry, span.key))
+        if self.reaper is None:
+            self.reaper = threading.Thread(target=self.__reap)
+            self.reaper.daemon = True
+            self.reaper.start()
+        elif self.expiry_queue[0][1] == span.key:
+            self.expiry_condition.notify()
 
     def __check_expiry(self, key):
+        if (
+            key in self.expirations
+            and self.expirations[key] <= time.time()
+        ):
+            self.counter.pop(key, None)
+            self.unique_counter.pop(key)
+            self.tracker.pop(key, None)
+            self.tracked_counter.pop(key)
+            self.samples.pop(key, None)
+            self.topk.pop(key, None)
+            self.sketches.pop(key, None)
+            self.expirations.pop(key, None)
+
+    def __touch(self, span):
+        self.__check_expiry(span.key)
+        self.__schedule_expiry(span)
+
+    def error_rate(self, span):
+        """
+        Gets the relative error of the unique counter sketch of ``span``.
+        """
+        for prefix, error_rate in self.prefix_error_rates:
+            if span.in_namespace(prefix):
+                return error_rate
+        return self.resolution_error_rates.get(
+            span.__class__.__name__.lower(), self.unique_counter.error_rate
+        )
+
+    def dump(self):
+        """
+        Gets a copy of the state of the storage that shares nothing with
+        it. This only takes as long as copying the maps, the copy can be
+        serialized without holding the lock.
+        """
         with self.lock:
-            if (
-                key in self.expirations
-                and self.expirations[key] <= time.time()
-            ):
-                self.counter.pop(key, None)
-                self.unique_counter.pop(key)
-                self.tracker.pop(key, None)
-                self.expirations.pop(key, None)
+            return {
+                "counter": dict(self.counter),
+                "unique_counter": self.unique_counter.copy(),
+                "tracker": dict(
+                    (key, set(identifiers))
+                    for key, identifiers in self.tracker.items()
+                ),
+                "tracked_counter": self.tracked_counter.copy(),
+                "topk": dict(
+                    (key, sketch.copy()) for key, sketch in self.topk.items()
+                ),
+                "sketches": dict(
+                    (key, sketch.copy())
+                    for key, sketch in self.sketches.items()
+                ),
+                "expirations": dict(self.expirations),
+            }
+
+    def load(self, state):
+        """
+        Replaces the state of the storage with one returned by
+        :meth:`dump`.
+        """
+        with self.lock:
+            self.counter = Counter(state["counter"])
+            self.unique_counter.counter = state["unique_counter"]
+            self.tracker = state["tracker"]
+            self.tracked_counter.counter = state.get("tracked_counter", {})
+            self.samples = {}
+            self.topk = state.get("topk", {})
+            self.sketches = state.get("sketches", {})
+            self.expirations = {}
+            self.expiry_queue = []
+            for key, expiry in state["expirations"].items():
+                self.__schedule_expiry(_Expiry(key, expiry))
+
+    def replay(self, records):
+        """
+        Applies records passed to :attr:`journal` to the storage.
+
+        :param records: an iterable of records
+        """
+        with self.lock:
+            for record in records:
+                kind, key, value, expiry = record[:4]
+                self.__touch(_Expiry(key, expiry))
+                if kind == "c":
+                    self.counter[key] += value
+                elif kind == "u":
+                    self.unique_counter.add_hash(key, value, record[4])
+                elif kind == "k":
+                    self.__topk(key).add(value, record[4])
+                elif kind == "m":
+                    self.__sketch(key, record[5]).add(value, record[4])
+                else:
+                    self.__track(key, value, *record[4:])
+
+    def __topk(self, key):
+        if key not in self.topk:
+            self.topk[key] = SpaceSaving(self.topk_capacity)
+        return self.topk[key]
+
+    def __sketch(self, key, size):
+        if key not in self.sketches:
+            self.sketches[key] = CountMinSketch(*size)
+        return self.sketches[key]
+
+    def incr_topk(self, spans, item, amount=1):
+        with self.lock:
+            for span in spans:
+                self.__touch(span)
+                self.__topk(span.key).add(item, amount)
+                if self.journal is not None:
+                    self.journal(("k", span.key, item, span.expiry, amount))
+
+    def top_k(self, span, k):
+        with self.lock:
+            self.__check_expiry(span.key)
+            if span.key not in self.topk:
+                return []
+            return self.topk[span.key].top(k)
 
     def uniques(self, span):
-        self.__check_expiry(span.key)
-        if span.key not in self.tracker:
-            return set()
-        else:
-            return self.tracker.get(span.key)
+        with self.lock:
+            self.__check_expiry(span.key)
+            if span.key not in self.tracker:
+                return set()
+            else:
+                return self.tracker.get(span.key)
 
     def count(self, span):
-        self.__check_expiry(span.key)
-        return self.counter.get(span.key, 0)
+        return self.count_many([span])[0]
 
     def cardinality(self, span):
-        self.__check_expiry(span.key)
-        return self.unique_counter.get(span.key)
+        return self.cardinality_many([span])[0]
+
+    def count_many(self, spans):
+        with self.lock:
+            counts = []
+            for span in spans:
+                sketch = self.count_min.sketch(span)
+                if sketch is None:
+                    self.__check_expiry(span.key)
+                    counts.append(self.counter.get(span.key, 0))
+                    continue
+                self.__check_expiry(sketch.key)
+                counts.append(
+                    self.sketches[sketch.key].query(span.namespace)
+                    if sketch.key in self.sketches else 0
+                )
+            return counts
+
+    def cardinality_many(self, spans):
+        with self.lock:
+            cardinalities = []
+            for span in spans:
+                self.__check_expiry(span.key)
+                cardinalities.append(self.unique_counter.get(span.key))
+            return cardinalities
+
+    def unique_union(self, spans):
+        """
+        Gets a merged copy of the unique counters of ``spans``, see
+        :func:`sifr.hll.merge_counters`.
+        """
+        with self.lock:
+            for span in spans:
+                self.__check_expiry(span.key)
+            return self.unique_counter.union(span.key for span in spans)
+
+    def cardinality_union(self, spans):
+        return estimate(self.unique_union(spans))
+
+    def cardinality_unions(self, groups):
+        with self.lock:
+            return [self.cardinality_union(spans) for spans in groups]
 
     def track(self, span, identifier):
-        if span.expiry is not None:
-            self.expirations[span.key] = span.expiry
-        self.tracker.setdefault(span.key, set())
-        self.tracker[span.key].add(identifier)
+        self.track_multi([span], identifier)
 
     def track_multi(self, spans, identifier):
-        for span in spans:
-            self.track(span, identifier)
+        full = []
+        with self.lock:
+            for span in spans:
+                self.__touch(span)
+                error_rate = self.error_rate(span)
+                if not self.__track(span.key, identifier, error_rate):
+                    full.append(span)
+                if self.journal is not None:
+                    self.journal(
+                        ("t", span.key, identifier, span.expiry, error_rate)
+                    )
+        if full:
+            raise TrackLimitExceeded(full)
+
+    def __track(self, key, identifier, error_rate=None):
+        """
+        Tracks an identifier within the limit, returns ``False`` if it was
+        rejected.
+        """
+        identifiers = self.tracker.setdefault(key, set())
+        if self.track_limit is None:
+            identifiers.add(identifier)
+            return True
+        self.tracked_counter.add(key, identifier, error_rate)
+        if (
+            identifier in identifiers
+            or len(identifiers) < self.track_limit
+        ):
+            identifiers.add(identifier)
+        elif self.track_policy == "reservoir":
+            self.__sample(key, identifiers, identifier)
+        return self.track_policy != "reject" or identifier in identifiers
+
+    def __sample(self, key, identifiers, identifier):
+        """
+        Replaces the identifier with the highest score in a full set if
+        ``identifier`` has a lower one. The heap of a set is only built
+        once it is full.
+        """
+        if key not in self.samples:
+            self.samples[key] = [
+                (-sample_score(kept), next(self.sample_order), kept)
+                for kept in identifiers
+            ]
+            heapq.heapify(self.samples[key])
+        heap, score = self.samples[key], sample_score(identifier)
+        if heap and score < -heap[0][0]:
+            evicted = heapq.heapreplace(
+                heap, (-score, next(self.sample_order), identifier)
+            )[2]
+            identifiers.discard(evicted)
+            identifiers.add(identifier)
+
+    def tracked_cardinality(self, span):
+        with self.lock:
+            self.__check_expiry(span.key)
+            if self.track_limit is None:
+                return len(self.tracker.get(span.key, ()))
+            return self.tracked_counter.get(span.key)
 
     def incr(self, span, amount=1):
+        self.incr_spans([(span, amount)])
+
+    def incr_multi(self, spans, amount=1):
+        self.incr_spans((span, amount) for span in spans)
+
+    def incr_spans(self, amounts):
         with self.lock:
-            self.count(span)
-            self.__schedule_expiry()
-            if span.expiry is not None:
-                self.expirations[span.key] = span.expiry
-            self.counter[span.key] += amount
+            for span, amount in amounts:
+                sketch = self.count_min.sketch(span)
+                if sketch is not None:
+                    self.__incr_sketch(sketch, span.namespace, amount)
+                    continue
+                self.__touch(span)
+                self.counter[span.key] += amount
+                if self.journal is not None:
+                    self.journal(("c", span.key, amount, span.expiry))
+
+    def __incr_sketch(self, sketch, namespace, amount):
+        size = (sketch.width, sketch.depth)
+        self.__touch(sketch)
+        self.__sketch(sketch.key, size).add(namespace, amount)
+        if self.journal is not None:
+            self.journal(
+                ("m", sketch.key, namespace, sketch.expiry, amount, size)
+            )
+
+    def incr_unique(self, span, identifier):
+        self.incr_unique_multi([span], identifier)
+
+    def incr_unique_multi(self, spans, identifier):
+        value = hash64_one(identifier)
+        with self.lock:
+            for span in spans:
+                self.__touch(span)
+                error_rate = self.error_rate(span)
+                self.unique_counter.add_hash(span.key, value, error_rate)
+                if self.journal is not None:
+                    self.journal(
+                        ("u", span.key, value, span.expiry, error_rate)
+                    )
+
+
+class ShardedMemoryStorage(Storage):
+    """
+    In memory storage that hash partitions the keys over several
+    :class:`MemoryStorage` shards, each with its own lock. Every span is
+    routed to the shard that owns it so a write only ever holds the lock
+    of the shard that it is updating.
+
+    :param shards: the number of shards
+    :param kwargs: passed on to each :class:`MemoryStorage`
+    """
+
+    def __init__(self, shards=16, **kwargs):
+        self.shards = [MemoryStorage(**kwargs) for _ in range(shards)]
+        super(ShardedMemoryStorage, self).__init__()
+
+    def shard(self, span):
+        """
+        Gets the shard that owns ``span``.
+        """
+        return self.shards[hash(span.key) % len(self.shards)]
+
+    def incr(self, span, amount=1):
+        self.shard(span).incr(span, amount)
 
     def incr_multi(self, spans, amount=1):
         for span in spans:
-            self.incr(span)
+            self.shard(span).incr(span, amount)
+
+    def incr_spans(self, amounts):
+        for span, amount in amounts:
+            self.shard(span).incr(span, amount)
 
     def incr_unique(self, span, identifier):
-        self.cardinality(span)
-        self.__schedule_expiry()
-        if span.expiry is not None:
-            self.expirations[span.key] = span.expiry
-        self.unique_counter.add(span.key, identifier)
+        self.shard(span).incr_unique(span, identifier)
 
     def incr_unique_multi(self, spans, identifier):
         for span in spans:
-            self.incr_unique(span, identifier)
+            self.shard(span).incr_unique(span, identifier)
+
+    def track(self, span, identifier):
+        self.shard(span).track(span, identifier)
+
+    def track_multi(self, spans, identifier):
+        full = []
+        for span in spans:
+            try:
+                self.shard(span).track(span, identifier)
+            except TrackLimitExceeded as error:
+                full.extend(error.spans)
+        if full:
+            raise TrackLimitExceeded(full)
+
+    def count(self, span):
+        return self.shard(span).count(span)
+
+    def cardinality(self, span):
+        return self.shard(span).cardinality(span)
+
+    def cardinality_union(self, spans):
+        shards = {}
+        for span in spans:
+            shards.setdefault(id(self.shard(span)), []).append(span)
+        return estimate(merge_counters([
+            self.shard(shard_spans[0]).unique_union(shard_spans)
+            for shard_spans in shards.values()
+        ]))
+
+    def uniques(self, span):
+        return self.shard(span).uniques(span)
+
+    def tracked_cardinality(self, span):
+        return self.shard(span).tracked_cardinality(span)
+
+    def incr_topk(self, spans, item, amount=1):
+        for span in spans:
+            self.shard(span).incr_topk([span], item, amount)
+
+    def top_k(self, span, k):
+        return self.shard(span).top_k(span, k)
+
+
+#: Writes a value to each of ``KEYS`` with the command in ``ARGV[1]``.
+#: ``ARGV`` then holds a ``value, expiry`` pair per key, the expiry is a
+#: unix timestamp that is only set if the key doesn't have a ttl yet, or
+#: an empty string for keys that never expire.
+WRITE_SCRIPT = """
+local command = ARGV[1]
+for i, key in ipairs(KEYS) do
+    redis.call(command, key, ARGV[i * 2])
+    local expiry = ARGV[i * 2 + 1]
+    if expiry ~= "" and redis.call("ttl", key) == -1 then
+        redis.call("expireat", key, expiry)
+    end
+end
+return #KEYS
+"""
+
+
+#: Space-Saving update of the sorted sets in ``KEYS``: ``ARGV[2]``
+#: occurrences of the item ``ARGV[1]`` are added, if a set already holds
+#: ``ARGV[3]`` other items the one with the lowest score is replaced and
+#: its score inherited. ``ARGV[3 + i]`` is the expiry of ``KEYS[i]`` as
+#: for :data:`WRITE_SCRIPT`.
+TOPK_SCRIPT = """
+local item, amount, capacity = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+for i, key in ipairs(KEYS) do
+    if redis.call("zscore", key, item)
+            or redis.call("zcard", key) < capacity then
+        redis.call("zincrby", key, amount, item)
+    else
+        local lowest = redis.call("zrange", key, 0, 0, "WITHSCORES")
+        redis.call("zrem", key, lowest[1])
+        redis.call("zadd", key, tonumber(lowest[2]) + amount, item)
+    end
+    local expiry = ARGV[i + 3]
+    if expiry ~= "" and redis.call("ttl", key) == -1 then
+        redis.call("expireat", key, expiry)
+    end
+end
+return #KEYS
+"""
+
+
+#: Count-Min update of the hashes in ``KEYS``: the arguments of each key
+#: are its expiry (as for :data:`WRITE_SCRIPT`), an amount, the number of
+#: cells to increment by the amount and the fields of those cells.
+COUNT_MIN_SCRIPT = """
+local position = 1
+for i, key in ipairs(KEYS) do
+    local expiry, amount = ARGV[position], ARGV[position + 1]
+    local depth = tonumber(ARGV[position + 2])
+    for field = position + 3, position + 2 + depth do
+        redis.call("hincrby", key, ARGV[field], amount)
+    end
+    if expiry ~= "" and redis.call("ttl", key) == -1 then
+        redis.call("expireat", key, expiry)
+    end
+    position = position + 3 + depth
+end
+return #KEYS
+"""
+
+
+#: Bounded tracking of ``ARGV[1]``. ``KEYS`` are pairs of the tracked set
+#: of a span (a sorted set scored by ``ARGV[4]`` with the ``reservoir``
+#: policy) and the hyperloglog that counts all of its identifiers.
+#: ``ARGV[2]`` is the limit, ``ARGV[3]`` the policy and ``ARGV[4 + i]``
+#: the expiry of the ``i``th pair. Returns the indexes of the pairs that
+#: rejected the identifier.
+TRACK_SCRIPT = """
+local identifier, limit, policy = ARGV[1], tonumber(ARGV[2]), ARGV[3]
+local full = {}
+for span = 1, #KEYS / 2 do
+    local key, counter = KEYS[span * 2 - 1], KEYS[span * 2]
+    redis.call("pfadd", counter, identifier)
+    if policy == "reservoir" then
+        redis.call("zadd", key, ARGV[4], identifier)
+        redis.call("zremrangebyrank", key, limit, -1)
+    elseif redis.call("sismember", key, identifier) == 1
+            or redis.call("scard", key) < limit then
+        redis.call("sadd", key, identifier)
+    elseif policy == "reject" then
+        table.insert(full, span)
+    end
+    local expiry = ARGV[span + 4]
+    if expiry ~= "" then
+        for _, written in ipairs({key, counter}) do
+            if redis.call("ttl", written) == -1 then
+                redis.call("expireat", written, expiry)
+            end
+        end
+    end
+end
+return full
+"""
+
+
+def script_arguments(command, suffix, values, key=None):
+    """
+    Gets the keys and arguments of :data:`WRITE_SCRIPT`.
+
+    :param command: the command to write with
+    :param suffix: the suffix of the span keys
+    :param values: an iterable of ``(span, value)`` tuples
+    :param key: a function that gets the key of a span and a suffix,
+     by default ``span.key + suffix``
+    :return: a ``(keys, args)`` tuple
+    """
+    keys, args = [], [command]
+    for span, value in values:
+        keys.append(key(span, suffix) if key else span.key + suffix)
+        args.append(value)
+        args.append(int(span.expiry) if span.expiry is not None else "")
+    return keys, args
+
+
+class PipelineBatcher(object):
+    """
+    Collects the commands of concurrent callers and sends them to redis
+    in a single pipeline from a background thread. A pipeline is sent
+    ``window`` seconds after the first command of a batch was queued, or
+    as soon as ``max_commands`` are queued.
+
+    :param redis: a :class:`redis.Redis` client
+    :param window: how long to wait for more commands
+    :param max_commands: the largest number of commands in a pipeline
+    """
+
+    def __init__(self, redis, window=0.002, max_commands=1000):
+        self.redis = redis
+        self.window = window
+        self.max_commands = max_commands
+        self.condition = threading.Condition()
+        self.pending = []
+        self.size = 0
+        self.sender = None
+
+    def submit(self, calls):
+        """
+        Queues calls for the next pipeline.
+
+        :param calls: a list of callables that queue commands on the
+         pipeline that they are given
+        :return: a :class:`PipelineRequest` to :meth:`wait` for
+        """
+        request = PipelineRequest(calls)
+        with self.condition:
+            self.pending.append(request)
+            self.size += len(calls)
+            if self.sender is None:
+                self.sender = threading.Thread(target=self.__send_batches)
+                self.sender.daemon = True
+                self.sender.start()
+            elif len(self.pending) == 1 or self.size >= self.max_commands:
+                self.condition.notify()
+        return request
+
+    def execute(self, calls):
+        """
+        Queues calls and waits for their results, see :meth:`submit`.
+        """
+        return self.submit(calls).wait()
+
+    def __send_batches(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.condition.wait(1)
+                    if not self.pending:
+                        self.sender = None
+                        return
+                deadline = time.time() + self.window
+                while self.size < self.max_commands:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, self.pending, self.size = self.pending, [], 0
+            self.__send(batch)
+
+    def __send(self, batch):
+        try:
+            with self.redis.pipeline(transaction=False) as pipeline:
+                sizes = []
+                for request in batch:
+                    for call in request.calls:
+                        size = len(pipeline)
+                        call(pipeline)
+                        sizes.append(len(pipeline) - size)
+                results = iter(pipeline.execute(raise_on_error=False))
+        except Exception as error:
+            for request in batch:
+                request.resolve(None, error)
+            return
+        sizes = iter(sizes)
+        for request in batch:
+            request_results, error = [], None
+            for _ in request.calls:
+                result = None
+                for _ in range(next(sizes)):
+                    result = next(results)
+                    if isinstance(result, Exception):
+                        error = error or result
+                request_results.append(result)
+            request.resolve(request_results, error)
+
+
+class PipelineRequest(object):
+    """
+    The calls of one caller of :meth:`PipelineBatcher.submit`.
+    """
+
+    def __init__(self, calls):
+        self.calls = calls
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+    def resolve(self, results, error):
+        self.results, self.error = results, error
+        self.done.set()
+
+    def wait(self):
+        """
+        Waits for the pipeline that the calls were sent in.
+
+        :return: a list with the result of the last command queued by
+         each call
+        """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.results
 
 
 class RedisStorage(Storage):
-    def __init__(self, redis):
+    """
+    Every write is a single call to :data:`WRITE_SCRIPT` that updates
+    all the spans it was given and sets their expiry when they are
+    created.
+
+    In cluster mode the namespace of a span is used as the hash tag of its
+    keys (``{views:user:1}:2015-01-01_10:00:c``) so that all the spans of
+    a namespace are stored in the same slot. Writes then make one script
+    call per namespace and batched operations send one pipeline to each
+    node of a :class:`redis.cluster.RedisCluster` client.
+
+    When ``batch_window`` is set the commands of concurrent callers are
+    sent to each node in shared pipelines by a :class:`PipelineBatcher`.
+
+    :param redis: a :class:`redis.Redis` or
+     :class:`redis.cluster.RedisCluster` client
+    :param cluster: whether to use hash tagged keys
+    :param batch_window: how long to collect commands for a shared
+     pipeline, ``None`` to send the commands of every call on their own
+    :param batch_size: the largest number of commands in a shared
+     pipeline
+    :param topk_capacity: the number of items that the top-k sorted set
+     of a span keeps, see :data:`TOPK_SCRIPT`
+    :param count_min_prefixes: namespace prefixes whose spans are counted
+     in a Count-Min sketch per span (a hash of at most ``width * depth``
+     fields) instead of a key per namespace, see
+     :class:`sifr.cms.CountMinPrefixes`
+    :param track_limit: the largest number of identifiers tracked per
+     span, see :data:`TRACK_SCRIPT` and :class:`MemoryStorage`
+    :param track_policy: one of :data:`TRACK_POLICIES`
+    """
+
+    def __init__(self, redis, cluster=False, batch_window=None,
+                 batch_size=1000, topk_capacity=100,
+                 count_min_prefixes=None, track_limit=None,
+                 track_policy="first"):
+        if track_policy not in TRACK_POLICIES:
+            raise ValueError("Unknown track policy: %s" % track_policy)
         self.redis = redis
+        self.cluster = cluster
+        self.write_script = redis.register_script(WRITE_SCRIPT)
+        self.topk_script = redis.register_script(TOPK_SCRIPT)
+        self.topk_capacity = topk_capacity
+        self.count_min_script = redis.register_script(COUNT_MIN_SCRIPT)
+        self.count_min = CountMinPrefixes(count_min_prefixes)
+        self.track_script = redis.register_script(TRACK_SCRIPT)
+        self.track_limit = track_limit
+        self.track_policy = track_policy
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.batchers = {}
+        self.batchers_lock = threading.Lock()
+
+    def key(self, span, suffix):
+        """
+        Gets the redis key of a span.
+
+        :param suffix: ``:c``, ``:u``, ``:t``, ``:s``, ``:h``, ``:k`` or
+         ``:m``
+        """
+        if self.cluster:
+            return "{%s}:%s%s" % (span.namespace, span.timestamp, suffix)
+        return span.key + suffix
+
+    def slot(self, key):
+        """
+        Gets the cluster slot of a key.
+        """
+        from redis.crc import key_slot
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        return key_slot(key)
+
+    def node(self, key):
+        """
+        Gets the client of the node that serves ``key``.
+        """
+        if not hasattr(self.redis, "get_node_from_key"):
+            return self.redis
+        return self.redis.get_node_from_key(key).redis_connection
+
+    def pipelined(self, calls):
+        """
+        Runs commands in one pipeline per node.
+
+        :param calls: a list of ``(key, call)`` tuples where ``call``
+         queues the commands for ``key`` on the pipeline it is given
+        :return: a list with the result of the last command queued by
+         each call
+        """
+        nodes = {}
+        for index, (key, call) in enumerate(calls):
+            node = self.node(key)
+            nodes.setdefault(id(node), (node, []))[1].append((index, call))
+        results = [None] * len(calls)
+        if self.batch_window is not None:
+            requests = [
+                (node_calls, self.batcher(node).submit(
+                    [call for _, call in node_calls]
+                ))
+                for node, node_calls in nodes.values()
+            ]
+            for node_calls, request in requests:
+                for (index, _), result in zip(node_calls, request.wait()):
+                    results[index] = result
+            return results
+        for node, node_calls in nodes.values():
+            with node.pipeline(transaction=False) as pipeline:
+                sizes = []
+                for _, call in node_calls:
+                    size = len(pipeline)
+                    call(pipeline)
+                    sizes.append(len(pipeline) - size)
+                node_results = iter(pipeline.execute())
+                for (index, _), size in zip(node_calls, sizes):
+                    for _ in range(size):
+                        results[index] = next(node_results)
+        return results
+
+    def batcher(self, node):
+        """
+        Gets the :class:`PipelineBatcher` of a node.
+        """
+        with self.batchers_lock:
+            if id(node) not in self.batchers:
+                self.batchers[id(node)] = PipelineBatcher(
+                    node, self.batch_window, self.batch_size
+                )
+            return self.batchers[id(node)]
+
+    def by_namespace(self, spans):
+        """
+        Groups spans by namespace (and therefore slot in cluster mode).
+        """
+        namespaces = OrderedDict()
+        for span in spans:
+            namespaces.setdefault(span.namespace, []).append(span)
+        return list(namespaces.values())
+
+    def by_slot(self, values):
+        """
+        Groups ``(span, value)`` tuples so that the keys of each group can
+        be passed to a single script call: all of them outside of cluster
+        mode, by namespace in cluster mode.
+        """
+        if not self.cluster:
+            return [values]
+        namespaces = OrderedDict()
+        for span, value in values:
+            namespaces.setdefault(span.namespace, []).append((span, value))
+        return list(namespaces.values())
+
+    def run_script(self, script, calls):
+        """
+        Runs a script once for each of ``calls``, in one pipeline per
+        node unless there is a single call to make.
+
+        :param script: a script registered with the redis client
+        :param calls: a list of ``(keys, args)`` tuples
+        """
+        if len(calls) == 1 and self.batch_window is None:
+            keys, args = calls[0]
+            return [script(keys=keys, args=args)]
+        return self.pipelined([
+            (keys[0], lambda pipeline, keys=keys, args=args: (
+                script(keys=keys, args=args, client=pipeline)
+            ))
+            for keys, args in calls
+        ])
+
+    def write(self, command, suffix, values):
+        """
+        Writes values to several spans in one round trip.
+
+        :param command: ``incrby``, ``pfadd`` or ``sadd``
+        :param suffix: the suffix of the span keys
+        :param values: an iterable of ``(span, value)`` tuples
+        """
+        values = list(values)
+        if values:
+            self.run_script(self.write_script, [
+                script_arguments(command, suffix, group, self.key)
+                for group in self.by_slot(values)
+            ])
 
     def track(self, span, identifier):
-        with self.redis.pipeline(transaction=False) as pipeline:
-            pipeline.sadd(span.key + ":t", identifier)
-            pipeline.expire(span.key + ":t",
-                            int(span.expiry) - int(time.time()))
-            pipeline.execute()
+        self.track_multi([span], identifier)
 
     def track_multi(self, spans, identifier):
-        with self.redis.pipeline(transaction=False) as pipeline:
-            for span in spans:
-                pipeline.sadd(span.key + ":t", identifier)
-                if span.expiry is not None:
-                    pipeline.expire(
-                        span.key + ":t",
-                        int(span.expiry) - int(time.time())
-                    )
-            pipeline.execute()
+        if self.track_limit is None:
+            self.write("sadd", ":t", ((span, identifier) for span in spans))
+            return
+        suffix = ":s" if self.track_policy == "reservoir" else ":t"
+        groups = self.by_slot([(span, None) for span in spans])
+        calls = []
+        for group in groups:
+            keys = []
+            for span, _ in group:
+                keys.extend([self.key(span, suffix), self.key(span, ":h")])
+            args = [
+                identifier, self.track_limit, self.track_policy,
+                sample_score(identifier)
+            ] + [
+                int(span.expiry) if span.expiry is not None else ""
+                for span, _ in group
+            ]
+            calls.append((keys, args))
+        full = [
+            group[int(index) - 1][0]
+            for group, indexes in zip(
+                groups, self.run_script(self.track_script, calls)
+            )
+            for index in indexes
+        ]
+        if full:
+            raise TrackLimitExceeded(full)
+
+    def incr_topk(self, spans, item, amount=1):
+        calls = []
+        for group in self.by_slot([(span, None) for span in spans]):
+            keys = [self.key(span, ":k") for span, _ in group]
+            args = [item, amount, self.topk_capacity] + [
+                int(span.expiry) if span.expiry is not None else ""
+                for span, _ in group
+            ]
+            calls.append((keys, args))
+        if calls:
+            self.run_script(self.topk_script, calls)
+
+    def top_k(self, span, k):
+        if self.batch_window is None:
+            items = self.redis.zrevrange(
+                self.key(span, ":k"), 0, k - 1, withscores=True
+            )
+        else:
+            items = self.pipelined([(
+                self.key(span, ":k"),
+                lambda pipeline: pipeline.zrevrange(
+                    self.key(span, ":k"), 0, k - 1, withscores=True
+                )
+            )])[0]
+        return [(item, int(count)) for item, count in items]
+
+    def read(self, command, key):
+        """
+        Runs a single read command, in a shared pipeline when batching.
+        """
+        if self.batch_window is None:
+            return getattr(self.redis, command)(key)
+        return self.pipelined([
+            (key, lambda pipeline: getattr(pipeline, command)(key))
+        ])[0]
 
     def uniques(self, span):
-        return self.redis.smembers(span.key + ":t") or set()
+        if self.track_limit is not None and self.track_policy == "reservoir":
+            key = self.key(span, ":s")
+            if self.batch_window is None:
+                return set(self.redis.zrange(key, 0, -1))
+            return set(self.pipelined([
+                (key, lambda pipeline: pipeline.zrange(key, 0, -1))
+            ])[0])
+        return self.read("smembers", self.key(span, ":t")) or set()
+
+    def tracked_cardinality(self, span):
+        if self.track_limit is None:
+            return int(self.read("scard", self.key(span, ":t")) or 0)
+        return int(self.read("pfcount", self.key(span, ":h")) or 0)
 
     def count(self, span):
-        value = self.redis.get(span.key + ":c")
+        if self.count_min.prefixes:
+            return self.count_many([span])[0]
+        value = self.read("get", self.key(span, ":c"))
         return int(value) if value is not None else 0
 
     def incr_unique(self, span, identifier):
-        with self.redis.pipeline(transaction=False) as pipeline:
-            pipeline.pfadd(span.key + ":u", identifier)
-            pipeline.expire(span.key + ":u",
-                            int(span.expiry) - int(time.time()))
-            pipeline.execute()
+        self.incr_unique_multi([span], identifier)
 
     def incr_unique_multi(self, spans, identifier):
-        with self.redis.pipeline(transaction=False) as pipeline:
-            for span in spans:
-                pipeline.pfadd(span.key + ":u", identifier)
-                if span.expiry is not None:
-                    pipeline.expire(
-                        span.key + ":u",
-                        int(span.expiry) - int(time.time())
-                    )
-            pipeline.execute()
+        self.write("pfadd", ":u", ((span, identifier) for span in spans))
 
     def incr(self, span, amount=1):
-        with self.redis.pipeline(transaction=False) as pipeline:
-            pipeline.incr(span.key + ":c")
-            if span.expiry is not None:
-                pipeline.expire(
-                    span.key + ":c",
-                    int(span.expiry) - int(time.time())
-                )
-            pipeline.execute()
+        self.incr_spans([(span, amount)])
 
     def incr_multi(self, spans, amount=1):
-        with self.redis.pipeline(transaction=False) as pipeline:
-            for span in spans:
-                pipeline.incr(span.key + ":c")
-                if span.expiry is not None:
-                    pipeline.expire(
-                        span.key + ":c",
-                        int(span.expiry) - int(time.time())
-                    )
-            pipeline.execute()
+        self.incr_spans((span, amount) for span in spans)
+
+    def incr_spans(self, amounts):
+        if not self.count_min.prefixes:
+            self.write("incrby", ":c", amounts)
+            return
+        counters, sketches = [], []
+        for span, amount in amounts:
+            sketch = self.count_min.sketch(span)
+            if sketch is None:
+                counters.append((span, amount))
+            else:
+                sketches.append((sketch, (span.namespace, amount)))
+        self.write("incrby", ":c", counters)
+        if sketches:
+            self.run_script(self.count_min_script, [
+                self.__count_min_arguments(group)
+                for group in self.by_slot(sketches)
+            ])
+
+    def __count_min_arguments(self, values):
+        keys, args = [], []
+        for sketch, (namespace, amount) in values:
+            keys.append(self.key(sketch, ":m"))
+            args.extend([
+                int(sketch.expiry) if sketch.expiry is not None else "",
+                amount, sketch.depth
+            ])
+            args.extend(cells(namespace, sketch.width, sketch.depth))
+        return keys, args
 
     def cardinality(self, span):
-        value = self.redis.pfcount(span.key + ":u")
+        value = self.read("pfcount", self.key(span, ":u"))
         return int(value) if value is not None else 0
 
+    def count_many(self, spans):
+        spans = list(spans)
+        if not spans:
+            return []
+        sketches = [self.count_min.sketch(span) for span in spans]
+        if any(sketches):
+            return self.__count_sketches(spans, sketches)
+        if not self.cluster and self.batch_window is None:
+            values = self.redis.mget([self.key(span, ":c") for span in spans])
+        else:
+            values = {}
+            groups = [
+                [self.key(span, ":c") for span in group]
+                for group in self.by_namespace(spans)
+            ]
+            results = self.pipelined([
+                (keys[0], lambda pipeline, keys=keys: pipeline.mget(keys))
+                for keys in groups
+            ])
+            for keys, result in zip(groups, results):
+                values.update(zip(keys, result))
+            values = [values[self.key(span, ":c")] for span in spans]
+        return [int(value) if value is not None else 0 for value in values]
+
+    def __count_sketches(self, spans, sketches):
+        """
+        Counts spans of which some are counted by sketches, a cell that
+        doesn't exist counts as 0.
+        """
+        counters = [
+            span for span, sketch in zip(spans, sketches) if sketch is None
+        ]
+        counts = iter(self.count_many(counters) if counters else [])
+        calls = []
+        for span, sketch in zip(spans, sketches):
+            if sketch is not None:
+                key = self.key(sketch, ":m")
+                fields = cells(span.namespace, sketch.width, sketch.depth)
+                calls.append((key, lambda pipeline, key=key, fields=fields: (
+                    pipeline.hmget(key, fields)
+                )))
+        cell_values = iter(self.pipelined(calls))
+        results = []
+        for sketch in sketches:
+            if sketch is None:
+                results.append(next(counts))
+            else:
+                results.append(min(
+                    int(value) if value is not None else 0
+                    for value in next(cell_values)
+                ))
+        return results
+
+    def cardinality_many(self, spans):
+        keys = [self.key(span, ":u") for span in spans]
+        return [
+            int(value) if value is not None else 0
+            for value in self.pipelined([
+                (key, lambda pipeline, key=key: pipeline.pfcount(key))
+                for key in keys
+            ])
+        ]
+
+    def cardinality_union(self, spans):
+        return self.cardinality_unions([spans])[0]
+
+    def cardinality_unions(self, groups):
+        groups = [[self.key(span, ":u") for span in spans] for spans in groups]
+        results = [0] * len(groups)
+        indexes, calls = [], []
+        for index, keys in enumerate(groups):
+            if not keys:
+                continue
+            if self.cluster and len(set(map(self.slot, keys))) > 1:
+                results[index] = self.__cross_slot_union(keys)
+            else:
+                indexes.append(index)
+                calls.append((keys[0], lambda pipeline, keys=keys: (
+                    pipeline.pfcount(*keys)
+                )))
+        for index, value in zip(indexes, self.pipelined(calls)):
+            results[index] = int(value or 0)
+        return results
+
+    def __cross_slot_union(self, keys):
+        """
+        PFCOUNT only accepts keys from the same slot, the sketches in the
+        other slots are copied next to the first key for the duration of
+        the count.
+        """
+        slot = self.slot(keys[0])
+        local = [key for key in keys if self.slot(key) == slot]
+        remote = [key for key in keys if self.slot(key) != slot]
+        dumps = self.pipelined([
+            (key, lambda pipeline, key=key: pipeline.dump(key))
+            for key in remote
+        ])
+        tag = keys[0][1:keys[0].index("}")]
+        copies = [
+            ("{%s}:union:%s:%d" % (tag, uuid.uuid4().hex, index), dump)
+            for index, dump in enumerate(dumps) if dump is not None
+        ]
+
+        def count(pipeline):
+            for copy, dump in copies:
+                pipeline.restore(copy, 60000, dump)
+            pipeline.pfcount(*(local + [copy for copy, _ in copies]))
+            if copies:
+                pipeline.delete(*[copy for copy, _ in copies])
+
+        with self.node(keys[0]).pipeline(transaction=False) as pipeline:
+            count(pipeline)
+            results = pipeline.execute()
+        return int(results[len(copies)] or 0)
+
 
 class RiakStorage(Storage):
-    def __init__(self, riak):
+    """
+    Stores the spans of a namespace in one riak map per namespace.
+    Operations that touch several namespaces fetch and store their maps
+    concurrently on a pool of ``max_workers`` threads, which share the
+    connection pool of the riak client.
+
+    Riak doesn't expire the fields of a map, so with ``partitioned`` the
+    maps are split by a coarser period (see :attr:`PARTITIONS`), e.g.
+    ``views:user:1@2015-01-01`` holds the minutes of a day. The
+    partitions are recorded in an index so that :meth:`sweep` can delete
+    them once all of their spans have expired.
+
+    :param riak: a :class:`riak.RiakClient`
+    :param max_workers: the number of maps to fetch or store concurrently
+    :param partitioned: whether to partition the maps by time
+    """
+
+    #: the span that the maps of each resolution are partitioned by
+    PARTITIONS = {Minute: Day, Hour: Month, Day: Year, Month: Year}
+
+    def __init__(self, riak, max_workers=8, partitioned=False):
         self.riak = riak
         self.counter_bucket = self.riak.bucket_type(
             "maps"
@@ -217,70 +1435,488 @@ class RiakStorage(Storage):
         self.uniques_bucket = self.riak.bucket_type(
             "maps"
         ).bucket("sifr_uniques")
+        self.partitions_bucket = self.riak.bucket_type(
+            "maps"
+        ).bucket("sifr_partitions")
+        self.max_workers = max_workers
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.partitioned = partitioned
+        self.indexed = set()
+
+    def parallel(self, function, items):
+        """
+        Calls ``function`` for every item on the thread pool.
+
+        :return: the list of results in the same order as ``items``
+        """
+        items = list(items)
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [function(item) for item in items]
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.max_workers)
+        return self.pool.map(function, items)
+
+    def close(self):
+        """
+        Stops the thread pool.
+        """
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
 
     def count(self, span):
-        map = self.counter_bucket.get(span.namespace)
-        counter = map.counters.get(span.timestamp)
-        return counter.value
+        return self.count_many([span])[0]
 
     def incr(self, span, amount=1):
-        map = self.counter_bucket.new(span.namespace)
-        counter = map.counters.get(span.timestamp)
-        counter.increment()
-        map.store()
+        self.incr_spans([(span, amount)])
+
+    def map_key(self, span):
+        """
+        Gets the key of the map that holds ``span``.
+        """
+        partition = self.partitioned and self.PARTITIONS.get(span.__class__)
+        if not partition:
+            return span.namespace
+        return "%s@%s" % (span.namespace, partition.format(span.at))
+
+    def partition_expiry(self, span):
+        """
+        Gets the day (``YYYY-MM-DD``) after which every span in the
+        partition of ``span`` has expired.
+        """
+        partition = self.PARTITIONS[span.__class__](span.at, [])
+        expiry = to_timestamp(
+            to_seconds(partition.range[1]) + span.__class__.retention
+        )
+        return Day.format(datetime.datetime.fromtimestamp(expiry))
+
+    def index_partitions(self, bucket, spans):
+        """
+        Records the partitions of ``spans`` that this storage hasn't
+        written to before in the index used by :meth:`sweep`.
+        """
+        days = {}
+        for span in spans:
+            key = self.map_key(span)
+            if key == span.namespace or (bucket.name, key) in self.indexed:
+                continue
+            days.setdefault(self.partition_expiry(span), set()).add(key)
+        if not days:
+            return
+        index = self.partitions_bucket.new(bucket.name)
+        for day, keys in days.items():
+            for key in keys:
+                index.sets[day].add(key)
+        index.store()
+        if len(self.indexed) > 100000:
+            self.indexed.clear()
+        self.indexed.update(
+            (bucket.name, key) for keys in days.values() for key in keys
+        )
+
+    def sweep(self, now=None):
+        """
+        Deletes the partitions of which every span has expired.
+
+        :param now: the current time
+        :return: the number of maps that were deleted
+        """
+        today = Day.format(now or datetime.datetime.now())
+        deleted = 0
+        for bucket in [
+            self.counter_bucket, self.unique_counters_bucket,
+            self.uniques_bucket
+        ]:
+            index = self.partitions_bucket.get(bucket.name)
+            expired = [day for day in index.sets if day < today]
+            for day in expired:
+                keys = list(index.sets[day].value)
+                self.parallel(bucket.delete, keys)
+                deleted += len(keys)
+                del index.sets[day]
+            if expired:
+                index.store()
+        return deleted
 
     def get_maps(self, bucket, spans, create=False):
-        maps = {}
-        namespaces = set(span.namespace for span in spans)
-        for namespace in namespaces:
-            if create:
-                maps[namespace] = bucket.new(namespace)
-            else:
-                maps[namespace] = bucket.get(namespace)
-        return maps
+        keys = {}
+        for span in spans:
+            keys.setdefault(self.map_key(span), span)
+        if create:
+            if self.partitioned:
+                self.index_partitions(bucket, keys.values())
+            return dict((key, bucket.new(key)) for key in keys)
+        return dict(zip(keys, self.parallel(bucket.get, list(keys))))
+
+    def store_maps(self, maps):
+        """
+        Stores several maps concurrently.
+
+        :param maps: the maps returned by :meth:`get_maps`
+        """
+        self.parallel(lambda map: map.store(), maps.values())
 
     def track_multi(self, spans, identifier):
         maps = self.get_maps(self.uniques_bucket, spans, True)
         for span in spans:
-            riak_set = maps[span.namespace].sets.get(span.timestamp)
+            riak_set = maps[self.map_key(span)].sets.get(span.timestamp)
             riak_set.add(str(identifier))
-        for map in maps.values():
-            map.store()
+        self.store_maps(maps)
 
     def incr_unique_multi(self, spans, identifier):
         maps = self.get_maps(self.unique_counters_bucket, spans, True)
         for span in spans:
-            counter = maps[span.namespace].sets.get(span.timestamp)
+            counter = maps[self.map_key(span)].sets.get(span.timestamp)
             counter.add(str(identifier))
-        for map in maps.values():
-            map.store()
+        self.store_maps(maps)
 
     def track(self, span, identifier):
-        map = self.uniques_bucket.new(span.namespace)
-        riak_set = map.sets.get(span.timestamp)
-        riak_set.add(str(identifier))
-        map.store()
+        self.track_multi([span], identifier)
 
     def incr_unique(self, span, identifier):
-        map = self.unique_counters_bucket.new(span.namespace)
-        riak_set = map.sets.get(span.timestamp)
-        riak_set.add(str(identifier))
-        map.store()
+        self.incr_unique_multi([span], identifier)
 
     def incr_multi(self, spans, amount=1):
-        maps = self.get_maps(self.counter_bucket, spans, True)
-        for span in spans:
-            counter = maps[span.namespace].counters.get(span.timestamp)
+        self.incr_spans((span, amount) for span in spans)
+
+    def incr_spans(self, amounts):
+        amounts = list(amounts)
+        maps = self.get_maps(
+            self.counter_bucket, [span for span, _ in amounts], True
+        )
+        for span, amount in amounts:
+            counter = maps[self.map_key(span)].counters.get(span.timestamp)
             counter.increment(amount)
-        for map in maps.values():
-            map.store()
+        self.store_maps(maps)
 
     def cardinality(self, span):
-        map = self.unique_counters_bucket.get(span.namespace)
-        riak_set = map.sets.get(span.timestamp)
-        return len(riak_set)
+        return self.cardinality_many([span])[0]
+
+    def count_many(self, spans):
+        spans = list(spans)
+        maps = self.get_maps(self.counter_bucket, spans)
+        return [
+            maps[self.map_key(span)].counters.get(span.timestamp).value
+            for span in spans
+        ]
+
+    def cardinality_many(self, spans):
+        spans = list(spans)
+        maps = self.get_maps(self.unique_counters_bucket, spans)
+        return [
+            len(maps[self.map_key(span)].sets.get(span.timestamp))
+            for span in spans
+        ]
+
+    def cardinality_union(self, spans):
+        return self.cardinality_unions([spans])[0]
+
+    def cardinality_unions(self, groups):
+        groups = [list(spans) for spans in groups]
+        maps = self.get_maps(
+            self.unique_counters_bucket, list(itertools.chain(*groups))
+        )
+        return [
+            len(set().union(*[
+                maps[self.map_key(span)].sets.get(span.timestamp).value
+                for span in spans
+            ]))
+            for spans in groups
+        ]
 
     def uniques(self, span):
-        map = self.uniques_bucket.get(span.namespace)
+        map = self.uniques_bucket.get(self.map_key(span))
         riak_set = map.sets.get(span.timestamp)
         return riak_set.value
+
+
+class BufferedStorage(Storage):
+    """
+    Write behind wrapper around another :class:`Storage`. Writes are
+    aggregated locally and flushed to the wrapped storage in bulk by a
+    background thread. Reads include the writes that haven't been flushed
+    yet. Writes that fail to flush are kept and retried by the next flush.
+
+    Reads don't wait for flushes, except for counts of spans that the
+    flush in progress is writing. Without a lock around the write there is
+    no telling whether the wrapped storage already includes those counts.
+
+    :param storage: the :class:`Storage` to flush to
+    :param flush_interval: seconds between background flushes
+    :param max_pending: number of pending span updates after which the
+     writer flushes synchronously
+    """
+
+    def __init__(self, storage, flush_interval=1.0, max_pending=10000):
+        self.storage = storage
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.lock = threading.RLock()
+        self.flush_lock = threading.RLock()
+        self.counts = {}
+        self.unique_identifiers = {}
+        self.tracked_identifiers = {}
+        self.pending = 0
+        # the updates taken by the latest flush, incremented generation
+        # and whether they are still being written
+        self.batch = ({}, {}, {})
+        self.generation = 0
+        self.writing = False
+        self.written = threading.Condition(self.lock)
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.__flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+        super(BufferedStorage, self).__init__()
+
+    def __flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "failed to flush buffered writes"
+                )
+
+    def __maybe_flush(self):
+        if self.pending >= self.max_pending:
+            self.flush()
+
+    def __add_identifier(self, pending, span, identifier):
+        with self.lock:
+            entry = pending.setdefault(span.key, [span, set()])
+            entry[0] = span
+            if identifier not in entry[1]:
+                entry[1].add(identifier)
+                self.pending += 1
+
+    @staticmethod
+    def __by_identifier(pending):
+        spans = {}
+        for span, identifiers in pending.values():
+            for identifier in identifiers:
+                spans.setdefault(identifier, []).append(span)
+        return spans.items()
+
+    def flush(self):
+        """
+        Writes all the pending updates to the wrapped storage.
+        """
+        with self.flush_lock:
+            with self.lock:
+                self.batch = (
+                    self.counts, self.unique_identifiers,
+                    self.tracked_identifiers
+                )
+                self.counts = {}
+                self.unique_identifiers = {}
+                self.tracked_identifiers = {}
+                self.pending = 0
+                self.generation += 1
+                self.writing = True
+            counts, unique_identifiers, tracked_identifiers = self.batch
+            try:
+                self.__write(counts, unique_identifiers, tracked_identifiers)
+            finally:
+                with self.lock:
+                    self.writing = False
+                    self.written.notify_all()
+
+    def __write(self, counts, unique_identifiers, tracked_identifiers):
+        try:
+            if counts:
+                self.storage.incr_spans(counts.values())
+        except Exception:
+            self.__restore(counts, unique_identifiers, tracked_identifiers)
+            raise
+        try:
+            for identifier, spans in self.__by_identifier(unique_identifiers):
+                self.storage.incr_unique_multi(spans, identifier)
+            for identifier, spans in self.__by_identifier(
+                tracked_identifiers
+            ):
+                try:
+                    self.storage.track_multi(spans, identifier)
+                except TrackLimitExceeded:
+                    # the caller has returned, rejected identifiers are
+                    # only counted by tracked_cardinality
+                    pass
+        except Exception:
+            # adding identifiers again is harmless, so all of them are
+            # retried
+            self.__restore({}, unique_identifiers, tracked_identifiers)
+            raise
+
+    def __restore(self, counts, unique_identifiers, tracked_identifiers):
+        """
+        Merges updates that failed to be written back into the pending
+        updates.
+        """
+        with self.lock:
+            for key, (span, amount) in counts.items():
+                entry = self.counts.get(key)
+                if entry is None:
+                    self.counts[key] = [span, amount]
+                    self.pending += 1
+                else:
+                    entry[1] += amount
+            self.__merge_identifiers(
+                unique_identifiers, self.unique_identifiers
+            )
+            self.__merge_identifiers(
+                tracked_identifiers, self.tracked_identifiers
+            )
+
+    def __merge_identifiers(self, failed, pending):
+        for key, (span, identifiers) in failed.items():
+            entry = pending.setdefault(key, [span, set()])
+            added = identifiers - entry[1]
+            entry[1].update(added)
+            self.pending += len(added)
+
+    def close(self):
+        """
+        Stops the background flush and writes the pending updates.
+        """
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
+
+    def incr(self, span, amount=1):
+        self.incr_spans([(span, amount)])
+
+    def incr_multi(self, spans, amount=1):
+        self.incr_spans((span, amount) for span in spans)
+
+    def incr_spans(self, amounts):
+        with self.lock:
+            for span, amount in amounts:
+                entry = self.counts.get(span.key)
+                if entry is None:
+                    self.counts[span.key] = [span, amount]
+                    self.pending += 1
+                else:
+                    entry[0] = span
+                    entry[1] += amount
+        self.__maybe_flush()
+
+    def incr_unique(self, span, identifier):
+        self.incr_unique_multi([span], identifier)
+
+    def incr_unique_multi(self, spans, identifier):
+        for span in spans:
+            self.__add_identifier(self.unique_identifiers, span, identifier)
+        self.__maybe_flush()
+
+    def track(self, span, identifier):
+        self.track_multi([span], identifier)
+
+    def track_multi(self, spans, identifier):
+        for span in spans:
+            self.__add_identifier(self.tracked_identifiers, span, identifier)
+        self.__maybe_flush()
+
+    def count(self, span):
+        return self.count_many([span])[0]
+
+    def count_many(self, spans):
+        spans = list(spans)
+        keys = set(span.key for span in spans)
+        while True:
+            with self.lock:
+                while self.writing and keys.intersection(self.batch[0]):
+                    self.written.wait()
+                generation = self.generation
+            counts = self.storage.count_many(spans)
+            with self.lock:
+                # a flush that started during the read may or may not be
+                # included in it, unless it had no counts of the spans
+                if self.generation == generation or (
+                    self.generation == generation + 1
+                    and not keys.intersection(self.batch[0])
+                ):
+                    return [
+                        count + self.counts.get(span.key, (span, 0))[1]
+                        for span, count in zip(spans, counts)
+                    ]
+
+    def cardinality(self, span):
+        return self.cardinality_many([span])[0]
+
+    def __flush_uniques(self, spans):
+        self.__flush_identifiers(
+            self.unique_identifiers, spans, self.storage.incr_unique_multi
+        )
+
+    def __flush_identifiers(self, identifiers, spans, write):
+        """
+        Writes the pending identifiers of ``spans`` with ``write``, the
+        flush lock must be held.
+        """
+        with self.lock:
+            pending = dict(
+                (span.key, identifiers.pop(span.key))
+                for span in spans if span.key in identifiers
+            )
+            self.pending -= sum(
+                len(span_identifiers)
+                for _, span_identifiers in pending.values()
+            )
+        try:
+            for identifier, pending_spans in self.__by_identifier(pending):
+                write(pending_spans, identifier)
+        except Exception:
+            with self.lock:
+                self.__merge_identifiers(pending, identifiers)
+            raise
+
+    def cardinality_many(self, spans):
+        spans = list(spans)
+        with self.flush_lock:
+            self.__flush_uniques(spans)
+            return self.storage.cardinality_many(spans)
+
+    def cardinality_union(self, spans):
+        spans = list(spans)
+        with self.flush_lock:
+            self.__flush_uniques(spans)
+            return self.storage.cardinality_union(spans)
+
+    def cardinality_unions(self, groups):
+        groups = [list(spans) for spans in groups]
+        with self.flush_lock:
+            self.__flush_uniques(list(itertools.chain(*groups)))
+            return self.storage.cardinality_unions(groups)
+
+    def uniques(self, span):
+        # identifiers are taken before the read so that those of a flush
+        # that completes during it aren't missed, sets ignore duplicates
+        pending = set()
+        with self.lock:
+            tracked = [self.tracked_identifiers]
+            if self.writing:
+                tracked.append(self.batch[2])
+            for identifiers in tracked:
+                if span.key in identifiers:
+                    pending.update(identifiers[span.key][1])
+        uniques = set(self.storage.uniques(span))
+        uniques.update(pending)
+        return uniques
+
+    def incr_topk(self, spans, item, amount=1):
+        # Space-Saving sketches don't aggregate exactly, so top-k writes
+        # aren't buffered.
+        self.storage.incr_topk(spans, item, amount)
+
+    def top_k(self, span, k):
+        return self.storage.top_k(span, k)
+
+    def tracked_cardinality(self, span):
+        with self.flush_lock:
+            self.__flush_identifiers(
+                self.tracked_identifiers, [span], self.storage.track_multi
+            )
+            return self.storage.tracked_cardinality(span)
@@ -0,0 +1,79 @@
+import heapq
+import itertools
+
+
+class SpaceSaving(object):
+    """
+    Space-Saving sketch of the most frequent items of a stream. At most
+    ``capacity`` items are counted, when a new item arrives while the
+    sketch is full it replaces the item with the lowest count and
+    inherits that count. The count of every item is therefore an
+    overestimate by at most the lowest count, and any item that occurs
+    more often than ``total / capacity`` times is guaranteed to be kept.
+
+    :param capacity: the number of items to keep
+    """
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.counts = {}
+        # (count, order, item) entries, stale entries are skipped when
+        # popped. order breaks ties without comparing the items.
+        self.heap = []
+        self.order = itertools.count()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, item, amount=1):
+        """
+        Counts an occurrence of an item.
+
+        :param item: any hashable object
+        :param amount: the number of occurrences
+        """
+        if item not in self.counts and len(self.counts) >= self.capacity:
+            while True:
+                count, _, evicted = heapq.heappop(self.heap)
+                if self.counts.get(evicted) == count:
+                    break
+            del self.counts[evicted]
+            amount += count
+        count = self.counts[item] = self.counts.get(item, 0) + amount
+        heapq.heappush(self.heap, (count, next(self.order), item))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [
+                (count, next(self.order), item)
+                for item, count in self.counts.items()
+            ]
+            heapq.heapify(self.heap)
+
+    def top(self, k):
+        """
+        Gets the ``k`` items with the highest counts.
+
+        :return: a list of ``(item, count)`` tuples, highest count first
+        """
+        return heapq.nlargest(
+            k, self.counts.items(), key=lambda item: item[1]
+        )
+
+    def copy(self):
+        """
+        Gets a copy of the sketch.
+        """
+        copy = SpaceSaving(self.capacity)
+        copy.__setstate__(self.__getstate__())
+        return copy
+
+    def __getstate__(self):
+        return self.capacity, dict(self.counts)
+
+    def __setstate__(self, state):
+        self.__init__(state[0])
+        self.counts = state[1]
+        self.heap = [
+            (count, next(self.order), item)
+            for item, count in self.counts.items()
+        ]
+        heapq.heapify(self.heap)
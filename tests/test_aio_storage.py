@@ -0,0 +1,100 @@
+import asyncio
+import unittest
+import datetime
+
+import redis.asyncio
+
+from sifr.aio import AsyncMemoryStorage, AsyncRedisStorage
+from sifr.span import Minute, Hour
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncStorageTestsMixin(object):
+    def test_incr(self):
+        async def test():
+            storage = await self.get_storage()
+            span = Minute(datetime.datetime.now(), ["minute_span"])
+            await asyncio.gather(*[storage.incr(span) for _ in range(10)])
+            await storage.incr_multi([span], 5)
+            await storage.incr_spans([(span, 2)])
+            self.assertEqual(await storage.count(span), 17)
+            self.assertEqual(await storage.count_many([span]), [17])
+        run(test())
+
+    def test_multi(self):
+        async def test():
+            storage = await self.get_storage()
+            spans = [
+                Minute(datetime.datetime.now(), ["minute_span"]),
+                Hour(datetime.datetime.now(), ["minute_span"])
+            ]
+            await asyncio.gather(
+                storage.incr_multi(spans),
+                storage.incr_unique_multi(spans, "1"),
+                storage.incr_unique_multi(spans, "2"),
+                storage.incr_unique(spans[0], "2"),
+                storage.track_multi(spans, "1"),
+                storage.track(spans[1], "2"),
+            )
+            self.assertEqual(await storage.count(spans[0]), 1)
+            self.assertEqual(await storage.cardinality(spans[0]), 2)
+            self.assertEqual(await storage.cardinality(spans[1]), 2)
+            self.assertEqual(await storage.cardinality_union(spans), 2)
+            self.assertEqual(await storage.uniques(spans[0]), set(["1"]))
+            self.assertEqual(
+                await storage.uniques(spans[1]), set(["1", "2"])
+            )
+        run(test())
+
+
+class AsyncMemoryStorageTests(AsyncStorageTestsMixin, unittest.TestCase):
+    async def get_storage(self):
+        return AsyncMemoryStorage()
+
+
+class AsyncRedisStorageTests(AsyncStorageTestsMixin, unittest.TestCase):
+    async def get_storage(self):
+        client = redis.asyncio.Redis(decode_responses=True)
+        await client.flushall()
+        return AsyncRedisStorage(client)
+
+    def test_shared_pipeline(self):
+        async def test():
+            storage = await self.get_storage()
+            span = Minute(datetime.datetime.now(), ["minute_span"])
+            await asyncio.gather(*[storage.incr(span) for _ in range(10)])
+            self.assertTrue(await storage.redis.ttl(span.key + ":c") > 3000)
+            pipelines = []
+            execute = storage.batch.redis.pipeline
+
+            def pipeline(*a, **k):
+                pipelines.append(1)
+                return execute(*a, **k)
+            storage.batch.redis.pipeline = pipeline
+            counts = await asyncio.gather(
+                *[storage.count(span) for _ in range(10)]
+            )
+            self.assertEqual(counts, [10] * 10)
+            self.assertEqual(len(pipelines), 1)
+        run(test())
+
+    def test_write_script(self):
+        async def test():
+            storage = await self.get_storage()
+            span = Minute(datetime.datetime.now(), ["minute_span"])
+            await storage.incr(span, 3)
+            await storage.redis.expire(span.key + ":c", 10)
+            await asyncio.gather(
+                storage.incr(span, 2), storage.incr_unique(span, "1")
+            )
+            self.assertEqual(await storage.count(span), 5)
+            self.assertEqual(await storage.redis.ttl(span.key + ":c"), 10)
+            self.assertTrue(await storage.redis.ttl(span.key + ":u") > 3000)
+        run(test())
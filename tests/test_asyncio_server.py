@@ -0,0 +1,284 @@
+import asyncio
+import datetime
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import unittest
+
+import msgpack
+
+from sifr import RPCClient
+from sifr.daemon.aio import AsyncSifrServer
+from sifr.daemon.workers import (
+    PartitionedSifrServer, PeerConnection, owner, _reap, _spawn
+)
+from sifr.span import Hour, Minute
+from sifr.storage import MemoryStorage
+from tests import get_free_port
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self):
+        super(CountingStorage, self).__init__()
+        self.batches = []
+
+    def incr_spans(self, amounts):
+        amounts = list(amounts)
+        self.batches.append(amounts)
+        super(CountingStorage, self).incr_spans(amounts)
+
+
+class AsyncioServerTests(unittest.TestCase):
+    def setUp(self):
+        self.storage = CountingStorage()
+        self.port = get_free_port()
+        self.loop = asyncio.new_event_loop()
+        self.server = AsyncSifrServer(self.storage)
+        self.listener = self.loop.run_until_complete(
+            self.server.start("127.0.0.1", self.port)
+        )
+        self.server_thread = threading.Thread(target=self.loop.run_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.server_thread.join()
+        self.listener.close()
+        self.loop.close()
+
+    def test_client_server_full_flow(self):
+        cli = RPCClient('127.0.0.1', self.port)
+        cli.incr("foo", 1)
+        self.assertEqual(
+            1,
+            self.storage.count(Hour(datetime.datetime.now(), ["foo"]))
+        )
+        cli.incr("bar", 1, ["minute"])
+        self.assertEqual(
+            0,
+            self.storage.count(Hour(datetime.datetime.now(), ["bar"]))
+        )
+        self.assertEqual(
+            1,
+            self.storage.count(Minute(datetime.datetime.now(), ["bar"]))
+        )
+        self.assertEqual(
+            1,
+            cli.count("foo", datetime.datetime.now(), "hour")
+        )
+        cli.incr_unique("foo", "test")
+        self.assertEqual(
+            1,
+            cli.cardinality("foo", datetime.datetime.now(), "hour")
+        )
+        cli.track("foo", "test")
+        self.assertEqual(
+            set(["test"]),
+            cli.uniques("foo", datetime.datetime.now(), "hour")
+        )
+        self.assertEqual(
+            1,
+            cli.tracked_cardinality("foo", datetime.datetime.now(), "hour")
+        )
+        cli.client.close()
+
+    def test_bounded_tracked_cardinality(self):
+        self.storage.track_limit = 2
+        cli = RPCClient('127.0.0.1', self.port)
+        for identifier in ["a", "b", "c"]:
+            cli.track("foo", identifier)
+        now = datetime.datetime.now()
+        self.assertEqual(len(cli.uniques("foo", now, "hour")), 2)
+        self.assertEqual(cli.tracked_cardinality("foo", now, "hour"), 3)
+        cli.client.close()
+
+    def test_pipelined_requests(self):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        try:
+            sock.sendall(b"".join(
+                msgpack.packb([0, i, "incr", ["foo", ["minute", "hour"], 1]])
+                for i in range(100)
+            ))
+            sock.sendall(msgpack.packb([0, 100, "nope", []]))
+            unpacker = msgpack.Unpacker(raw=False)
+            responses = {}
+            while len(responses) < 101:
+                unpacker.feed(sock.recv(4096))
+                for _, msgid, error, result in unpacker:
+                    responses[msgid] = error, result
+        finally:
+            sock.close()
+        self.assertEqual(
+            [responses[i] for i in range(100)], [(None, None)] * 100
+        )
+        self.assertTrue(responses[100][0].startswith("NameError"))
+        self.assertEqual(
+            100,
+            self.storage.count(Hour(datetime.datetime.now(), ["foo"]))
+        )
+        self.assertTrue(len(self.storage.batches) < 100)
+        self.assertEqual(
+            sum(len(batch) for batch in self.storage.batches),
+            2 * len(self.storage.batches)
+        )
+
+    def test_invalid_batched_call(self):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        try:
+            sock.sendall(b"".join([
+                msgpack.packb([0, 0, "incr", ["foo", ["hour"], 1]]),
+                msgpack.packb([0, 1, "incr", ["foo", ["week"], 1]]),
+                msgpack.packb([0, 2, "incr", ["foo", ["hour"], "1"]]),
+                msgpack.packb([0, 3, "incr_unique", ["foo", ["hour"]]]),
+                msgpack.packb([0, 4, "incr_unique", ["foo", ["hour"], "a"]]),
+                msgpack.packb([0, 5, "incr", ["foo", ["hour"], True]]),
+                msgpack.packb([0, 6, "incr_unique", ["foo", ["hour"], ["b"]]]),
+            ]))
+            unpacker = msgpack.Unpacker(raw=False)
+            responses = {}
+            while len(responses) < 7:
+                unpacker.feed(sock.recv(4096))
+                for _, msgid, error, result in unpacker:
+                    responses[msgid] = error
+        finally:
+            sock.close()
+        self.assertEqual(responses[0], None)
+        self.assertTrue(responses[1].startswith("ValueError"))
+        self.assertTrue(responses[2].startswith("TypeError"))
+        self.assertTrue(responses[3].startswith("ValueError"))
+        self.assertEqual(responses[4], None)
+        self.assertTrue(responses[5].startswith("TypeError"))
+        self.assertTrue(responses[6].startswith("TypeError"))
+        now = datetime.datetime.now()
+        self.assertEqual(self.storage.count(Hour(now, ["foo"])), 1)
+        self.assertEqual(self.storage.cardinality(Hour(now, ["foo"])), 1)
+
+
+class PartitionedServerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        peers = [
+            os.path.join(self.directory, "worker-%d.sock" % i)
+            for i in range(2)
+        ]
+        self.loop = asyncio.new_event_loop()
+        self.storages = [MemoryStorage(), MemoryStorage()]
+        self.ports = [get_free_port(), get_free_port()]
+        self.listeners = []
+        for index, storage in enumerate(self.storages):
+            server = PartitionedSifrServer(storage, index, peers)
+            self.listeners.append(self.loop.run_until_complete(
+                server.start_peer(peers[index])
+            ))
+            self.listeners.append(self.loop.run_until_complete(
+                server.start("127.0.0.1", self.ports[index])
+            ))
+        self.server_thread = threading.Thread(target=self.loop.run_forever)
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.server_thread.join()
+        for listener in self.listeners:
+            listener.close()
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def test_peer_reconnect(self):
+        path = os.path.join(self.directory, "late.sock")
+        peer = PeerConnection(path)
+        peer.connect = lambda: PeerConnection.connect(peer, retries=1)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertRaises(
+                OSError, loop.run_until_complete,
+                peer.call("count", ["foo", 0, "hour"])
+            )
+            server = AsyncSifrServer(MemoryStorage())
+            listener = loop.run_until_complete(asyncio.start_unix_server(
+                lambda reader, writer: server.handle(
+                    reader, writer, server.call
+                ),
+                path
+            ))
+            self.assertEqual(
+                loop.run_until_complete(
+                    peer.call("count", ["foo", 0, "hour"])
+                ),
+                0
+            )
+            peer.writer.close()
+            listener.close()
+        finally:
+            loop.close()
+
+    def test_failed_worker(self):
+        def fail():
+            raise ValueError("bad config")
+
+        handlers = [signal.getsignal(signal.SIGTERM),
+                    signal.getsignal(signal.SIGINT)]
+        try:
+            children = _spawn(
+                fail, "127.0.0.1", get_free_port(),
+                [os.path.join(self.directory, "failing.sock")]
+            )
+            sleeper = os.fork()
+            if sleeper == 0:  # pragma: no cover
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.pause()
+                os._exit(0)
+            self.assertEqual(_reap(children + [sleeper]), 1)
+        finally:
+            signal.signal(signal.SIGTERM, handlers[0])
+            signal.signal(signal.SIGINT, handlers[1])
+
+    def test_owner(self):
+        self.assertEqual(owner("foo", 4), owner(u"foo", 4))
+        self.assertEqual(
+            set(owner("key%d" % i, 4) for i in range(100)),
+            set(range(4))
+        )
+
+    def test_partitioned_keys(self):
+        clients = [RPCClient("127.0.0.1", port) for port in self.ports]
+        keys = ["key%d" % i for i in range(10)]
+        for client in clients:
+            for key in keys:
+                client.incr(key, 1, ["hour"])
+            client.incr_unique("unique", "%d" % clients.index(client))
+        now = datetime.datetime.now()
+        for key in keys:
+            span = Hour(now, [key])
+            self.assertEqual(
+                self.storages[owner(key, 2)].count(span), 2
+            )
+            self.assertEqual(
+                self.storages[1 - owner(key, 2)].count(span), 0
+            )
+            self.assertEqual(
+                [client.count(key, now, "hour") for client in clients],
+                [2, 2]
+            )
+        self.assertEqual(
+            [client.cardinality("unique", now, "hour") for client in clients],
+            [2, 2]
+        )
+        for index, client in enumerate(clients):
+            client.track("tracked", "%d" % index)
+        self.assertEqual(
+            [client.tracked_cardinality("tracked", now, "hour")
+             for client in clients],
+            [2, 2]
+        )
+        self.assertEqual(
+            self.storages[owner("tracked", 2)].tracked_cardinality(
+                Hour(now, ["tracked"])
+            ),
+            2
+        )
+        for client in clients:
+            client.client.close()
@@ -0,0 +1,161 @@
+import unittest
+import datetime
+import time
+import threading
+import hiro
+from sifr.span import Minute, Hour
+from sifr.storage import BufferedStorage, MemoryStorage
+
+
+class FailingStorage(MemoryStorage):
+    def __init__(self):
+        self.failing = set()
+        self.blocked = None
+        super(FailingStorage, self).__init__()
+
+    def incr_spans(self, amounts):
+        amounts = list(amounts)
+        if self.blocked is not None:
+            self.blocked.wait()
+        if "incr_spans" in self.failing:
+            raise IOError("unavailable")
+        super(FailingStorage, self).incr_spans(amounts)
+
+    def incr_unique_multi(self, spans, identifier):
+        if "incr_unique_multi" in self.failing:
+            raise IOError("unavailable")
+        super(FailingStorage, self).incr_unique_multi(spans, identifier)
+
+
+class BufferedStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.inner = MemoryStorage()
+        self.storage = BufferedStorage(self.inner, flush_interval=60)
+
+    def tearDown(self):
+        self.storage.close()
+
+    def test_incr(self):
+        span = Minute(datetime.datetime.now(), ["buffered"])
+        self.storage.incr(span)
+        self.storage.incr_multi([span], 2)
+        self.storage.incr_batch([(["buffered"], span.at, 3)], [Minute])
+        self.assertEqual(self.inner.count(span), 0)
+        self.assertEqual(self.storage.count(span), 6)
+        self.storage.flush()
+        self.assertEqual(self.inner.count(span), 6)
+        self.storage.incr(span)
+        self.assertEqual(self.storage.count(span), 7)
+        self.assertEqual(self.storage.count_many([span]), [7])
+
+    def test_incr_unique(self):
+        spans = [
+            Minute(datetime.datetime.now(), ["buffered"]),
+            Hour(datetime.datetime.now(), ["buffered"])
+        ]
+        self.storage.incr_unique_multi(spans, "1")
+        self.storage.incr_unique(spans[0], "2")
+        self.assertEqual(self.inner.cardinality(spans[0]), 0)
+        self.assertEqual(self.storage.cardinality(spans[0]), 2)
+        self.assertEqual(self.inner.cardinality(spans[1]), 0)
+        self.assertEqual(self.storage.cardinality_many(spans), [2, 1])
+        self.storage.incr_unique(spans[1], "3")
+        self.assertEqual(self.storage.cardinality_union(spans), 3)
+        self.assertEqual(self.storage.cardinality_intersection(spans), 1)
+
+    def test_track(self):
+        spans = [
+            Minute(datetime.datetime.now(), ["buffered"]),
+            Hour(datetime.datetime.now(), ["buffered"])
+        ]
+        self.storage.track_multi(spans, "1")
+        self.storage.flush()
+        self.storage.track(spans[0], "2")
+        self.assertEqual(self.inner.uniques(spans[0]), set(["1"]))
+        self.assertEqual(self.storage.uniques(spans[0]), set(["1", "2"]))
+        self.assertEqual(self.storage.uniques(spans[1]), set(["1"]))
+
+    def test_max_pending(self):
+        storage = BufferedStorage(self.inner, flush_interval=60, max_pending=2)
+        try:
+            now = datetime.datetime.now()
+            storage.incr(Minute(now, ["buffered", 1]))
+            self.assertEqual(self.inner.count(Minute(now, ["buffered", 1])), 0)
+            storage.incr(Minute(now, ["buffered", 2]))
+            self.assertEqual(self.inner.count(Minute(now, ["buffered", 1])), 1)
+            self.assertEqual(self.inner.count(Minute(now, ["buffered", 2])), 1)
+        finally:
+            storage.close()
+
+    def test_background_flush(self):
+        storage = BufferedStorage(self.inner, flush_interval=0.01)
+        try:
+            span = Minute(datetime.datetime.now(), ["buffered"])
+            storage.incr(span)
+            time.sleep(0.1)
+            self.assertEqual(self.inner.count(span), 1)
+        finally:
+            storage.close()
+
+    def test_expiry(self):
+        with hiro.Timeline().freeze() as timeline:
+            span = Minute(datetime.datetime.now(), ["buffered"])
+            self.storage.incr(span)
+            self.storage.flush()
+            timeline.forward((60 * 60) + 1)
+            self.assertEqual(self.storage.count(span), 0)
+
+    def test_failed_flush(self):
+        inner = FailingStorage()
+        storage = BufferedStorage(inner, flush_interval=60)
+        try:
+            span = Minute(datetime.datetime.now(), ["buffered"])
+            storage.incr(span, 2)
+            storage.incr_unique(span, "1")
+            storage.track(span, "1")
+            inner.failing = set(["incr_spans"])
+            self.assertRaises(IOError, storage.flush)
+            storage.incr(span)
+            self.assertEqual(storage.count(span), 3)
+            inner.failing = set(["incr_unique_multi"])
+            self.assertRaises(IOError, storage.flush)
+            self.assertEqual(inner.count(span), 3)
+            self.assertEqual(inner.cardinality(span), 0)
+            inner.failing = set()
+            storage.flush()
+            self.assertEqual(inner.count(span), 3)
+            self.assertEqual(inner.cardinality(span), 1)
+            self.assertEqual(inner.uniques(span), set(["1"]))
+            self.assertEqual(storage.pending, 0)
+        finally:
+            storage.close()
+
+    def test_read_during_flush(self):
+        inner = FailingStorage()
+        storage = BufferedStorage(inner, flush_interval=60)
+        try:
+            now = datetime.datetime.now()
+            flushed, other = Minute(now, ["flushed"]), Minute(now, ["other"])
+            storage.incr(flushed, 2)
+            storage.track(flushed, "1")
+            inner.blocked = threading.Event()
+            flush = threading.Thread(target=storage.flush)
+            flush.start()
+            while not storage.writing:
+                time.sleep(0.001)
+            storage.incr(other)
+            self.assertEqual(storage.count(other), 1)
+            self.assertEqual(storage.uniques(flushed), set(["1"]))
+            counts = []
+            read = threading.Thread(
+                target=lambda: counts.append(storage.count(flushed))
+            )
+            read.start()
+            time.sleep(0.05)
+            self.assertEqual(counts, [])
+            inner.blocked.set()
+            flush.join()
+            read.join()
+            self.assertEqual(counts, [2])
+        finally:
+            storage.close()
@@ -0,0 +1,44 @@
+import datetime
+import unittest
+
+from sifr.cms import CountMinPrefixes, CountMinSketch, cells, dimensions
+from sifr.span import Minute, Hour
+
+
+class CountMinSketchTests(unittest.TestCase):
+    def test_dimensions(self):
+        self.assertEqual(dimensions(0.001, 0.99), (2719, 5))
+        self.assertEqual(dimensions(0.01, 0.5), (272, 1))
+
+    def test_cells(self):
+        indexes = cells("views:user:1", 100, 4)
+        self.assertEqual(indexes, cells(u"views:user:1", 100, 4))
+        self.assertEqual(
+            [index // 100 for index in indexes], [0, 1, 2, 3]
+        )
+
+    def test_error_bound(self):
+        sketch = CountMinSketch(*dimensions(0.01, 0.99))
+        counts = dict(("item%d" % i, i % 7 + 1) for i in range(2000))
+        for item, count in counts.items():
+            sketch.add(item, count)
+        total = sum(counts.values())
+        errors = [sketch.query(item) - count for item, count in counts.items()]
+        self.assertTrue(min(errors) >= 0)
+        self.assertTrue(
+            sum(error > 0.01 * total for error in errors) < 0.01 * len(counts)
+        )
+        self.assertEqual(sketch.copy().query("item1"), sketch.query("item1"))
+
+    def test_prefixes(self):
+        prefixes = CountMinPrefixes({"views": 0.01, "views:user": [0.1, 0.9]})
+        now = datetime.datetime.now()
+        span = Minute(now, ["views", "user", 1])
+        sketch = prefixes.sketch(span)
+        self.assertEqual(sketch.key, "views:user:" + span.timestamp)
+        self.assertEqual(sketch.expiry, span.expiry)
+        self.assertEqual((sketch.width, sketch.depth), (28, 3))
+        self.assertEqual(
+            prefixes.sketch(Hour(now, ["views", "page"])).namespace, "views"
+        )
+        self.assertEqual(prefixes.sketch(Hour(now, ["clicks"])), None)
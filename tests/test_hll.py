@@ -0,0 +1,102 @@
+import unittest
+
+import numpy
+
+from sifr.hll import HyperLogLog, HLLCounter, hash64, hash64_one
+
+
+class HyperLogLogTests(unittest.TestCase):
+    def test_precision(self):
+        self.assertEqual(HyperLogLog(0.005).precision, 16)
+        self.assertEqual(HyperLogLog(0.005).registers.dtype, numpy.uint8)
+        self.assertEqual(HyperLogLog(0.005).registers.nbytes, 1 << 16)
+        self.assertEqual(HyperLogLog(precision=10).precision, 10)
+
+    def test_hash(self):
+        hashes = hash64(["a", u"a", b"a", 1, "1", "", "a" * 100])
+        self.assertEqual(hashes.dtype, numpy.uint64)
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertEqual(hashes[0], hashes[2])
+        self.assertEqual(hashes[3], hashes[4])
+        self.assertEqual(len(set(hashes[3:])), 3)
+        self.assertEqual(list(hash64(["a"])), list(hashes[:1]))
+        self.assertEqual(hash64_one("a" * 100), hashes[-1])
+        self.assertEqual(len(hash64([])), 0)
+
+    def test_card(self):
+        for count in [0, 1, 10, 1000, 100000]:
+            hll = HyperLogLog(0.005)
+            hll.update(["user-%d" % i for i in range(count)])
+            hll.update(["user-%d" % i for i in range(count // 2)])
+            self.assertAlmostEqual(
+                hll.card(), count, delta=max(1, count * 0.02)
+            )
+
+    def test_add_merge(self):
+        first, second = HyperLogLog(0.01), HyperLogLog(0.01)
+        for i in range(500):
+            first.add(i)
+        second.update(range(250, 1000))
+        first.merge(second)
+        self.assertAlmostEqual(first.card(), 1000, delta=20)
+
+    def test_fold(self):
+        identifiers = ["user-%d" % i for i in range(20000)]
+        sketch = HyperLogLog(precision=14)
+        sketch.update(identifiers)
+        for precision in [14, 10, 4]:
+            expected = HyperLogLog(precision=precision)
+            expected.update(identifiers)
+            folded = sketch.fold(precision)
+            self.assertTrue((folded.registers == expected.registers).all())
+        self.assertRaises(ValueError, sketch.fold, 16)
+        coarse = HyperLogLog(precision=10)
+        coarse.update(identifiers[:100])
+        coarse.merge(sketch)
+        self.assertEqual(coarse.precision, 10)
+        self.assertAlmostEqual(coarse.card(), 20000, delta=1000)
+
+    def test_add_matches_update(self):
+        identifiers = ["", "a", "a" * 9, "a" * 100, 1, b"b"]
+        first, second = HyperLogLog(0.01), HyperLogLog(0.01)
+        first.update(identifiers)
+        for identifier in identifiers:
+            second.add(identifier)
+        self.assertTrue((first.registers == second.registers).all())
+
+
+class HLLCounterTests(unittest.TestCase):
+    def test_counter(self):
+        counter = HLLCounter()
+        self.assertEqual(counter.get("key"), 0)
+        counter.add("key", "1")
+        counter.add_many("key", ["1", "2", "3"])
+        self.assertEqual(counter.get("key"), 3)
+        counter.pop("key")
+        self.assertEqual(counter.get("key"), 0)
+
+    def test_promotion(self):
+        counter = HLLCounter(threshold=100)
+        counter.add_many("key", [str(i) for i in range(50)])
+        for i in range(100):
+            counter.add("key", str(i))
+        self.assertTrue(counter.is_exact("key"))
+        self.assertEqual(counter.get("key"), 100)
+        counter.add("key", "100")
+        self.assertFalse(counter.is_exact("key"))
+        self.assertAlmostEqual(counter.get("key"), 101, delta=2)
+        counter.add_many("key", [str(i) for i in range(1000)])
+        self.assertAlmostEqual(counter.get("key"), 1000, delta=20)
+        counter.add_many("other", [str(i) for i in range(101)])
+        self.assertFalse(counter.is_exact("other"))
+        counter.add_many("duplicates", (str(i % 10) for i in range(500)))
+        counter.add_many("duplicates", [str(i) for i in range(100)])
+        self.assertTrue(counter.is_exact("duplicates"))
+        self.assertEqual(counter.get("duplicates"), 100)
+
+    def test_sketches_only(self):
+        counter = HLLCounter(threshold=0)
+        counter.add("key", "1")
+        counter.add("key", "1")
+        self.assertFalse(counter.is_exact("key"))
+        self.assertEqual(counter.get("key"), 1)
@@ -1,8 +1,48 @@
 import unittest
 import datetime
+import time
 import hiro
 from sifr.span import Minute, Day, Hour
-from sifr.storage import MemoryStorage
+from sifr.storage import (
+    MemoryStorage, Storage, TrackLimitExceeded, sample_score
+)
+
+
+class MinimalStorage(Storage):
+    """
+    A storage that only implements the abstract methods it is tested with.
+    """
+
+    def __init__(self):
+        self.storage = MemoryStorage()
+        super(MinimalStorage, self).__init__()
+
+    def incr(self, span, amount=1):
+        self.storage.incr(span, amount)
+
+    def incr_multi(self, spans, amount=1):
+        self.storage.incr_multi(spans, amount)
+
+    def incr_unique(self, span, identifier):
+        self.storage.incr_unique(span, identifier)
+
+    def incr_unique_multi(self, spans, identifier):
+        self.storage.incr_unique_multi(spans, identifier)
+
+    def track(self, span, identifier):
+        self.storage.track(span, identifier)
+
+    def track_multi(self, spans, identifier):
+        self.storage.track_multi(spans, identifier)
+
+    def count(self, span):
+        return self.storage.count(span)
+
+    def cardinality(self, span):
+        return self.storage.cardinality(span)
+
+    def uniques(self, span):
+        return self.storage.uniques(span)
 
 
 class MemoryStorageTests(unittest.TestCase):
@@ -39,6 +79,88 @@ class MemoryStorageTests(unittest.TestCase):
             timeline.forward((60 * 60) + 1)
             self.assertEqual(storage.cardinality(span), 0)
 
+    def test_incr_unique_exact_threshold(self):
+        with hiro.Timeline().freeze():
+            span = Minute(datetime.datetime.now(), ["minute_span"])
+            storage = MemoryStorage(exact_threshold=1000)
+            for i in range(1000):
+                storage.incr_unique(span, i)
+            self.assertEqual(storage.cardinality(span), 1000)
+            self.assertTrue(storage.unique_counter.is_exact(span.key))
+            storage.incr_unique(span, 1000)
+            self.assertFalse(storage.unique_counter.is_exact(span.key))
+            self.assertAlmostEqual(storage.cardinality(span), 1001, delta=20)
+
+    def test_error_rates(self):
+        with hiro.Timeline().freeze():
+            now = datetime.datetime.now()
+            storage = MemoryStorage(
+                exact_threshold=0, error_rate=0.01,
+                resolution_error_rates={"minute": 0.05, "hour": 0.02},
+                prefix_error_rates={"views:page": 0.005, "views": 0.03}
+            )
+            spans = [
+                Minute(now, ["clicks"]), Hour(now, ["clicks"]),
+                Day(now, ["clicks"]), Minute(now, ["views", "page", 1]),
+                Day(now, ["views", "user", 1]), Minute(now, ["views", "pages"])
+            ]
+            for span in spans:
+                storage.incr_unique(span, "1")
+            self.assertEqual(
+                [
+                    storage.unique_counter.counter[span.key].precision
+                    for span in spans
+                ],
+                [9, 12, 14, 16, 11, 11]
+            )
+            self.assertEqual(storage.cardinality_union(spans), 1)
+
+    def test_cardinality_union(self):
+        with hiro.Timeline().freeze():
+            now = datetime.datetime.now()
+            storage = MemoryStorage(exact_threshold=100)
+            spans = [
+                Minute(now - datetime.timedelta(minutes=i), ["union"])
+                for i in range(3)
+            ]
+            for i, span in enumerate(spans):
+                for identifier in range(i * 50, i * 50 + 80):
+                    storage.incr_unique(span, identifier)
+            self.assertEqual(storage.cardinality_union(spans[:2]), 130)
+            storage.incr_unique_multi(spans[:1], "promote")
+            for identifier in range(1000):
+                storage.incr_unique(spans[2], identifier)
+            self.assertFalse(storage.unique_counter.is_exact(spans[2].key))
+            self.assertAlmostEqual(
+                storage.cardinality_union(spans), 1001, delta=20
+            )
+            self.assertEqual(storage.cardinality_union([]), 0)
+
+    def test_cardinality_intersection(self):
+        with hiro.Timeline().freeze():
+            now = datetime.datetime.now()
+            storage = MemoryStorage()
+            spans = [
+                Day(now, ["views", "page", page]) for page in range(3)
+            ]
+            for i, span in enumerate(spans):
+                for identifier in range(i * 10, 100):
+                    storage.incr_unique(span, identifier)
+            self.assertEqual(storage.cardinality_union(spans), 100)
+            self.assertEqual(storage.cardinality_intersection(spans), 80)
+            self.assertEqual(
+                storage.cardinality_intersection(spans[:2]), 90
+            )
+            self.assertEqual(
+                storage.cardinality_unions([spans[:1], spans[1:], []]),
+                [100, 90, 0]
+            )
+            self.assertEqual(storage.cardinality_intersection([]), 0)
+            self.assertRaises(
+                ValueError, storage.cardinality_intersection,
+                [Day(now, ["views", "page", page]) for page in range(25)]
+            )
+
     def test_tracker_minute(self):
         with hiro.Timeline().freeze() as timeline:
             span = Minute(datetime.datetime.now(), ["minute_span"])
@@ -85,3 +207,182 @@ class MemoryStorageTests(unittest.TestCase):
             self.assertEqual(storage.count(spans[1]), 0)
             self.assertEqual(storage.cardinality(spans[1]), 0)
             self.assertEqual(storage.uniques(spans[1]), set())
+
+    def test_range(self):
+        with hiro.Timeline().freeze(datetime.datetime(2012, 12, 29, 10)):
+            storage = MemoryStorage()
+            now = datetime.datetime.now()
+            for span in [Minute, Hour, Day]:
+                storage.incr(span(now, ["range"]), 2)
+                storage.incr_unique(span(now, ["range"]), "1")
+            storage.incr(Day(now - datetime.timedelta(days=1), ["range"]))
+            storage.incr_unique(
+                Day(now - datetime.timedelta(days=1), ["range"]), "2"
+            )
+            start = now - datetime.timedelta(days=2)
+            end = now + datetime.timedelta(days=2)
+            self.assertEqual(
+                storage.count_range(["range"], start, end, [Day]), 3
+            )
+            self.assertEqual(
+                storage.cardinality_range(["range"], start, end, [Day]), 2
+            )
+            storage.incr_unique(
+                Day(now - datetime.timedelta(days=1), ["range"]), "1"
+            )
+            self.assertEqual(
+                storage.cardinality_range(["range"], start, end, [Day]), 2
+            )
+            self.assertEqual(
+                storage.count_range(
+                    ["range"], now, now + datetime.timedelta(minutes=1),
+                    [Minute]
+                ), 2
+            )
+            self.assertEqual(
+                storage.count_many(
+                    [Minute(now, ["range"]), Hour(now, ["range"])]
+                ),
+                [2, 2]
+            )
+            self.assertEqual(
+                storage.cardinality_many(
+                    [Minute(now, ["range"]), Hour(now, ["range"])]
+                ),
+                [1, 1]
+            )
+
+    def test_incr_batch(self):
+        with hiro.Timeline().freeze():
+            storage = MemoryStorage()
+            now = datetime.datetime.now()
+            storage.incr_batch(
+                [(["batch", i % 2], now, i) for i in range(10)],
+                [Minute, Hour]
+            )
+            self.assertEqual(storage.count(Minute(now, ["batch", 0])), 20)
+            self.assertEqual(storage.count(Hour(now, ["batch", 1])), 25)
+            storage.incr_multi([Minute(now, ["batch", 0])], 5)
+            self.assertEqual(storage.count(Minute(now, ["batch", 0])), 25)
+
+    def test_top_k(self):
+        with hiro.Timeline().freeze() as timeline:
+            storage = MemoryStorage(topk_capacity=3)
+            now = datetime.datetime.now()
+            spans = [Minute(now, ["pages"]), Hour(now, ["pages"])]
+            for page in ["a", "b", "a", "c", "a", "b"]:
+                storage.incr_topk(spans, page)
+            storage.incr_topk(spans[:1], "d", 3)
+            self.assertEqual(storage.top_k(spans[0], 2), [("d", 4), ("a", 3)])
+            self.assertEqual(storage.top_k(spans[1], 2), [("a", 3), ("b", 2)])
+            self.assertEqual(storage.top_k(Minute(now, ["other"]), 2), [])
+            timeline.forward((60 * 60) + 1)
+            self.assertEqual(storage.top_k(spans[0], 2), [])
+            self.assertEqual(storage.top_k(spans[1], 1), [("a", 3)])
+
+    def test_count_min(self):
+        with hiro.Timeline().freeze() as timeline:
+            storage = MemoryStorage(count_min_prefixes={"views:user": 0.001})
+            now = datetime.datetime.now()
+            for user in range(100):
+                storage.incr_multi(
+                    [Minute(now, ["views", "user", user]),
+                     Hour(now, ["views", "user", user])],
+                    user
+                )
+            storage.incr(Minute(now, ["views", "page"]), 3)
+            self.assertEqual(len(storage.counter), 1)
+            self.assertEqual(len(storage.sketches), 2)
+            self.assertEqual(
+                storage.count_many([
+                    Minute(now, ["views", "user", 10]),
+                    Minute(now, ["views", "page"]),
+                    Hour(now, ["views", "user", 99]),
+                    Hour(now, ["views", "user", "other"]),
+                ]),
+                [10, 3, 99, 0]
+            )
+            timeline.forward((60 * 60) + 1)
+            self.assertEqual(
+                storage.count(Minute(now, ["views", "user", 10])), 0
+            )
+            self.assertEqual(
+                storage.count(Hour(now, ["views", "user", 10])), 10
+            )
+            users = Hour(now, ["views", "users"])
+            storage.incr(users, 5)
+            self.assertIn(users.key, storage.counter)
+            self.assertEqual(storage.count(users), 5)
+
+    def test_track_limit(self):
+        with hiro.Timeline().freeze():
+            now = datetime.datetime.now()
+            spans = [Minute(now, ["tracked"]), Hour(now, ["tracked"])]
+            identifiers = [str(i) for i in range(100)]
+            for policy in ["first", "reservoir", "reject"]:
+                storage = MemoryStorage(track_limit=10, track_policy=policy)
+                storage.track(spans[1], "0")
+                rejected = 0
+                for identifier in identifiers:
+                    try:
+                        storage.track_multi(spans, identifier)
+                    except TrackLimitExceeded as error:
+                        self.assertEqual(error.spans, spans)
+                        rejected += 1
+                self.assertEqual(len(storage.uniques(spans[0])), 10)
+                self.assertEqual(storage.tracked_cardinality(spans[0]), 100)
+                if policy == "reservoir":
+                    self.assertEqual(
+                        storage.uniques(spans[0]),
+                        set(sorted(identifiers, key=sample_score)[:10])
+                    )
+                else:
+                    self.assertEqual(
+                        storage.uniques(spans[0]), set(identifiers[:10])
+                    )
+                self.assertEqual(rejected, 90 if policy == "reject" else 0)
+            self.assertEqual(
+                MemoryStorage().tracked_cardinality(spans[0]), 0
+            )
+            self.assertRaises(
+                ValueError, MemoryStorage, track_policy="unknown"
+            )
+
+    def test_base_cardinality_range(self):
+        storage = MinimalStorage()
+        start = datetime.datetime(2012, 12, 12, 10)
+        expiry = time.time() + 60
+        spans = [
+            Hour(start, ["base"], expiry=expiry),
+            Hour(start + datetime.timedelta(hours=1), ["base"], expiry=expiry)
+        ]
+        storage.incr_unique_multi(spans, "1")
+        storage.incr_unique(spans[1], "2")
+        self.assertEqual(storage.cardinality_union(spans[1:]), 2)
+        self.assertEqual(
+            storage.cardinality_range(
+                ["base"], start, start + datetime.timedelta(hours=2), [Hour]
+            ),
+            3
+        )
+
+    def test_reaper(self):
+        storage = MemoryStorage()
+        now = datetime.datetime.now()
+        spans = [
+            Minute(now, ["reaped", i], expiry=time.time() + 0.05)
+            for i in range(10)
+        ]
+        for span in spans:
+            storage.incr(span)
+            storage.incr(span)
+            storage.incr_unique(span, "1")
+            storage.track(span, "1")
+        kept = Minute(now, ["kept"])
+        storage.incr(kept)
+        self.assertEqual(len(storage.expiry_queue), 11)
+        time.sleep(0.2)
+        self.assertEqual(list(storage.counter.keys()), [kept.key])
+        self.assertEqual(list(storage.expirations.keys()), [kept.key])
+        self.assertEqual(storage.tracker, {})
+        self.assertEqual(storage.expiry_queue, [(kept.expiry, kept.key)])
@@ -64,6 +64,10 @@ class MsgpackServerTests(unittest.TestCase):
             set(["test"]),
             cli.uniques("foo", datetime.datetime.now(), "hour")
         )
+        self.assertEqual(
+            1,
+            cli.tracked_cardinality("foo", datetime.datetime.now(), "hour")
+        )
 
     def tearDown(self):
         if self.server:
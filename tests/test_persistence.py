@@ -0,0 +1,114 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import hiro
+
+from sifr.persistence import Persistence, read_log
+from sifr.span import Minute, Hour, Day
+from sifr.storage import MemoryStorage
+
+
+class PersistenceTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, **kwargs):
+        storage = MemoryStorage(exact_threshold=10)
+        persistence = Persistence(
+            storage, self.directory, snapshot_interval=3600, **kwargs
+        ).open()
+        return storage, persistence
+
+    def write(self, storage, spans, offset=0):
+        storage.incr_multi(spans, 2)
+        for i in range(offset, offset + 20):
+            storage.incr_unique_multi(spans, i)
+        storage.track_multi(spans, "1")
+        storage.incr_topk(spans, "page")
+
+    def test_snapshot_and_log(self):
+        with hiro.Timeline().freeze():
+            now = datetime.datetime.now()
+            spans = [Minute(now, ["persist"]), Day(now, ["persist"])]
+            storage, persistence = self.open()
+            self.write(storage, spans)
+            persistence.snapshot()
+            self.write(storage, spans, 10)
+            expected = (
+                storage.count_many(spans), storage.cardinality_many(spans)
+            )
+            persistence.flush()
+            # simulate a crash: no final snapshot
+            persistence.stopped.set()
+
+            restored, persistence = self.open()
+            self.assertEqual(restored.count_many(spans), expected[0])
+            self.assertEqual(restored.cardinality_many(spans), expected[1])
+            self.assertEqual(restored.uniques(spans[0]), set(["1"]))
+            self.assertEqual(restored.top_k(spans[1], 1), [("page", 2)])
+            self.assertEqual(restored.expirations, storage.expirations)
+            persistence.close()
+            self.assertEqual(
+                sorted(os.listdir(self.directory)),
+                ["log.%d" % persistence.generation, "snapshot"]
+            )
+
+            restored, persistence = self.open()
+            self.assertEqual(restored.count_many(spans), expected[0])
+            restored.incr(spans[0])
+            persistence.close()
+            restored, persistence = self.open()
+            self.assertEqual(restored.count(spans[0]), expected[0][0] + 1)
+            persistence.close()
+
+    def test_truncated_log(self):
+        with hiro.Timeline().freeze():
+            span = Hour(datetime.datetime.now(), ["persist"])
+            storage, persistence = self.open(flush_interval=0)
+            for _ in range(5):
+                storage.incr(span)
+            path = persistence.log_path(persistence.generation)
+            persistence.stopped.set()
+            with open(path, "rb+") as log:
+                log.truncate(os.path.getsize(path) - 3)
+            self.assertEqual(len(list(read_log(path))), 4)
+            restored, persistence = self.open()
+            self.assertEqual(restored.count(span), 4)
+            persistence.close()
+
+    def test_expiry(self):
+        with hiro.Timeline().freeze() as timeline:
+            span = Minute(datetime.datetime.now(), ["persist"])
+            storage, persistence = self.open()
+            storage.incr(span)
+            persistence.close()
+            timeline.forward(60 * 60 + 1)
+            restored, persistence = self.open()
+            self.assertEqual(restored.count(span), 0)
+            persistence.close()
+
+    def test_flush_without_storage_lock(self):
+        span = Hour(datetime.datetime.now(), ["persist"])
+        storage, persistence = self.open(fsync=True)
+        storage.incr(span)
+        with storage.lock:
+            flusher = threading.Thread(target=persistence.flush)
+            flusher.start()
+            flusher.join(5)
+            self.assertFalse(flusher.is_alive())
+        persistence.close()
+
+    def test_close_unopened(self):
+        persistence = Persistence(MemoryStorage(), self.directory)
+        persistence.close()
+        storage, persistence = self.open()
+        persistence.close()
+        persistence.close()
+        self.assertEqual(len(os.listdir(self.directory)), 2)
@@ -1,10 +1,11 @@
 import unittest
 import datetime
+import threading
 
 import redis
 
-from sifr.span import Minute, Hour
-from sifr.storage import RedisStorage
+from sifr.span import Minute, Hour, get_time_spans
+from sifr.storage import RedisStorage, TrackLimitExceeded, sample_score
 
 
 class RedisStorageTests(unittest.TestCase):
@@ -61,3 +62,251 @@ class RedisStorageTests(unittest.TestCase):
 
         self.assertTrue(self.redis.ttl(spans[0].key + ":t") > 3000)
         self.assertTrue(self.redis.ttl(spans[1].key + ":t") > 3599*24)
+
+    def test_range(self):
+        storage = RedisStorage(self.redis)
+        now = datetime.datetime.now()
+        spans = get_time_spans(
+            now - datetime.timedelta(minutes=2),
+            now + datetime.timedelta(minutes=2),
+            ["range"], [Minute]
+        )
+        storage.incr_multi(spans)
+        storage.incr_unique_multi(spans, "1")
+        self.assertEqual(storage.count_many(spans), [1] * len(spans))
+        self.assertEqual(storage.cardinality_many(spans), [1] * len(spans))
+        self.assertEqual(
+            storage.count_range(
+                ["range"],
+                now - datetime.timedelta(minutes=2),
+                now + datetime.timedelta(minutes=2),
+                [Minute]
+            ),
+            len(spans)
+        )
+        self.assertEqual(
+            storage.cardinality_range(
+                ["range"],
+                now - datetime.timedelta(minutes=2),
+                now + datetime.timedelta(minutes=2),
+                [Minute]
+            ),
+            1
+        )
+        storage.incr_unique(spans[0], "2")
+        self.assertEqual(storage.cardinality_union(spans), 2)
+        self.assertEqual(storage.cardinality_union(spans[1:]), 1)
+        self.assertEqual(storage.cardinality_intersection(spans[:2]), 1)
+        self.assertEqual(
+            storage.cardinality_unions([spans[:1], spans[1:], []]), [2, 1, 0]
+        )
+
+    def test_incr_batch(self):
+        storage = RedisStorage(self.redis)
+        now = datetime.datetime.now()
+        storage.incr_batch(
+            [(["batch", i % 2], now, i) for i in range(10)],
+            [Minute, Hour]
+        )
+        self.assertEqual(storage.count(Minute(now, ["batch", 0])), 20)
+        self.assertEqual(storage.count(Hour(now, ["batch", 1])), 25)
+
+    def test_write_script(self):
+        storage = RedisStorage(self.redis)
+        now = datetime.datetime.now()
+        spans = [Minute(now, ["script"]), Hour(now, ["script"])]
+        storage.incr_multi(spans, 3)
+        storage.incr(spans[0], 2)
+        self.assertEqual(storage.count_many(spans), [5, 3])
+        self.assertAlmostEqual(
+            self.redis.ttl(spans[0].key + ":c"),
+            int(spans[0].expiry) - int(self.redis.time()[0]), delta=1
+        )
+        self.redis.expire(spans[0].key + ":c", 10)
+        storage.incr(spans[0])
+        self.assertEqual(self.redis.ttl(spans[0].key + ":c"), 10)
+        self.redis.persist(spans[1].key + ":c")
+        storage.incr(spans[1])
+        self.assertTrue(self.redis.ttl(spans[1].key + ":c") > 3599 * 24)
+
+    def test_top_k(self):
+        storage = RedisStorage(self.redis, topk_capacity=3)
+        now = datetime.datetime.now()
+        spans = [Minute(now, ["pages"]), Hour(now, ["pages"])]
+        for page in ["a", "b", "a", "c", "a", "b"]:
+            storage.incr_topk(spans, page)
+        storage.incr_topk(spans[:1], "d", 3)
+        self.assertEqual(self.redis.zcard(spans[0].key + ":k"), 3)
+        self.assertEqual(storage.top_k(spans[0], 2), [("d", 4), ("a", 3)])
+        self.assertEqual(storage.top_k(spans[1], 2), [("a", 3), ("b", 2)])
+        self.assertEqual(storage.top_k(Minute(now, ["other"]), 2), [])
+        self.assertTrue(self.redis.ttl(spans[0].key + ":k") > 0)
+
+    def test_count_min(self):
+        storage = RedisStorage(
+            self.redis, count_min_prefixes={"views:user": 0.001}
+        )
+        now = datetime.datetime.now()
+        for user in range(100):
+            storage.incr_multi(
+                [Minute(now, ["views", "user", user]),
+                 Hour(now, ["views", "user", user])],
+                user
+            )
+        storage.incr(Minute(now, ["views", "page"]), 3)
+        span = Minute(now, ["views", "user", 10])
+        self.assertEqual(
+            sorted(self.redis.keys()),
+            sorted([
+                "views:page:%s:c" % span.timestamp,
+                "views:user:%s:m" % span.timestamp,
+                "views:user:%s:m" % Hour(now, ["views"]).timestamp,
+            ])
+        )
+        self.assertTrue(self.redis.ttl("views:user:%s:m" % span.timestamp) > 0)
+        self.assertEqual(storage.count(span), 10)
+        self.assertEqual(
+            storage.count_many([
+                span,
+                Minute(now, ["views", "page"]),
+                Hour(now, ["views", "user", 99]),
+                Hour(now, ["views", "user", "other"]),
+            ]),
+            [10, 3, 99, 0]
+        )
+
+    def test_track_limit(self):
+        now = datetime.datetime.now()
+        spans = [Minute(now, ["tracked"]), Hour(now, ["tracked"])]
+        identifiers = [str(i) for i in range(100)]
+        for policy in ["first", "reservoir", "reject"]:
+            self.redis.flushall()
+            storage = RedisStorage(
+                self.redis, track_limit=10, track_policy=policy
+            )
+            storage.track(spans[1], "0")
+            rejected = 0
+            for identifier in identifiers:
+                try:
+                    storage.track_multi(spans, identifier)
+                except TrackLimitExceeded as error:
+                    self.assertEqual(error.spans, spans)
+                    rejected += 1
+            self.assertEqual(len(storage.uniques(spans[0])), 10)
+            self.assertEqual(storage.tracked_cardinality(spans[0]), 100)
+            if policy == "reservoir":
+                self.assertEqual(
+                    storage.uniques(spans[0]),
+                    set(sorted(identifiers, key=sample_score)[:10])
+                )
+            else:
+                self.assertEqual(
+                    storage.uniques(spans[0]), set(identifiers[:10])
+                )
+            self.assertEqual(rejected, 90 if policy == "reject" else 0)
+            self.assertTrue(self.redis.ttl(spans[0].key + ":h") > 0)
+        self.redis.flushall()
+        storage = RedisStorage(self.redis)
+        storage.track(spans[0], "1")
+        self.assertEqual(storage.tracked_cardinality(spans[0]), 1)
+
+
+class RedisClusterModeTests(unittest.TestCase):
+    def setUp(self):
+        self.redis = redis.Redis(decode_responses=True)
+        self.redis.flushall()
+
+    def test_keys(self):
+        storage = RedisStorage(self.redis, cluster=True)
+        now = datetime.datetime.now()
+        spans = [Minute(now, ["views", 1]), Hour(now, ["views", 1])]
+        storage.incr_multi(spans, 2)
+        storage.incr_unique_multi(spans, "1")
+        storage.track_multi(spans, "1")
+        for span in spans:
+            key = "{views:1}:" + span.timestamp
+            self.assertEqual(storage.key(span, ":c"), key + ":c")
+            self.assertEqual(self.redis.get(key + ":c"), "2")
+            self.assertTrue(self.redis.ttl(key + ":u") > 3000)
+            self.assertEqual(self.redis.smembers(key + ":t"), set(["1"]))
+        self.assertEqual(
+            storage.slot(storage.key(spans[0], ":c")),
+            storage.slot(storage.key(spans[1], ":u"))
+        )
+        self.assertEqual(storage.count(spans[0]), 2)
+        self.assertEqual(storage.cardinality(spans[0]), 1)
+        self.assertEqual(storage.uniques(spans[0]), set(["1"]))
+
+    def test_pipeline_per_node(self):
+        nodes = [
+            redis.Redis(decode_responses=True),
+            redis.Redis(decode_responses=True)
+        ]
+        pipelines = []
+
+        class Storage(RedisStorage):
+            def node(self, key):
+                node = nodes[self.slot(key) % 2]
+                pipelines.append(id(node))
+                return node
+
+        storage = Storage(self.redis, cluster=True)
+        now = datetime.datetime.now()
+        spans = [Minute(now, ["views", i]) for i in range(10)]
+        storage.incr_spans((span, i) for i, span in enumerate(spans))
+        self.assertEqual(len(set(pipelines)), 2)
+        self.assertEqual(storage.count_many(spans), list(range(10)))
+        for i, span in enumerate(spans):
+            storage.incr_unique_multi(spans[i:], i)
+        self.assertEqual(storage.cardinality_many(spans), list(range(1, 11)))
+        self.assertEqual(
+            storage.cardinality_unions([spans[:1], spans, spans[3:], []]),
+            [1, 10, 10, 0]
+        )
+        self.assertEqual(
+            storage.cardinality_intersection([spans[2], spans[5]]), 3
+        )
+        self.assertEqual(self.redis.keys("*union*"), [])
+
+
+class BatchedRedisStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.redis = redis.Redis(decode_responses=True)
+        self.redis.flushall()
+
+    def test_shared_pipelines(self):
+        storage = RedisStorage(self.redis, batch_window=0.05)
+        pipelines = []
+        pipeline = self.redis.pipeline
+
+        def counting_pipeline(*args, **kwargs):
+            pipelines.append(1)
+            return pipeline(*args, **kwargs)
+        self.redis.pipeline = counting_pipeline
+        now = datetime.datetime.now()
+        spans = [Minute(now, ["batched"]), Hour(now, ["batched"])]
+        start = threading.Event()
+
+        def write():
+            start.wait()
+            storage.incr_multi(spans, 2)
+            storage.incr_unique_multi(spans, threading.current_thread().name)
+        threads = [threading.Thread(target=write) for _ in range(20)]
+        [thread.start() for thread in threads]
+        start.set()
+        [thread.join() for thread in threads]
+        self.assertTrue(len(pipelines) < 20)
+        self.assertEqual(storage.count_many(spans), [40, 40])
+        self.assertEqual(storage.count(spans[0]), 40)
+        self.assertEqual(storage.cardinality(spans[1]), 20)
+        self.assertTrue(self.redis.ttl(spans[0].key + ":c") > 3000)
+
+    def test_errors(self):
+        storage = RedisStorage(self.redis, batch_window=0.01, batch_size=1)
+        span = Minute(datetime.datetime.now(), ["batched"])
+        self.redis.sadd(span.key + ":c", "1")
+        self.assertRaises(redis.ResponseError, storage.incr, span)
+        storage.incr_unique(span, "1")
+        self.assertEqual(storage.cardinality(span), 1)
+        storage.track(span, "1")
+        self.assertEqual(storage.uniques(span), set(["1"]))
@@ -4,7 +4,7 @@ import datetime
 import redis
 import riak
 
-from sifr.span import Minute, Hour
+from sifr.span import Minute, Hour, get_time_spans
 from sifr.storage import RedisStorage, RiakStorage
 
 
@@ -12,7 +12,7 @@ class RedisStorageTests(unittest.TestCase):
     def setUp(self):
         self.riak = riak.RiakClient(pb_port=8087, protocol='pbc')
         storage = RiakStorage(self.riak)
-        for bucket in [storage.unique_counters_bucket, storage.uniques_bucket, storage.counter_bucket]:
+        for bucket in [storage.unique_counters_bucket, storage.uniques_bucket, storage.counter_bucket, storage.partitions_bucket]:
             for key in bucket.get_keys():
                 bucket.delete(key)
 
@@ -58,3 +58,89 @@ class RedisStorageTests(unittest.TestCase):
         self.assertEqual(storage.cardinality(spans[1]), 2)
         self.assertEqual(storage.uniques(spans[0]), set(["1", "2"]))
         self.assertEqual(storage.uniques(spans[1]), set(["1", "2"]))
+
+    def test_range(self):
+        storage = RiakStorage(self.riak)
+        now = datetime.datetime.now()
+        spans = get_time_spans(
+            now - datetime.timedelta(minutes=2),
+            now + datetime.timedelta(minutes=2),
+            ["range"], [Minute]
+        )
+        storage.incr_multi(spans)
+        storage.incr_unique_multi(spans, "1")
+        self.assertEqual(storage.count_many(spans), [1] * len(spans))
+        self.assertEqual(storage.cardinality_many(spans), [1] * len(spans))
+        self.assertEqual(
+            storage.count_range(
+                ["range"],
+                now - datetime.timedelta(minutes=2),
+                now + datetime.timedelta(minutes=2),
+                [Minute]
+            ),
+            len(spans)
+        )
+        self.assertEqual(
+            storage.cardinality_range(
+                ["range"],
+                now - datetime.timedelta(minutes=2),
+                now + datetime.timedelta(minutes=2),
+                [Minute]
+            ),
+            1
+        )
+        storage.incr_unique(spans[0], "2")
+        self.assertEqual(storage.cardinality_union(spans), 2)
+        self.assertEqual(storage.cardinality_union(spans[1:]), 1)
+        self.assertEqual(storage.cardinality_intersection(spans[:2]), 1)
+        self.assertEqual(
+            storage.cardinality_unions([spans[:1], spans[1:], []]), [2, 1, 0]
+        )
+
+    def test_incr_batch(self):
+        storage = RiakStorage(self.riak)
+        now = datetime.datetime.now()
+        storage.incr_batch(
+            [(["batch", i % 2], now, i) for i in range(10)],
+            [Minute, Hour]
+        )
+        self.assertEqual(storage.count(Minute(now, ["batch", 0])), 20)
+        self.assertEqual(storage.count(Hour(now, ["batch", 1])), 25)
+
+    def test_parallel_namespaces(self):
+        storage = RiakStorage(self.riak, max_workers=4)
+        now = datetime.datetime.now()
+        spans = [
+            span(now, ["parallel", i]) for i in range(10)
+            for span in [Minute, Hour]
+        ]
+        storage.incr_spans((span, i) for i, span in enumerate(spans))
+        storage.incr_unique_multi(spans, "1")
+        fetched = []
+        get = storage.counter_bucket.get
+
+        def counting_get(namespace):
+            fetched.append(namespace)
+            return get(namespace)
+        storage.counter_bucket.get = counting_get
+        self.assertEqual(storage.count_many(spans), list(range(20)))
+        self.assertEqual(sorted(fetched), sorted(set(fetched)))
+        self.assertEqual(len(fetched), 10)
+        self.assertEqual(storage.cardinality_many(spans), [1] * 20)
+        storage.close()
+
+    def test_partitioned(self):
+        storage = RiakStorage(self.riak, partitioned=True)
+        now = datetime.datetime(2015, 3, 10, 12, 30)
+        spans = [Minute(now, ["views", 1]), Hour(now, ["views", 1])]
+        old = Minute(now - datetime.timedelta(days=3), ["views", 1])
+        storage.incr_multi(spans + [old], 2)
+        storage.incr_unique_multi(spans, "1")
+        self.assertEqual(storage.map_key(spans[0]), "views:1@2015-03-10")
+        self.assertEqual(storage.map_key(spans[1]), "views:1@2015-03")
+        self.assertEqual(storage.count_many(spans + [old]), [2, 2, 2])
+        self.assertEqual(storage.cardinality_many(spans), [1, 1])
+        self.assertEqual(storage.sweep(now), 1)
+        self.assertEqual(storage.count_many(spans + [old]), [2, 2, 0])
+        storage.sweep(now + datetime.timedelta(days=2))
+        self.assertEqual(storage.count_many(spans), [0, 2])
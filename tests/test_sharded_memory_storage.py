@@ -0,0 +1,67 @@
+import unittest
+import datetime
+import threading
+import hiro
+from sifr.span import Minute, Hour, Day
+from sifr.storage import ShardedMemoryStorage
+
+
+class ShardedMemoryStorageTests(unittest.TestCase):
+    def test_multi(self):
+        with hiro.Timeline().freeze() as timeline:
+            storage = ShardedMemoryStorage(shards=4)
+            spans = [
+                span(datetime.datetime.now(), ["sharded", i])
+                for span in [Minute, Hour] for i in range(10)
+            ]
+            storage.incr_multi(spans, 2)
+            storage.incr_spans([(spans[0], 1)])
+            storage.incr_unique_multi(spans, "1")
+            storage.incr_unique(spans[0], "2")
+            storage.track_multi(spans, "1")
+            storage.track(spans[0], "2")
+            self.assertTrue(
+                len(set(id(storage.shard(span)) for span in spans)) > 1
+            )
+            self.assertEqual(
+                storage.count_many(spans), [3] + [2] * (len(spans) - 1)
+            )
+            self.assertEqual(
+                storage.cardinality_many(spans), [2] + [1] * (len(spans) - 1)
+            )
+            self.assertEqual(storage.count(spans[1]), 2)
+            self.assertEqual(storage.cardinality(spans[0]), 2)
+            self.assertEqual(storage.cardinality_union(spans), 2)
+            self.assertEqual(storage.uniques(spans[0]), set(["1", "2"]))
+            self.assertEqual(storage.uniques(spans[1]), set(["1"]))
+            timeline.forward((60 * 60) + 1)
+            self.assertEqual(
+                storage.count_many(spans), [0] * 10 + [2] * 10
+            )
+
+    def test_concurrent_writes(self):
+        storage = ShardedMemoryStorage(shards=4)
+        now = datetime.datetime.now()
+
+        def write():
+            for i in range(200):
+                storage.incr_multi(
+                    [span(now, ["sharded", i % 10]) for span in [Hour, Day]]
+                )
+                storage.incr_unique(Hour(now, ["sharded", i % 10]), i)
+                storage.track(Hour(now, ["sharded", i % 10]), i)
+
+        threads = [threading.Thread(target=write) for _ in range(4)]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+        self.assertEqual(
+            storage.count_many(
+                [Hour(now, ["sharded", i]) for i in range(10)]
+            ),
+            [80] * 10
+        )
+        self.assertEqual(
+            [len(storage.uniques(Hour(now, ["sharded", i])))
+             for i in range(10)],
+            [20] * 10
+        )
@@ -0,0 +1,112 @@
+import datetime
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import hiro
+
+from sifr.shared import SharedMemoryStorage, SharedTableFull, _HEADER, _SLOT
+from sifr.span import Minute, Hour, Day
+
+
+def count_in_process(path, at, events):
+    storage = SharedMemoryStorage(path)
+    spans = [
+        span(at, ["shared", i]) for i in range(3) for span in [Minute, Hour]
+    ]
+    for i in range(events):
+        storage.incr_multi(spans[(i % 3) * 2:(i % 3) * 2 + 2])
+    storage.close()
+
+
+class SharedMemoryStorageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "counters")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_incr(self):
+        with hiro.Timeline().freeze() as timeline:
+            storage = SharedMemoryStorage(self.path, capacity=64, stripes=4)
+            now = datetime.datetime.now()
+            spans = [Minute(now, ["shared"]), Day(now, ["shared"])]
+            storage.incr_multi(spans, 2)
+            storage.incr_spans([(spans[0], 3)])
+            storage.incr(spans[1])
+            self.assertEqual(storage.count_many(spans), [5, 3])
+            other = SharedMemoryStorage(self.path)
+            self.assertEqual(other.capacity, 64)
+            self.assertEqual(other.count(spans[0]), 5)
+            timeline.forward(60 * 60 + 1)
+            self.assertEqual(storage.count_many(spans), [0, 3])
+            later = Minute(datetime.datetime.now(), ["shared"])
+            storage.incr(later)
+            self.assertEqual(other.count(later), 1)
+            self.assertRaises(
+                NotImplementedError, storage.incr_unique, spans[0], "1"
+            )
+            self.assertRaises(NotImplementedError, storage.uniques, spans[0])
+            storage.close()
+            other.close()
+
+    def test_full(self):
+        with hiro.Timeline().freeze() as timeline:
+            storage = SharedMemoryStorage(self.path, capacity=8, stripes=1)
+            now = datetime.datetime.now()
+            spans = [Minute(now, ["full", i]) for i in range(9)]
+            storage.incr_multi(spans[:8])
+            self.assertRaises(SharedTableFull, storage.incr, spans[8])
+            timeline.forward(60 * 60 + 1)
+            later = Minute(datetime.datetime.now(), ["full", 8])
+            storage.incr(later)
+            self.assertEqual(storage.count_many(spans[:8]), [0] * 8)
+            self.assertEqual(storage.count(later), 1)
+            self.assertEqual(
+                [
+                    _SLOT.unpack_from(
+                        storage.map, _HEADER.size + i * _SLOT.size
+                    )[0] != 0
+                    for i in range(8)
+                ].count(True),
+                1
+            )
+            storage.close()
+
+    def test_same_path(self):
+        now = datetime.datetime.now()
+        span = Hour(now, ["shared"])
+        first = SharedMemoryStorage(self.path, capacity=64, stripes=4)
+        second = SharedMemoryStorage(self.path)
+        self.assertIs(first.locks, second.locks)
+        first.incr(span)
+        first.close()
+        first.close()
+        second.incr(span)
+        self.assertEqual(second.count(span), 2)
+        second.close()
+        self.assertTrue(second.map.closed)
+
+    def test_processes(self):
+        at = datetime.datetime.now()
+        SharedMemoryStorage(self.path, capacity=1024, stripes=8).close()
+        processes = [
+            multiprocessing.Process(
+                target=count_in_process, args=(self.path, at, 300)
+            )
+            for _ in range(4)
+        ]
+        [process.start() for process in processes]
+        [process.join() for process in processes]
+        storage = SharedMemoryStorage(self.path)
+        self.assertEqual(
+            storage.count_many(
+                [span(at, ["shared", i]) for i in range(3)
+                 for span in [Minute, Hour]]
+            ),
+            [400] * 6
+        )
+        storage.close()
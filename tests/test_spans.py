@@ -2,7 +2,10 @@ import unittest
 import datetime
 import time
 import hiro
-from sifr.span import Minute, Year, Month, Day, Hour, get_time_spans, Forever
+from sifr.span import (
+    Minute, Year, Month, Day, Hour, get_time_spans, Forever,
+    iter_time_spans, plan_time_spans, coalesce_events
+)
 
 
 class SpanTests(unittest.TestCase):
@@ -79,3 +82,70 @@ class SpanTests(unittest.TestCase):
                     buckets=[Day]
                 )) == 34
             )
+
+    def test_query_keys_partial_buckets(self):
+        self.assertEqual(
+            [k.key for k in get_time_spans(
+                start=datetime.datetime(2012, 11, 30, 22, 59, 0, 1),
+                end=datetime.datetime(2013, 1, 1, 1, 0),
+                keys=["single"],
+                buckets=[Month, Day, Hour]
+            )],
+            ["single:2012-11-30_23",
+             "single:2012-12",
+             "single:2013-01-01_00",
+             ]
+        )
+
+    def test_query_keys_lazy(self):
+        spans = iter_time_spans(
+            start=datetime.datetime(2012, 1, 1),
+            end=datetime.datetime(2013, 1, 1),
+            keys=["single"],
+            buckets=[Minute]
+        )
+        self.assertEqual(next(spans).key, "single:2012-01-01_00:00")
+        self.assertEqual(next(spans).key, "single:2012-01-01_00:01")
+
+    def test_plan(self):
+        plan = plan_time_spans(
+            datetime.datetime(2012, 1, 1),
+            datetime.datetime(2013, 1, 1),
+            [Minute]
+        )
+        self.assertEqual(len(plan), 1)
+        span, first, last = plan[0]
+        self.assertEqual(span, Minute)
+        self.assertEqual(last - first + 1, 366 * 24 * 60)
+        self.assertEqual(
+            [(span, last - first + 1) for span, first, last in
+             plan_time_spans(
+                 datetime.datetime(2012, 2, 28, 23),
+                 datetime.datetime(2013, 3, 1),
+             )],
+            [(Hour, 1), (Day, 1), (Month, 12)]
+        )
+
+    def test_coalesce_events(self):
+        at = datetime.datetime(2012, 12, 12, 10, 10)
+        spans = dict(
+            (span.key, amount) for span, amount in coalesce_events(
+                [
+                    (["views", 1], at, 1),
+                    (["views", 1], at + datetime.timedelta(seconds=30), 2),
+                    (["views", 1], at + datetime.timedelta(minutes=1), 3),
+                    (["views", 2], at, 4),
+                ],
+                [Hour, Minute]
+            )
+        )
+        self.assertEqual(
+            spans,
+            {
+                "views:1:2012-12-12_10": 6,
+                "views:1:2012-12-12_10:10": 3,
+                "views:1:2012-12-12_10:11": 3,
+                "views:2:2012-12-12_10": 4,
+                "views:2:2012-12-12_10:10": 4,
+            }
+        )
@@ -0,0 +1,49 @@
+import pickle
+import random
+import unittest
+
+from sifr.topk import SpaceSaving
+
+
+class SpaceSavingTests(unittest.TestCase):
+    def test_exact_below_capacity(self):
+        sketch = SpaceSaving(10)
+        for i in range(5):
+            sketch.add(i, i + 1)
+        sketch.add(4)
+        self.assertEqual(len(sketch), 5)
+        self.assertEqual(sketch.top(2), [(4, 6), (3, 4)])
+
+    def test_eviction(self):
+        sketch = SpaceSaving(2)
+        sketch.add("a", 5)
+        sketch.add("b", 2)
+        sketch.add("c")
+        self.assertEqual(len(sketch), 2)
+        self.assertEqual(sketch.top(2), [("a", 5), ("c", 3)])
+
+    def test_heavy_hitters(self):
+        random.seed(0)
+        sketch = SpaceSaving(20)
+        stream = ["hot%d" % (i % 5) for i in range(5000)]
+        stream += ["cold%d" % random.randint(0, 10000) for _ in range(5000)]
+        random.shuffle(stream)
+        for item in stream:
+            sketch.add(item)
+        self.assertEqual(len(sketch), 20)
+        self.assertEqual(
+            sorted(item for item, _ in sketch.top(5)),
+            ["hot%d" % i for i in range(5)]
+        )
+        for _, count in sketch.top(5):
+            self.assertTrue(1000 <= count <= 1000 + 10000 // 20)
+
+    def test_copy(self):
+        sketch = SpaceSaving(3)
+        for item in "abcabd":
+            sketch.add(item)
+        for copy in [sketch.copy(), pickle.loads(pickle.dumps(sketch))]:
+            self.assertEqual(copy.top(3), sketch.top(3))
+            copy.add("e", 10)
+            self.assertEqual(copy.top(1), [("e", 12)])
+            self.assertEqual(sketch.top(1)[0][0], "a")